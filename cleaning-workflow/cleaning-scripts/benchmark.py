@@ -0,0 +1,243 @@
+"""
+this script times the cleaning stages on synthetic data (see
+`synthetic_crashes.py`), so changes to the scripts can be checked for speed
+and memory before the real data gets bigger.
+
+for every scale (1 is the size of the 2022 file, 1000 is a thousand times
+that), it makes the synthetic files, gets each stage's input ready the same
+way the pipeline would, and then runs the stage on a fresh copy of it. a
+stage's time is the fastest of `--repeat` runs, and its peak memory is the
+most python and numpy allocated during one extra run (measured with
+`tracemalloc`, so it leaves out memory pyarrow allocates for string columns).
+
+    python benchmark.py --scale 1 10 100 --repeat 3 --out "benchmark.json"
+
+the results are printed as a table, and saved as json with one record per
+stage and scale:
+    {"stage": ..., "scale": ..., "rows": ..., "seconds": ...,
+     "rows_per_sec": ..., "peak_memory_bytes": ...}
+along with the git commit and the python/pandas/numpy versions, so runs
+from different commits can be compared.
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+from collections import namedtuple
+
+# the git commit and library versions
+from run_report import environment
+from synthetic_crashes import TEMPLATE_FILE, load_template, generate_all
+
+from main_data_cleaning import (
+    rename_df,
+    rename_dict_13_18,
+    rename_dict_03_15,
+    organize_location_cols,
+    add_bike_ped_flags,
+)
+from clean_times import clean_1318, clean_0315
+from clean_datetime import clean_date_time
+from clean_addresses import clean_addresses
+from merge_bike_ped import build_index, merge
+from make_master_file import drop_duplicate_years, estimate_fields
+from jitter import add_jitter
+from make_geojson import LAYERS, prepare, save_geojson, save_tiles
+from make_columnar import save_layers
+from make_charts import build_cube
+
+# `input` is the name of the prepared df the stage runs on
+Stage = namedtuple("Stage", ["name", "input", "run"])
+
+
+def prepare_inputs(files):
+    """
+    returns the df each stage starts from, made from the synthetic files by
+    the stages before it, the same order as the pipeline
+    """
+    inputs = {
+        "1318": rename_df(files["moco-crash-2013-2018-synthetic"], rename_dict_13_18),
+        "0315": rename_df(files["moco-crash-2003-2015-synthetic"], rename_dict_03_15),
+        "crashes": files["moco-crash-synthetic"],
+    }
+    # the bike/ped files are cleaned the same as the crash files
+    for name in ["bike", "ped"]:
+        inputs[name] = clean_date_time(
+            files[name + "-crashes-synthetic"].copy(), "Collision Date", "Collision Time"
+        )
+    inputs["0315 locations"] = add_bike_ped_flags(
+        organize_location_cols(inputs["0315"].copy())
+    )
+    inputs["0315 times"] = clean_date_time(
+        clean_0315(inputs["0315 locations"].copy()), "Collision Date", "Collision Time"
+    )
+    inputs["dated"] = clean_date_time(
+        inputs["crashes"].copy(), "Collision Date", "Collision Time"
+    )
+    inputs["merged"] = merge(
+        merge(inputs["dated"].copy(), build_index(inputs["bike"]), "Cyclist Involved"),
+        build_index(inputs["ped"]),
+        "Pedestrian Involved",
+    )
+    inputs["jittered"] = add_jitter(inputs["merged"].copy())
+    inputs["prepared"] = prepare(inputs["jittered"])
+    return inputs
+
+
+def geojson_files(out_dir):
+    return [os.path.join(out_dir, "master-%s.geojson" % name) for name in LAYERS]
+
+
+def stages(inputs, out_dir):
+    """ the stages, in pipeline order """
+    bike_index = build_index(inputs["bike"])
+    ped_index = build_index(inputs["ped"])
+    return [
+        Stage("clean_1318", "1318", lambda df: clean_1318(df, "Collision Time")),
+        Stage("organize_location_cols", "0315", organize_location_cols),
+        Stage("clean_0315", "0315 locations", clean_0315),
+        Stage(
+            "clean_date_time",
+            "crashes",
+            lambda df: clean_date_time(df, "Collision Date", "Collision Time"),
+        ),
+        Stage("clean_addresses", "dated", clean_addresses),
+        Stage(
+            "merge_bike_ped",
+            "dated",
+            lambda df: merge(
+                merge(df, bike_index, "Cyclist Involved"),
+                ped_index,
+                "Pedestrian Involved",
+            ),
+        ),
+        Stage(
+            "estimate_fields",
+            "0315 times",
+            lambda df: estimate_fields(drop_duplicate_years(df)),
+        ),
+        Stage("add_jitter", "merged", add_jitter),
+        Stage(
+            "save_geojson",
+            "prepared",
+            lambda df: save_geojson(df, geojson_files(out_dir)),
+        ),
+        Stage(
+            "save_tiles",
+            "prepared",
+            lambda df: save_tiles(df, os.path.join(out_dir, "tiles")),
+        ),
+        Stage(
+            "save_columnar",
+            "prepared",
+            lambda df: save_layers(df, os.path.join(out_dir, "columnar")),
+        ),
+        Stage("build_cube", "jittered", build_cube),
+    ]
+
+
+def time_stage(stage, df, repeat):
+    """ returns the fastest of `repeat` runs, in seconds """
+    times = []
+    for _ in range(repeat):
+        data = df.copy()
+        gc.collect()
+        start = time.perf_counter()
+        stage.run(data)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def peak_memory(stage, df):
+    """ returns the most memory allocated at once during a run, in bytes """
+    data = df.copy()
+    gc.collect()
+    tracemalloc.start()
+    stage.run(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark(template, scale, repeat=3, seed=0, names=None):
+    """ returns a result record for every stage at one scale """
+    inputs = prepare_inputs(generate_all(template, scale, seed))
+    out_dir = tempfile.mkdtemp(prefix="crash-benchmark-")
+    results = []
+    try:
+        for stage in stages(inputs, out_dir):
+            if names and stage.name not in names:
+                continue
+            df = inputs[stage.input]
+            seconds = time_stage(stage, df, repeat)
+            results.append(
+                {
+                    "stage": stage.name,
+                    "scale": scale,
+                    "rows": len(df),
+                    "seconds": round(seconds, 6),
+                    "rows_per_sec": round(len(df) / seconds) if seconds else None,
+                    "peak_memory_bytes": peak_memory(stage, df),
+                }
+            )
+            print_result(results[-1])
+    finally:
+        shutil.rmtree(out_dir)
+    return results
+
+
+def print_result(result):
+    print(
+        "%-24s x%-6g %10d rows %9.3fs %12s rows/s %9.1f MB"
+        % (
+            result["stage"],
+            result["scale"],
+            result["rows"],
+            result["seconds"],
+            result["rows_per_sec"],
+            result["peak_memory_bytes"] / 1e6,
+        )
+    )
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="time the cleaning stages")
+    parser.add_argument(
+        "--scale", type=float, nargs="+", default=[1], help="x the 2022 file"
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--template", default=TEMPLATE_FILE)
+    parser.add_argument("--stages", nargs="+", help="only run these stages")
+    parser.add_argument("--out", help="save the results to this json file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    ARGS = parse_args(sys.argv[1:])
+    TEMPLATE = load_template(ARGS.template)
+
+    RESULTS = []
+    for SCALE in ARGS.scale:
+        RESULTS += benchmark(TEMPLATE, SCALE, ARGS.repeat, ARGS.seed, ARGS.stages)
+
+    if ARGS.out:
+        with open(ARGS.out, "w") as f:
+            json.dump(
+                {
+                    "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "seed": ARGS.seed,
+                    "repeat": ARGS.repeat,
+                    **environment(),
+                    "results": RESULTS,
+                },
+                f,
+                indent=2,
+            )
+        print("results saved to", ARGS.out)
@@ -0,0 +1,252 @@
+"""
+this script matches misspelled road names to the right spelling, ex.
+`N MATTEWS DR` -> `N MATTHEWS DR` or `W KIRWOOD AVE` -> `W KIRKWOOD AVE`.
+
+the list of right spellings (the gazetteer) is every road name that shows up
+at least `MIN_COUNT` times in the clean data: a typo is rarely made the same
+way three times. every unique name in a file is looked up once:
+    - names in the gazetteer are kept, with a confidence of 1
+    - other names are looked up in an index of the gazetteer's 3 letter
+      pieces, which finds the `CANDIDATES` names with the most pieces in
+      common without comparing against every name. the most similar
+      candidate is used if its similarity (0 to 1) is at least `MIN_SCORE`,
+      and that similarity is the confidence
+    - a candidate is never used if it has different numbers (`E 2ND ST`
+      isn't `E 3RD ST`), different directions (`N` vs `S`) or a different
+      street type (`DR` vs `RD`) than the name, or if the rest of the names
+      are less than `MIN_CORE_SCORE` similar (`TULIP` isn't `STULL`). a name
+      without a street type can get one (`N JACKSON` -> `N JACKSON ST`), but
+      a street type is never dropped. a direction glued to the name
+      (`EDISCOVERY PKWY`) is split off, and never dropped either
+    - names that don't match anything are left as they are
+the confidences are added as `Roadway Id Match Confidence` and
+`Intersecting Road Match Confidence`.
+
+build the gazetteer from the clean files:
+    python canonicalize_streets.py --build "../../data/clean-data/moco-crash-2022-clean.csv" /
+        "../../data/clean-data/moco-crash-2021-clean.csv" ... /
+        "../../data/cleaning-process/street-gazetteer.csv"
+then canonicalize any number of files (after clean_addresses.py):
+    python canonicalize_streets.py "../../data/cleaning-process/street-gazetteer.csv" /
+        "in-file" "out-file" "in-file-2" "out-file-2" ...
+`pipeline.py` runs this step after clean_addresses.py whenever the gazetteer
+file exists.
+"""
+
+import os
+import re
+import sys
+import difflib
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+
+# parquet or csv, depending on the file name
+from crash_schema import read_table, write_table
+
+from intersection_index import normalize_road
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
+
+GAZETTEER_FILE = "../../data/cleaning-process/street-gazetteer.csv"
+
+ROAD_COLS = ["Roadway Id", "Intersecting Road"]
+CONFIDENCE_COLS = {
+    "Roadway Id": "Roadway Id Match Confidence",
+    "Intersecting Road": "Intersecting Road Match Confidence",
+}
+
+# how many times a spelling has to be seen to count as right
+MIN_COUNT = 3
+# how similar a name has to be to its match
+MIN_SCORE = 0.8
+# names compared closely for every lookup
+CANDIDATES = 10
+NGRAM = 3
+
+DIRECTIONS = {"N", "S", "E", "W", "NB", "SB", "EB", "WB"}
+STREET_TYPES = set("ST RD DR AVE LN CT PKWY PK BLVD WAY PL CIR TRL HWY BYPASS".split())
+# how similar the names have to be without their directions and types
+MIN_CORE_SCORE = 0.85
+
+
+def load_data(in_file):
+    """ returns a pandas dataframe of the cleaned dataset """
+    return read_table(in_file, low_memory=False)
+
+
+def load_gazetteer(path=GAZETTEER_FILE):
+    """ the saved gazetteer, or None if it hasn't been built yet """
+    if not os.path.exists(path):
+        return None
+    return read_table(path, keep_default_na=False)
+
+
+def build_gazetteer(dfs, min_count=MIN_COUNT):
+    """ every road name seen at least `min_count` times, most common first """
+    roads = pd.concat(
+        [df[col] for df in dfs for col in ROAD_COLS if col in df], ignore_index=True
+    )
+    counts = roads.dropna().map(normalize_road).value_counts()
+    counts = counts[(counts >= min_count) & (counts.index != "")]
+    return pd.DataFrame({"Road": counts.index, "Count": counts.to_numpy()})
+
+
+def ngrams(name, n=NGRAM):
+    """ the n letter pieces of a name, padded so the ends count too """
+    padded = " " + name + " "
+    return {padded[i : i + n] for i in range(len(padded) - n + 1)}
+
+
+class NgramIndex:
+    """ finds the gazetteer names that share the most n-grams with a name """
+
+    def __init__(self, names):
+        self.names = list(names)
+        self.positions = {name: i for i, name in enumerate(self.names)}
+        postings = defaultdict(list)
+        for i, name in enumerate(self.names):
+            for gram in ngrams(name):
+                postings[gram].append(i)
+        self.postings = {gram: np.array(ids) for gram, ids in postings.items()}
+        self.sizes = np.array([len(ngrams(name)) for name in self.names])
+
+    def candidates(self, name, limit=CANDIDATES):
+        """ the positions of the closest names, by the dice coefficient """
+        grams = ngrams(name)
+        found = [self.postings[gram] for gram in grams if gram in self.postings]
+        if not found:
+            return np.array([], dtype=int)
+        ids, shared = np.unique(np.concatenate(found), return_counts=True)
+        dice = 2 * shared / (self.sizes[ids] + len(grams))
+        return ids[np.argsort(-dice, kind="stable")[:limit]]
+
+
+def name_parts(name):
+    """ the directions, the street type (ex. `ST`) and the rest of a name """
+    tokens = name.split(" ")
+    street_type = None
+    if len(tokens) > 1 and tokens[-1] in STREET_TYPES:
+        street_type, tokens = tokens[-1], tokens[:-1]
+    # `ENTRANCE TO KROGER (S)`
+    directions = frozenset(
+        token.strip("()") for token in tokens if token.strip("()") in DIRECTIONS
+    )
+    core = " ".join(token for token in tokens if token.strip("()") not in DIRECTIONS)
+    return directions, street_type, core
+
+
+def similarity(a, b):
+    return difflib.SequenceMatcher(None, a, b).ratio()
+
+
+def compatible(name, candidate):
+    """
+    names with different numbers, directions or street types are different
+    roads, and the names without directions and types have to be close
+    """
+    if re.findall(r"\d+", name) != re.findall(r"\d+", candidate):
+        return False
+    directions, street_type, core = name_parts(name)
+    other_directions, other_type, other_core = name_parts(candidate)
+    if directions != other_directions:
+        return False
+    # a missing street type can be filled in, but not taken away
+    if street_type and street_type != other_type:
+        return False
+    return similarity(core, other_core) >= MIN_CORE_SCORE
+
+
+def glued_direction(name):
+    """ whether a name starts with a letter that could be a direction """
+    return re.match(r"^[NSEW][A-Z]", name) is not None
+
+
+def spellings(name):
+    """
+    the ways a road name can be read: `S LIBERTY DR.`, `W.17TH ST` and
+    `W17TH ST` are cleaned up, and `EDISCOVERY PKWY` is either
+    `E DISCOVERY PKWY` or a typo of a name that starts with an `E`
+    """
+    cleaned = re.sub(r"^([NSEW])(?=\d)", r"\1 ", re.sub(r"[.,]", " ", name))
+    cleaned = " ".join(cleaned.split())
+    if glued_direction(cleaned):
+        return [cleaned, cleaned[0] + " " + cleaned[1:]]
+    return [cleaned]
+
+
+def best_match(name, index, counts, min_score=MIN_SCORE):
+    """ the gazetteer name for a road name and the confidence, or None """
+    if name in index.positions:
+        return name, 1.0
+    best, best_key = None, (min_score, -1)
+    for spelling in spellings(name):
+        for i in index.candidates(spelling):
+            candidate = index.names[i]
+            if not compatible(spelling, candidate):
+                continue
+            # `EDISCOVERY PKWY` isn't `DISCOVERY PKWY`
+            if glued_direction(spelling) and candidate[:1] != spelling[:1]:
+                continue
+            score = similarity(spelling, candidate)
+            # the more common spelling wins a tie
+            if (score, counts[i]) >= best_key:
+                best, best_key = candidate, (score, counts[i])
+    return (best, round(best_key[0], 3)) if best else None
+
+
+def canonicalize(col, index, counts):
+    """
+    returns the column with every road name that matched replaced by its
+    gazetteer name, and the confidence of every match (nan for no match)
+    """
+    codes, uniques = pd.factorize(col)
+    names = np.array(uniques, dtype=object)
+    confidence = np.full(len(names), np.nan)
+    for i, raw in enumerate(names):
+        match = best_match(normalize_road(raw), index, counts)
+        if match:
+            names[i], confidence[i] = match
+    # code -1 (missing) picks the last entry
+    names = np.append(names, None)
+    confidence = np.append(confidence, np.nan)
+    return (
+        pd.Series(names[codes], index=col.index).where(col.notna(), col),
+        confidence[codes],
+    )
+
+
+def canonicalize_streets(df, gazetteer, index=None):
+    """ canonicalizes the road columns of a df against the gazetteer """
+    # a road named `NA` reads as missing unless `keep_default_na=False`
+    gazetteer = gazetteer[gazetteer["Road"].notna()]
+    index = index or NgramIndex(gazetteer["Road"])
+    counts = gazetteer["Count"].to_numpy()
+    for col in ROAD_COLS:
+        if col in df:
+            df[col], df[CONFIDENCE_COLS[col]] = canonicalize(df[col], index, counts)
+    return df
+
+
+def save_clean_df(cleaned_df, out_file):
+    """ save the cleaned df """
+    write_table(cleaned_df, out_file)
+
+
+if __name__ == "__main__":
+    script_report(sys.argv)
+    if sys.argv[1] == "--build":
+        GAZETTEER = build_gazetteer([load_data(f) for f in sys.argv[2:-1]])
+        write_table(GAZETTEER, sys.argv[-1])
+        print(len(GAZETTEER), "road names saved to", sys.argv[-1])
+    else:
+        GAZETTEER = load_gazetteer(sys.argv[1])
+        INDEX = NgramIndex(GAZETTEER["Road"])
+        for IN_FILE, OUTFILE in zip(sys.argv[2::2], sys.argv[3::2]):
+            DF = canonicalize_streets(load_data(IN_FILE), GAZETTEER, INDEX)
+            save_clean_df(DF, OUTFILE)
+
+            FUZZY = DF[CONFIDENCE_COLS["Roadway Id"]] < 1
+            print(int(FUZZY.sum()), "road names matched by spelling in", IN_FILE)
@@ -0,0 +1,150 @@
+"""
+shared dictionaries for the crash columns that only have a few dozen
+different values (ex. `Weather Conditions`).
+
+instead of millions of separate strings, these columns are loaded as pandas
+categoricals: one small int code per row, and each value stored once. every
+step loads them through `crash_schema.read_table`, which uses the same
+dictionary for every file, so a code means the same value in every file and
+every step, and filters, groupbys and joins on these columns work on the
+codes. the geojson, binary and chart exports encode the values from the
+same dictionaries.
+
+the dictionaries are saved in `data/categories.json`:
+    {"version": 3, "columns": {"Agency": ["BLOOMINGTON PD", ...], ...}}
+a value's code is its position in its list. new values are only ever added
+to the end, and the version goes up every time, so codes that were already
+given out never change. a value that isn't in the file yet still loads: it
+gets the next free code for that run. to add the new values of a file to
+the saved dictionaries:
+    python categories.py "../../data/clean-data/master-crashes.csv"
+"""
+
+import os
+import sys
+import json
+
+import pandas as pd
+
+# the low-cardinality columns
+CATEGORY_COLS = [
+    "Agency",
+    "Primary Factor",
+    "Manner of Collision",
+    "Weather Conditions",
+    "Light Condition",
+    "Surface Condition",
+    "Roadway Class",
+    "Roadway Junction Type",
+    "Road Character",
+    "Roadway Surface",
+    "Locality",
+    "Damage Estimate",
+]
+
+# next to the data, wherever the scripts are run from
+CATEGORIES_FILE = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "..", "..", "data", "categories.json"
+)
+
+# loaded the first time they are needed
+LOADED = {}
+
+
+def load_categories(path=CATEGORIES_FILE):
+    """ the saved dictionaries, or empty ones if there's no file yet """
+    if path not in LOADED:
+        if os.path.exists(path):
+            with open(path) as f:
+                LOADED[path] = json.load(f)
+        else:
+            LOADED[path] = {"version": 0, "columns": {}}
+    return LOADED[path]
+
+
+def save_categories(categories, path=CATEGORIES_FILE):
+    """ saves the dictionaries as the next version """
+    categories["version"] = categories.get("version", 0) + 1
+    with open(path, "w") as f:
+        json.dump(categories, f, indent=2)
+        f.write("\n")
+    LOADED[path] = categories
+
+
+def new_values(values, known):
+    """ the values that aren't in the dictionary yet, sorted """
+    known = set(known)
+    return sorted(str(value) for value in set(values) - known if pd.notna(value))
+
+
+def to_categorical(col, values):
+    """
+    the column as a categorical with the dictionary's codes. values that
+    aren't in the dictionary are added after it
+    """
+    is_text = isinstance(col.dtype, pd.CategoricalDtype) and (
+        pd.api.types.is_string_dtype(col.cat.categories)
+    )
+    if not is_text:
+        col = col.astype("string").astype("category")
+    return col.cat.set_categories(list(values) + new_values(col.cat.categories, values))
+
+
+def apply_categories(df, categories=None):
+    """ converts the category columns of a df, in place, and returns it """
+    categories = categories or load_categories()
+    for name in CATEGORY_COLS:
+        if name in df:
+            df[name] = to_categorical(df[name], categories["columns"].get(name, []))
+    return df
+
+
+def category_codes(col):
+    """
+    integer codes for a column, and the values they stand for, in sorted
+    order. missing values are coded as "". categoricals reuse their codes
+    instead of hashing every value again
+    """
+    if not isinstance(col.dtype, pd.CategoricalDtype):
+        return pd.factorize(col.fillna(""), sort=True)
+    values = list(col.cat.categories)
+    if "" not in values:
+        values.append("")
+    values = pd.Index(values)
+    order = values.argsort()
+    rank = order.argsort()
+    codes = col.cat.codes.to_numpy().astype("int64")
+    codes[codes < 0] = values.get_loc("")
+    return rank[codes], values[order]
+
+
+def update_categories(categories, df):
+    """
+    adds the new values of a df to the end of the dictionaries. returns
+    whether anything was added
+    """
+    columns = categories.setdefault("columns", {})
+    changed = False
+    for name in CATEGORY_COLS:
+        if name in df:
+            known = columns.setdefault(name, [])
+            extra = new_values(df[name].unique(), known)
+            known += extra
+            changed |= bool(extra)
+    return changed
+
+
+if __name__ == "__main__":
+    # read as text, so every value shows up as it is in the file
+    from crash_schema import read_table
+
+    CATEGORIES = load_categories()
+    CHANGED = False
+    for IN_FILE in sys.argv[1:]:
+        CHANGED |= update_categories(CATEGORIES, read_table(IN_FILE, dtype=str))
+
+    if CHANGED:
+        save_categories(CATEGORIES)
+        print("categories updated to version", CATEGORIES["version"])
+    else:
+        print("no new values, categories are still version", CATEGORIES["version"])
@@ -10,16 +10,21 @@ import sys
 import pandas as pd
 import numpy as np
 import re
+from collections import Counter
 
+# parquet or csv, depending on the file name
+from crash_schema import read_table, write_table
 
-def load_data(crash_file):
-    """ returns a pandas dataframe of the raw dataset. """
-    return pd.read_csv(crash_file, encoding="unicode_escape")
+# many files at once, in a pool of processes
+from parallel_files import parse_files, file_pairs, run_files
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
 
 
-def replace_str(df, str1, str2):
-    """replace string 1 with string 2 in a given df"""
-    return df.replace(to_replace=str1, value=str2, regex=True)
+def load_data(crash_file):
+    """ returns a pandas dataframe of the raw dataset. """
+    return read_table(crash_file, encoding="unicode_escape")
 
 
 # identify strings to manually replace
@@ -105,6 +110,44 @@ strs_to_replace = [
     ["DRR", "DRIVER"],
 ]
 
+# the only columns the replacement rules should touch
+address_cols = ["Roadway Id", "Intersecting Road"]
+
+# compile every rule once. the rules are applied in order, because later
+# rules depend on earlier ones (ex. `SOUTH ` -> `S ` before `S I-69` -> `I-69 S`)
+compiled_rules = [(re.compile(pattern), value) for pattern, value in strs_to_replace]
+
+
+def apply_rules(road, hits):
+    """runs a single road name through every rule, counting which rules fired"""
+    for i, (pattern, value) in enumerate(compiled_rules):
+        road, n = pattern.subn(value, road)
+        hits[i] += n
+    return road
+
+
+def replace_strs(col):
+    """
+    applies the ordered rule table to a column in one pass. each unique road
+    name only goes through the rules once, then the results are mapped back
+    to every row. returns the new column and how many times each rule fired.
+    """
+    codes, uniques = pd.factorize(col)
+    uniques = np.asarray(uniques, dtype=object)
+    # number of rows that share each unique road name
+    row_counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+
+    rule_counts = np.zeros(len(compiled_rules), dtype=np.int64)
+    for j, road in enumerate(uniques):
+        if isinstance(road, str):
+            hits = np.zeros(len(compiled_rules), dtype=np.int64)
+            uniques[j] = apply_rules(road, hits)
+            rule_counts += hits * row_counts[j]
+
+    cleaned = pd.Series(uniques.take(codes), index=col.index, dtype=object)
+    cleaned[codes < 0] = np.nan
+    return cleaned, rule_counts
+
 
 def extract_house_nums(road):
     """extract the `101` from `101 E 2ND ST` and create a new column"""
@@ -149,10 +192,18 @@ def remove_colons(road):
     return road
 
 
-def clean_addresses(df):
+def clean_addresses(df, rule_counts=None):
+    """
+    standardizes the road names. if a `Counter` is passed as `rule_counts`,
+    it is updated with the number of times each rule fired.
+    """
     df["Roadway Id"] = df["Roadway Id"].fillna("")
-    for string in strs_to_replace:
-        df = replace_str(df, string[0], string[1])
+    for col in address_cols:
+        if col in df:
+            df[col], counts = replace_strs(df[col])
+            if rule_counts is not None:
+                for (pattern, value), n in zip(strs_to_replace, counts):
+                    rule_counts[pattern] += int(n)
     df["Address Number"] = df["Roadway Id"].apply(extract_house_nums)
     df["Roadway Id"] = df["Roadway Id"].apply(remove_house_nums)
     df["Roadway Id"] = df["Roadway Id"].apply(remove_colons)
@@ -160,17 +211,34 @@ def clean_addresses(df):
     return df
 
 
+def print_rule_counts(rule_counts):
+    """prints how often each replacement rule fired, most common first"""
+    for pattern, n in rule_counts.most_common():
+        if n:
+            print(f"{n:>8}  {pattern}")
+
+
 def save_clean_df(cleaned_df, out_file):
     """ save the cleaned df """
-    cleaned_df.to_csv(out_file, index=False)
+    write_table(cleaned_df, out_file)
+
+
+def clean_file(in_file, out_file):
+    """ cleans one file, and returns how often each rule fired """
+    rule_counts = Counter()
+    save_clean_df(clean_addresses(load_data(in_file), rule_counts), out_file)
+    return rule_counts
 
 
 if __name__ == "__main__":
+    script_report(sys.argv)
 
-    DF = load_data(sys.argv[1])
-    OUTFILE = sys.argv[2]
+    FILES, WORKERS = parse_files(sys.argv[1:], "standardize the road names")
+    PAIRS = file_pairs(FILES)
 
-    CLEAN_DF = clean_addresses(DF)
-    save_clean_df(CLEAN_DF, OUTFILE)
+    # the rules are compiled once per worker, when it imports this script
+    RULE_COUNTS = sum(run_files(clean_file, PAIRS, WORKERS), Counter())
 
-    print("addresses have been cleaned for", sys.argv[1])
+    print_rule_counts(RULE_COUNTS)
+    for IN_FILE, _ in PAIRS:
+        print("addresses have been cleaned for", IN_FILE)
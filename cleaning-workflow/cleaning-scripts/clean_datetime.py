@@ -1,65 +1,143 @@
 """ 
 this script cleans the date/time for crash data from 2016 - 2022
 given two columns `Collision Date` and `Collision Time`, it returns
-one column called `DateTime`
+one column called `DateTime`. crashes without a readable time are put at
+midnight, and marked in the `Time Defaulted` column, so they can be told
+apart from crashes that really happened at 00:00
 
 """
 import sys
 
+import numpy as np
 import pandas as pd
-from datetime import date, time
+from collections import Counter
+
+# parquet or csv, depending on the file name
+from crash_schema import read_table, write_table
+
+# minutes since midnight, added to the older files by `clean_times.py`
+from clean_times import MINUTES_COL
+
+# a stable id for every record, to find it again in later extracts
+from record_ids import add_record_ids
+
+# many files at once, in a pool of processes
+from parallel_files import parse_files, file_pairs, run_files
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
+
+# formats seen in the source files, tried in order. anything that doesn't
+# match one of these falls back to pandas' own guess
+DATE_FORMATS = ["%m/%d/%y", "%m/%d/%Y", "%Y-%m-%dT%H:%M:%S", "%Y-%m-%d"]
+TIME_FORMATS = ["%I:%M %p", "%H:%M:%S", "%H:%M"]
+
+# True where the time was missing or unreadable, and set to midnight
+TIME_DEFAULTED = "Time Defaulted"
 
 
 def load_data(in_file):
     """ returns a pandas dataframe of the raw dataset. """
-    return pd.read_csv(in_file)
-
+    return read_table(in_file)
 
-# given a date string (`Collision Date` field) and a time string (`Collision Time` field),,,
-def get_datetime(date_string, time_string):
-    # combine the date and time into one `datetime` object
-    date_val = date(
-        pd.to_datetime(date_string).year,
-        pd.to_datetime(date_string).month,
-        pd.to_datetime(date_string).day,
-    )
-    if time_string:
-        # if the time string is `NaN`, set it to midnight
-        try:
-            time_val = time(
-                pd.to_datetime(time_string).hour, pd.to_datetime(time_string).minute
-            )
-        except:
-            time_val = time(0, 0, 0)
 
-    return pd.Timestamp.combine(date_val, time_val)
+def in_range(times):
+    """
+    the times as datetime64[ns]. times outside of its range (ex. `0317`,
+    read as the year 317) can't be stored and become `NaT`.
+    """
+    times = pd.DatetimeIndex(times)
+    fits = (times >= pd.Timestamp.min) & (times <= pd.Timestamp.max)
+    return times.where(fits).as_unit("ns")
 
 
-def clean_date_time(df, date_column, time_column):
-    df["DateTime"] = df.apply(
-        lambda row: get_datetime(row[date_column], row[time_column]), axis=1
-    )
-    df = df.drop(columns=[date_column, time_column])
+def parse_unique(col, formats):
+    """
+    parses each unique string in a column once and maps the results back to
+    every row. values that can't be parsed become `NaT`.
+    """
+    codes, uniques = pd.factorize(col)
+    uniques = pd.Index(uniques.astype(str))
+    parsed = pd.Series(pd.NaT, index=uniques, dtype="datetime64[ns]")
+    for fmt in formats:
+        todo = parsed.isna().to_numpy()
+        if not todo.any():
+            break
+        parsed[todo] = in_range(
+            pd.to_datetime(uniques[todo], format=fmt, errors="coerce")
+        )
+    for value in uniques[parsed.isna().to_numpy()]:
+        parsed[value] = in_range([pd.to_datetime(value, errors="coerce")])[0]
+
+    values = parsed.to_numpy().take(codes)
+    values[codes < 0] = np.datetime64("NaT")
+    return pd.Series(values, index=col.index)
+
+
+def clean_date_time(df, date_column, time_column, problems=None):
+    """
+    combines the date and time columns into one `DateTime` column.
+    if the df has a `Collision Minutes` column, it's used instead of parsing
+    the time strings. missing or unreadable times are set to midnight, and
+    those rows are True in `Time Defaulted`. if a `Counter` is passed
+    as `problems`, it is updated with the number of rows with a missing
+    time, an unreadable time or an unreadable date (which become `NaT`).
+    """
+    dates = parse_unique(df[date_column], DATE_FORMATS).dt.normalize()
+    if MINUTES_COL in df:
+        # the times have already been parsed, no need to read the strings
+        minutes = pd.to_timedelta(df[MINUTES_COL].astype(float), unit="min")
+        unreadable = minutes.isna() & df[time_column].notna()
+    else:
+        times = parse_unique(df[time_column], TIME_FORMATS)
+        minutes = (times - times.dt.normalize()).dt.floor("min")
+        unreadable = times.isna() & df[time_column].notna()
+
+    df["DateTime"] = dates + minutes.fillna(pd.Timedelta(0))
+    df[TIME_DEFAULTED] = minutes.isna().to_numpy()
+
+    if problems is not None:
+        problems["missing time"] += int(df[time_column].isna().sum())
+        problems["unreadable time"] += int(unreadable.sum())
+        problems["unreadable date"] += int(dates.isna().sum())
+
+    df = df.drop(columns=[date_column, time_column, MINUTES_COL], errors="ignore")
     return df
 
 
 def save_clean_df(cleaned_df, out_file):
     """ save the cleaned df """
-    cleaned_df.to_csv(out_file, index=False)
+    write_table(cleaned_df, out_file)
+
+
+def clean_file(in_file, out_file):
+    """ cleans one file, and returns how many rows had each problem """
+    problems = Counter()
+    clean_df = clean_date_time(
+        add_record_ids(load_data(in_file)), "Collision Date", "Collision Time", problems
+    )
+    save_clean_df(clean_df, out_file)
+    return problems
 
 
 if __name__ == "__main__":
+    script_report(sys.argv)
     # DF = load_data("./source-data/moco-crash-2022.csv")
-    DF = load_data(sys.argv[1])
-    OUTFILE = sys.argv[2]
-
-    CLEAN_DF = clean_date_time(DF, "Collision Date", "Collision Time")
-    save_clean_df(CLEAN_DF, OUTFILE)
+    FILES, WORKERS = parse_files(sys.argv[1:], "clean the dates/times of crash files")
+    PAIRS = file_pairs(FILES)
 
-    print("dates/times cleaned for", sys.argv[1])
+    for (IN_FILE, _), PROBLEMS in zip(PAIRS, run_files(clean_file, PAIRS, WORKERS)):
+        for PROBLEM, COUNT in PROBLEMS.items():
+            if COUNT:
+                print(COUNT, "rows with a", PROBLEM)
+        print("dates/times cleaned for", IN_FILE)
 
     """
     run this command in the terminal: 
 
     python clean_datetime.py "file-to-clean" "output-file"
+
+    more files can be cleaned at once, in parallel:
+
+    python clean_datetime.py "file-1" "output-1" "file-2" "output-2" --workers 4
     """
@@ -6,76 +6,115 @@ columns for the `clean_datetime.py` script
 """
 import sys 
 
+import numpy as np
 import pandas as pd
-from datetime import time
-import re
+from collections import Counter
+
+# parquet or csv, depending on the file name
+from crash_schema import read_table, write_table
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
+
+# every stage after this one can use this column instead of re-parsing times
+MINUTES_COL = "Collision Minutes"
+
+MILITARY_TIME = r"^(\d{1,2})(\d{2})$"
+CLOCK_TIME = r"(\d{1,2}):(\d{2}) ([AP])M"
+
 
 def load_data(in_file):
     """ returns a pandas dataframe of the raw dataset. """
-    return pd.read_csv(in_file)
-
-def clean_times_1318(Time):
-    # Search for 3- or 4-digit times
-    # these are in military time. so need to be converted to regular time to match the rest.
-    if re.search('\d{3,4}', Time):
-        
-        # ex 1230, 1024
-        if len(Time) == 4:
-            if int(Time[0:2])>12:
-                return str(int(Time[0:2]) - 12) + ":" + Time[2:4] + " PM"
-            elif Time[0:2] == '12':
-                return Time[0:2] + ":" + Time[2:4] + " PM"
-            else:
-                return Time[0:2] + ":" + Time[2:4] + " AM"
-            
-        # ex 130, 930, 725
-        if len(Time) == 3:
-            if Time[0:1] == '0':
-                return "12:" + Time[1:3] + " AM"
-            else:
-                return Time[0:1] + ":" + Time[1:3] + " AM" 
-        return Time
-    else:
-        # if clean up not needed, return the same name
-        return Time
-
-# remove all times with one or two digit numbers 
-def find_wrong_times_1318(Time):
-    if not re.search('\d{1,2}:\d{2} [A,P]M', Time):
-        return float('NaN')
-    else:
-        return Time
-    
-def clean_1318(df, time_col):
-    df[time_col] = df[time_col].apply(clean_times_1318)
-    df[time_col] = df[time_col].apply(find_wrong_times_1318)
-    return df
+    return read_table(in_file)
+
+def military_minutes(times):
+    """
+    3- or 4-digit military times -> minutes since midnight.
+    `930` is 9:30 AM, `1745` is 5:45 PM. anything else is `NaN`.
+    """
+    parts = times.str.strip().str.extract(MILITARY_TIME).astype(float)
+    return parts[0] * 60 + parts[1].where(parts[1] < 60)
+
+def clock_minutes(times):
+    """ `H:MM AM/PM` times -> minutes since midnight. anything else is `NaN` """
+    parts = times.str.extract(CLOCK_TIME)
+    hours = parts[0].astype(float)
+    minutes = parts[1].astype(float).where(lambda m: m < 60)
+    hours = hours.where((hours >= 1) & (hours <= 12)) % 12
+    pm = (parts[2] == "P").astype(float)
+    return (hours + 12 * pm) * 60 + minutes
+
+def minutes_to_clock(minutes):
+    """ minutes since midnight -> `H:MM AM/PM` strings, `NaN` stays `NaN` """
+    valid = minutes.notna()
+    hours, mins = np.divmod(minutes[valid].astype(int), 60)
+    clock = (
+        ((hours + 11) % 12 + 1).astype(str)
+        + ":"
+        + mins.astype(str).str.zfill(2)
+        + np.where(hours < 12, " AM", " PM")
+    )
+    return clock.reindex(minutes.index)
 
-def clean_time_0315(hour_string):
-    # test if float exists
-    if hour_string == hour_string:
-        return str(time(int(hour_string / 100)))
+def time_minutes(times, problems=None):
+    """
+    normalizes the 2013-2018 `TIME` values to minutes since midnight in one
+    pass. values that aren't 3- or 4-digit military times or `H:MM AM/PM`
+    times, or are out of range, become `NaN`. if a `Counter` is passed as
+    `problems`, it is updated with the number of missing and invalid times.
+    """
+    times = times.astype("string")
+    minutes = military_minutes(times)
+    minutes = minutes.where(minutes < 24 * 60)
+    minutes = minutes.fillna(clock_minutes(times))
+    if problems is not None:
+        problems["missing time"] += int(times.isna().sum())
+        problems["invalid time"] += int((minutes.isna() & times.notna()).sum())
+    return minutes.astype("Int64")
 
-def clean_0315(df):
+def hour_minutes(hours, problems=None):
+    """ the 2003-2015 `Hour` values (ex. `1500.0`) -> minutes since midnight """
+    minutes = (hours // 100 * 60).where((hours >= 0) & (hours < 2400))
+    if problems is not None:
+        problems["missing time"] += int(hours.isna().sum())
+        problems["invalid time"] += int((minutes.isna() & hours.notna()).sum())
+    return minutes.astype("Int64")
+
+def clean_1318(df, time_col, problems=None):
+    df[MINUTES_COL] = time_minutes(df[time_col], problems)
+    df[time_col] = minutes_to_clock(df[MINUTES_COL])
+    return df
+
+def clean_0315(df, problems=None):
     df['Collision Date'] = pd.to_datetime(df[['Year', 'Month', 'Day']])
-    df['Collision Time'] = df['Hour'].apply(clean_time_0315)
+    df[MINUTES_COL] = hour_minutes(df['Hour'], problems)
+    # ex. `18:00:00`
+    df['Collision Time'] = (
+        (df[MINUTES_COL] // 60).astype("string").str.zfill(2) + ":00:00"
+    )
     return df.drop(columns=['Year','Month','Day','Hour','Weekend?'])
 
 def save_clean_df(cleaned_df, out_file):
     ''' save the cleaned df '''
-    cleaned_df.to_csv(out_file, index=False)
+    write_table(cleaned_df, out_file)
 
 if __name__ == "__main__":
+    script_report(sys.argv)
     DF_13_18 = load_data(sys.argv[1])
     DF_03_15 = load_data(sys.argv[2])
     OUTFILE1 = sys.argv[3]
     OUTFILE2 = sys.argv[4]
 
-    CLEAN_DF1 = clean_1318(DF_13_18, 'Collision Time')
-    CLEAN_DF2 = clean_0315(DF_03_15)
+    PROBLEMS_1318 = Counter()
+    PROBLEMS_0315 = Counter()
+    CLEAN_DF1 = clean_1318(DF_13_18, 'Collision Time', PROBLEMS_1318)
+    CLEAN_DF2 = clean_0315(DF_03_15, PROBLEMS_0315)
     save_clean_df(CLEAN_DF1,OUTFILE1)
     save_clean_df(CLEAN_DF2,OUTFILE2)
 
+    print("2013-2018 times:", dict(PROBLEMS_1318))
+    print("2003-2015 times:", dict(PROBLEMS_0315))
+
     """
     run this command in the terminal: 
     
@@ -0,0 +1,454 @@
+"""
+the declared column types for crash records, and helpers to read and write
+them in a typed columnar format between cleaning steps.
+
+every step can read and write parquet instead of csv: just give it file names
+ending in `.parquet`. parquet files keep their column types, so later steps
+don't have to guess them again (or re-parse `DateTime` from text), and they
+are much faster to read and write. csv is still the format for the published
+files in `data/clean-data`.
+
+csvs are read with their declared types too: text columns are read as
+text without guessing their types, the low-cardinality ones (ex. `Weather
+Conditions`) as categoricals with the shared dictionaries in `categories.py`,
+and the typed columns are converted after they're parsed. a caller that
+passes its own `dtype` gets exactly that instead.
+
+this is also the registry of the columns each source layout has to have
+(`SOURCE_COLUMNS`), of how they're renamed to the 2019-2022 column names
+(`SOURCE_RENAMES`), and of the columns each stage that doesn't write its
+input back out reads (`STAGE_COLUMNS`). those stages load files with
+`read_stage`, so only their columns are parsed.
+
+parquet needs the `pyarrow` package:
+    pip install pyarrow
+"""
+
+import os
+
+import pandas as pd
+
+# one shared dictionary for each low-cardinality column
+from categories import CATEGORY_COLS, apply_categories
+
+# the loads and saves of a standalone script run with `--report`
+from run_report import record
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    # only needed for parquet files
+    pa = pq = None
+
+# columns that aren't listed here are stored as text in parquet files
+CRASH_SCHEMA = {
+    "Vehicles Involved": "Int64",
+    "Trailers Involved": "Int64",
+    "Number Injured": "Int64",
+    "Number Dead": "Int64",
+    "Number Deer": "Int64",
+    "State Property Damage?": "Int64",
+    "Feet From": "float64",
+    "Mile Marker": "float64",
+    "Latitude": "float64",
+    "Longitude": "float64",
+    "Collision Minutes": "Int64",
+    "DateTime": "datetime64[ns]",
+    "Cyclist Involved": "boolean",
+    "Pedestrian Involved": "boolean",
+    "Time Defaulted": "boolean",
+    "Cyclist Match Confidence": "float64",
+    "Pedestrian Match Confidence": "float64",
+    "Address Number": "float64",
+    # the date and hour of the 2003-2015 layout
+    "Year": "Int64",
+    "Month": "Int64",
+    "Day": "Int64",
+    "Hour": "float64",
+}
+
+# the crash columns that are read from csvs as text, without guessing their
+# types (ex. `House Number` and `Local Code` stay as they were written).
+# columns that are in neither list (ex. the counts of the chart cube) get the
+# types pandas guesses
+TEXT_COLUMNS = [
+    "Record Id",
+    "Master Record Number",
+    "Agency",
+    "Local Code",
+    "County",
+    "Township",
+    "City",
+    "Collision Date",
+    "Collision Time",
+    "House Number",
+    "Roadway Name",
+    "Roadway Suffix",
+    "Roadway Number",
+    "Roadway Interchange",
+    "Roadway Ramp",
+    "Roadway Id",
+    "Intersecting Road",
+    "Intersecting Road Number",
+    "Interchange",
+    "Corporate Limits?",
+    "Property Type",
+    "Direction",
+    "Roadway Class",
+    "Traffic Control Devices?",
+    "Aggressive Driving?",
+    "Hit and Run?",
+    "Locality",
+    "School Zone?",
+    "Rumble Strips?",
+    "Construction?",
+    "Construction Type",
+    "Light Condition",
+    "Weather Conditions",
+    "Surface Condition",
+    "Type of Median",
+    "Roadway Junction Type",
+    "Road Character",
+    "Roadway Surface",
+    "Primary Factor",
+    "Damage Estimate",
+    "Manner of Collision",
+    "Unique Location Id",
+    "Traffic Control",
+    "Injury Type",
+    "Reported_Location",
+    "Weekend?",
+]
+
+# the columns the cleaning scripts use from each source layout, by the names
+# in the source files. the files can have more. the bike/ped extracts from
+# the city have the 2019-2022 layout
+SOURCE_COLUMNS = {
+    "2019-2022": [
+        "Collision Date",
+        "Collision Time",
+        "Vehicles Involved",
+        "Number Injured",
+        "Number Dead",
+        "House Number",
+        "Roadway Id",
+        "Intersecting Road",
+        "Latitude",
+        "Longitude",
+        "Primary Factor",
+        "Manner of Collision",
+    ],
+    "2013-2018": [
+        "DATE",
+        "TIME",
+        "VEH#",
+        "INJ",
+        "DEAD",
+        "House#",
+        "Roadway Id",
+        "Intersect Rd.",
+        "Latitude",
+        "Longitude",
+        "Primary Factor",
+        "Collision Type",
+    ],
+    "2003-2015": [
+        "Year",
+        "Month",
+        "Day",
+        "Hour",
+        "Collision Type",
+        "Injury Type",
+        "Primary Factor",
+        "Reported_Location",
+        "Latitude",
+        "Longitude",
+    ],
+}
+
+# how the columns of each source layout are renamed to the 2019-2022 names.
+# the bike/ped extracts from the city have the 2019-2022 layout
+SOURCE_RENAMES = {
+    "2019-2022": {},
+    "2013-2018": {
+        "DATE": "Collision Date",
+        "TIME": "Collision Time",
+        "Trailers": "Trailers Involved",
+        "INJ": "Number Injured",
+        "DEAD": "Number Dead",
+        "DEER": "Number Deer",
+        "House#": "House Number",
+        "VEH#": "Vehicles Involved",
+        "Surf Con": "Surface Condition",
+        "Collision Type": "Manner of Collision",
+        "Rd Junction": "Roadway Junction Type",
+        "Weather": "Weather Conditions",
+        "Road Char": "Road Character",
+        "Surface": "Roadway Surface",
+        "CN Zone": "Construction?",
+        "Unique Id": "Unique Location Id",
+        "Intersect Rd.": "Intersecting Road",
+    },
+    "2003-2015": {"Collision Type": "Vehicles Involved"},
+}
+
+# the columns of the older layouts by their old names (ex. `INJ`), so they're
+# read with the same types. a name that is a different column in another
+# layout (`Collision Type`) isn't in here
+OLD_NAMES = {
+    old: new
+    for renames in SOURCE_RENAMES.values()
+    for old, new in renames.items()
+    if all(other.get(old, new) == new for other in SOURCE_RENAMES.values())
+}
+
+# the columns each stage reads, by their 2019-2022 names. the stages that
+# aren't listed write every column back out, so they read all of them
+STAGE_COLUMNS = {
+    # the bike/ped reports are only matched by time and place
+    "bike_ped_reports": ["DateTime", "Latitude", "Longitude"],
+    "geocode_store": [
+        "DateTime",
+        "Roadway Id",
+        "Intersecting Road",
+        "Latitude",
+        "Longitude",
+    ],
+    "intersection_index": ["Roadway Id", "Intersecting Road", "Latitude", "Longitude"],
+    "charts": [
+        "DateTime",
+        "Number Dead",
+        "Number Injured",
+        "Cyclist Involved",
+        "Pedestrian Involved",
+        "Primary Factor",
+    ],
+    # the map layers: the coordinates and the properties of each crash
+    "map": [
+        "Latitude",
+        "Longitude",
+        "Vehicles Involved",
+        "Number Injured",
+        "Number Dead",
+        "Roadway Id",
+        "Intersecting Road",
+        "Primary Factor",
+        "Manner of Collision",
+        "DateTime",
+        "Cyclist Involved",
+        "Pedestrian Involved",
+    ],
+    # crashes are clustered by place, then counted by year and severity
+    "hotspots": [
+        "Record Id",
+        "Latitude",
+        "Longitude",
+        "DateTime",
+        "Number Injured",
+        "Number Dead",
+        "Roadway Id",
+        "Intersecting Road",
+        "Cyclist Involved",
+        "Pedestrian Involved",
+    ],
+}
+
+PARQUET_EXTENSIONS = (".parquet", ".pq")
+
+BOOLEAN_VALUES = {"True": True, "False": False, "true": True, "false": False}
+
+
+def is_parquet(path):
+    return str(path).lower().endswith(PARQUET_EXTENSIONS)
+
+
+def to_type(col, dtype):
+    """
+    converts one column to its declared type. a column that can't be
+    converted without losing values (ex. `Vehicles Involved` is `1-Car` in
+    the 2003-2015 data) is stored as text instead.
+    """
+    if dtype == "boolean":
+        converted = col.map(lambda x: BOOLEAN_VALUES.get(x, x)).astype("boolean")
+    elif dtype.startswith("datetime"):
+        converted = pd.to_datetime(col, errors="coerce").astype(dtype)
+    else:
+        converted = pd.to_numeric(col, errors="coerce")
+        if dtype == "Int64" and (converted.dropna() % 1 != 0).any():
+            return col.astype("string")
+        converted = converted.astype(dtype)
+    if converted.notna().sum() < col.notna().sum():
+        return col.astype("string")
+    return converted
+
+
+def declared_type(name):
+    """ the declared type of a column, or None if it isn't a typed column """
+    return CRASH_SCHEMA.get(OLD_NAMES.get(name, name))
+
+
+def csv_dtypes(columns):
+    """
+    `read_csv` types for a file's columns: the category columns are parsed
+    straight to codes, and the other text columns as text. the typed columns
+    aren't listed, they're parsed by pandas and converted with `to_type` after
+    """
+    dtypes = {}
+    for col in columns:
+        if col in CATEGORY_COLS:
+            dtypes[col] = "category"
+        elif OLD_NAMES.get(col, col) in TEXT_COLUMNS:
+            dtypes[col] = str
+    return dtypes
+
+
+def convert_types(df):
+    """ converts the typed columns of a csv that was just read, in place """
+    for col in df.columns:
+        if declared_type(col) is not None:
+            df[col] = to_type(df[col], declared_type(col))
+    return apply_categories(df)
+
+
+def check_layout(df, layout, name):
+    """ raises a ValueError if a source file is missing columns of its layout """
+    missing = [col for col in SOURCE_COLUMNS[layout] if col not in df]
+    if missing:
+        raise ValueError(
+            "%s doesn't have the %s columns %s" % (name, layout, ", ".join(missing))
+        )
+    return df
+
+
+def apply_schema(df):
+    """ returns a copy of the df with every column in its declared type """
+    return df.apply(
+        lambda col: to_type(col, CRASH_SCHEMA[col.name])
+        if col.name in CRASH_SCHEMA
+        else col.astype("string")
+    )
+
+
+def read_table(path, **csv_options):
+    """
+    reads a parquet file, or a csv with the given `read_csv` options.
+    `usecols` is passed on as `columns` for parquet.
+    """
+    # a step of the script's `--report`, if it was given one
+    return record(os.path.basename(path), "load", read_file, path, csv_options)
+
+
+def read_file(path, csv_options):
+    if is_parquet(path):
+        df = pd.read_parquet(path, columns=csv_options.get("usecols"))
+        return df if "dtype" in csv_options else apply_categories(df)
+    if "dtype" in csv_options:
+        return pd.read_csv(path, **csv_options)
+    dtype = csv_dtypes(read_columns(path, **csv_options))
+    return convert_types(pd.read_csv(path, dtype=dtype, **csv_options))
+
+
+def write_table(df, path):
+    """ writes a parquet file with the declared types, or a csv """
+    record(os.path.basename(path), "save", write_file, df, path)
+
+
+def write_file(df, path):
+    if is_parquet(path):
+        apply_schema(df).to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def read_columns(path, **csv_options):
+    """ returns the column names of a file without reading its rows """
+    if is_parquet(path):
+        return list(pq.read_schema(path).names)
+    return list(pd.read_csv(path, nrows=0, **csv_options).columns)
+
+
+def stage_columns(path, stage):
+    """ the columns of a file that a stage reads, in the file's order """
+    needed = set(STAGE_COLUMNS[stage])
+    return [col for col in read_columns(path) if col in needed]
+
+
+def read_stage(path, stage, **csv_options):
+    """ reads only the columns of a file that a stage uses """
+    return read_table(path, usecols=stage_columns(path, stage), **csv_options)
+
+
+def read_chunks(path, chunk_size, **csv_options):
+    """
+    yields a file as dataframes of at most `chunk_size` rows, so it never has
+    to be in memory all at once. `usecols` is passed on as `columns` for parquet.
+    """
+    if is_parquet(path):
+        batches = pq.ParquetFile(path).iter_batches(
+            batch_size=chunk_size, columns=csv_options.get("usecols")
+        )
+        for batch in batches:
+            chunk = batch.to_pandas()
+            yield chunk if "dtype" in csv_options else apply_categories(chunk)
+    elif "dtype" in csv_options:
+        yield from pd.read_csv(path, chunksize=chunk_size, **csv_options)
+    else:
+        dtype = csv_dtypes(read_columns(path, **csv_options))
+        chunks = pd.read_csv(path, chunksize=chunk_size, dtype=dtype, **csv_options)
+        for chunk in chunks:
+            yield convert_types(chunk)
+
+
+class TableWriter:
+    """
+    writes a parquet file or a csv one chunk at a time. every chunk is
+    reindexed to `columns`, and parquet chunks are cast to the types of the
+    first chunk.
+    """
+
+    def __init__(self, path, columns):
+        self.path = path
+        self.columns = list(columns)
+        self.writer = None
+        self.rows = 0
+
+    def write(self, df):
+        df = df.reindex(columns=self.columns)
+        if is_parquet(self.path):
+            table = pa.Table.from_pandas(apply_schema(df), preserve_index=False)
+            if self.writer is None:
+                self.writer = pq.ParquetWriter(self.path, table.schema)
+            self.writer.write_table(table.cast(self.writer.schema))
+        else:
+            df.to_csv(
+                self.path,
+                mode="a" if self.rows else "w",
+                header=not self.rows,
+                index=False,
+            )
+        self.rows += len(df)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        elif not self.rows and not is_parquet(self.path):
+            # still write the header if there were no rows at all
+            pd.DataFrame(columns=self.columns).to_csv(self.path, index=False)
+
+
+def append_table(df, path):
+    """
+    adds rows to the end of an existing file, in the file's column order.
+    csvs are appended to in place, parquet files are read and rewritten
+    """
+    columns = read_columns(path)
+    if is_parquet(path):
+        write_table(pd.concat([read_table(path), df.reindex(columns=columns)]), path)
+    else:
+        df.reindex(columns=columns).to_csv(path, mode="a", header=False, index=False)
+
+
+def with_extension(path, extension):
+    """ `moco-crash-2022.csv`, `.parquet` -> `moco-crash-2022.parquet` """
+    return os.path.splitext(path)[0] + extension
@@ -0,0 +1,352 @@
+"""
+this script adds a new extract of one yearly file (ex. this month's
+`moco-crash-2023.csv` from the city's open data portal) to the clean data,
+without rerunning the pipeline for the records that haven't changed.
+
+every record has a stable `Record Id` (see `record_ids.py`), and a hash of
+each record's values is saved in `data/cleaning-process/delta/<name>.csv`
+after every run. a new extract is compared with those hashes, and only the
+records that are new or changed go through
+clean_datetime -> clean_addresses -> (canonicalize_streets) -> (geocode) ->
+merge_bike_ped.
+they are then merged, by Record Id, into:
+    - the clean yearly file, `data/clean-data/<name>-clean.csv`
+    - the master file
+    - the jittered master file. only the new and changed crashes are
+      jittered, after the crashes already at the same spot, so points that
+      are already published don't move. the master file is read a chunk
+      at a time, and only the crashes at those spots are kept
+    - the three geojson layers
+    - the chart cube: the old versions of the changed and removed records
+      (from the clean file) are taken out of it, and the new ones added
+    - the hotspots, which are found again from the whole jittered file
+records that aren't in the new extract anymore are removed from all of them.
+
+when an extract only adds records, the files are appended to in place, so
+a refresh takes time in proportion to the new records. when records changed
+or were removed, the files are rewritten from the rows already in them,
+without cleaning them again. the hotspots are the exception: a new crash
+can join two clusters anywhere, so they're always found again from every
+crash.
+
+the first run for a file has no saved hashes, so every record counts as
+changed. the clean files need a `Record Id` column, so files made before
+record ids were added need one `python pipeline.py --force` first.
+
+    python delta_ingest.py "new-extract.csv" "moco-crash-2023"
+    python delta_ingest.py "new-extract.csv" "moco-crash-2023" --geocode
+"""
+
+import os
+import sys
+import argparse
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# parquet or csv, depending on the file name
+from crash_schema import read_table, write_table, read_columns, append_table
+from crash_schema import read_chunks, stage_columns
+
+from record_ids import RECORD_ID, add_record_ids, row_hashes
+
+# the same steps the pipeline runs for every yearly file
+from pipeline import DATA_DIR, read_output, date_time, addresses, streets, geocode
+from pipeline import bike_ped, output_dirs
+
+from clean_datetime import load_data
+from make_master_file import drop_cols
+from geocode_store import load_store
+from canonicalize_streets import load_gazetteer
+from jitter import merge_geocoded_lat_lon, spatial_cells, add_jitter
+from make_geojson import LAYERS, GeoJSONWriter, prepare, write_layers, stream_geojson
+from make_charts import CUBE_FILE, build_cube, update_cube, load_cube, save_charts
+import hotspots
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
+
+STATE_DIR = "cleaning-process/delta"
+ROW_HASH = "Row Hash"
+
+# rows of the master file read at a time, to find the crashes at a spot
+CHUNK_SIZE = 100_000
+
+# the files of one yearly file's branch, laid out the same as the pipeline's
+Paths = namedtuple(
+    "Paths",
+    ["state", "clean", "bike", "ped", "master", "geocoded", "jittered", "geojson"]
+    + ["charts", "gazetteer", "hotspots"],
+)
+
+# `rows` are the new and changed records, `removed` the ids of the records
+# that aren't in the extract anymore
+Delta = namedtuple("Delta", ["rows", "removed", "unchanged"])
+
+
+def delta_paths(data_dir, name, file_format="csv"):
+    tmp = os.path.join(data_dir, "cleaning-process")
+    clean = os.path.join(data_dir, "clean-data")
+    # the same folders the pipeline saves to
+    published = output_dirs(data_dir)
+    return Paths(
+        state=os.path.join(data_dir, STATE_DIR, name + ".csv"),
+        clean=os.path.join(clean, name + "-clean.csv"),
+        bike=os.path.join(tmp, "bike-crashes-2013-2023." + file_format),
+        ped=os.path.join(tmp, "ped-crashes-2013-2023." + file_format),
+        master=os.path.join(clean, "master-crashes.csv"),
+        geocoded=os.path.join(clean, "geocoded", "master_crash_geocoded.csv"),
+        jittered=os.path.join(clean, "jittered", "master-crashes-jittered.csv"),
+        geojson=published["geojson"],
+        charts=published["charts"],
+        gazetteer=os.path.join(tmp, "street-gazetteer.csv"),
+        hotspots=published["hotspots"],
+    )
+
+
+def hex_hashes(hashes):
+    """ uint64 hashes as text, so they survive a csv """
+    return pd.Series(hashes).map("{:016x}".format).to_numpy()
+
+
+def load_state(path):
+    """ the row hash of every record in the last extract, by Record Id """
+    if not os.path.exists(path):
+        return None
+    state = read_table(path, dtype=str)
+    return pd.Series(state[ROW_HASH].to_numpy(), index=state[RECORD_ID])
+
+
+def save_state(extract, hashes, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_table(pd.DataFrame({RECORD_ID: extract[RECORD_ID], ROW_HASH: hashes}), path)
+
+
+def read_ids(path):
+    """ the Record Ids in a file. a file without them can't be merged into """
+    if not os.path.exists(path):
+        return pd.Series([], dtype=object)
+    if RECORD_ID not in read_columns(path):
+        raise ValueError(
+            "%s has no %s column, run `pipeline.py --force` once first"
+            % (path, RECORD_ID)
+        )
+    return read_table(path, usecols=[RECORD_ID], dtype=str)[RECORD_ID]
+
+
+def find_delta(extract, hashes, state, known_ids):
+    """
+    compares an extract with the hashes saved from the last one. without
+    saved hashes every record counts as changed, and `known_ids` (the ids
+    in the clean file) are used to find the removed records
+    """
+    ids = extract[RECORD_ID]
+    if state is None:
+        changed = np.ones(len(extract), dtype=bool)
+        previous = pd.Index(known_ids)
+    else:
+        changed = (ids.map(state) != hashes).to_numpy()
+        previous = state.index
+    removed = previous.difference(pd.Index(ids))
+    return Delta(extract[changed], list(removed), int((~changed).sum()))
+
+
+def clean_delta(rows, bike_df, ped_df, use_geocoder=False, gazetteer=None):
+    """ runs the new and changed records through the pipeline's steps """
+    df = addresses(date_time(rows.copy()))
+    if gazetteer is not None:
+        df = streets(df, gazetteer)
+    if use_geocoder:
+        df = geocode(df)
+    return bike_ped(df, bike_df, ped_df)
+
+
+def upsert(table, rows, removed):
+    """
+    replaces the records in the table that have the same Record Id as one
+    of the rows, where they are, adds the other rows at the end, and drops
+    the removed records
+    """
+    ids = table[RECORD_ID]
+    order = pd.Series(np.arange(len(table)), index=ids.to_numpy())
+    kept = ~(ids.isin(rows[RECORD_ID]) | ids.isin(removed)).to_numpy()
+
+    position = np.array(rows[RECORD_ID].map(order), dtype=float)
+    new = np.isnan(position)
+    position[new] = len(table) + np.arange(new.sum())
+
+    combined = pd.concat(
+        [table[kept], rows.reindex(columns=table.columns)], ignore_index=True
+    )
+    positions = np.concatenate([np.flatnonzero(kept), position])
+    return combined.iloc[np.argsort(positions, kind="stable")].reset_index(drop=True)
+
+
+def update_file(path, rows, removed):
+    """
+    merges the rows into a file by Record Id. the file is only appended to
+    if none of its records changed. returns what was done to the file
+    """
+    ids = read_ids(path)
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_table(rows, path)
+        return "created"
+    if not (ids.isin(rows[RECORD_ID]).any() or ids.isin(removed).any()):
+        append_table(rows, path)
+        return "appended"
+    # as text, so the rows that didn't change are written back as they were
+    write_table(upsert(read_table(path, dtype=str), rows, removed), path)
+    return "rewritten"
+
+
+def old_rows(clean_file, ids):
+    """
+    the records with these ids in the clean file, as they were before this
+    run, with only the columns the charts count
+    """
+    if not os.path.exists(clean_file):
+        return pd.DataFrame()
+    columns = stage_columns(clean_file, "charts") + [RECORD_ID]
+    old = read_table(clean_file, usecols=columns, low_memory=False)
+    return old[old[RECORD_ID].isin(ids)]
+
+
+def jitter_rows(master_file, rows, store=None):
+    """
+    jitters the rows, which are already in the master file, and returns them
+    as they are read from it. each one is placed after the crashes before it
+    in the file at the same spot, the same as a full run. the file is read a
+    chunk at a time, and only the rows and the crashes at their spots are kept
+    """
+    if not len(rows):
+        return rows
+    located = rows.copy()
+    if store is not None:
+        located = merge_geocoded_lat_lon(located, store)
+    spots = pd.MultiIndex.from_frame(spatial_cells(located).dropna())
+
+    near = []
+    for chunk in read_chunks(master_file, CHUNK_SIZE, low_memory=False):
+        if store is not None:
+            chunk = merge_geocoded_lat_lon(chunk, store)
+        at_spots = pd.MultiIndex.from_frame(spatial_cells(chunk)).isin(spots)
+        near.append(chunk[at_spots | chunk[RECORD_ID].isin(rows[RECORD_ID])])
+    jittered = add_jitter(pd.concat(near, ignore_index=True))
+    jittered = jittered[jittered[RECORD_ID].isin(rows[RECORD_ID])].copy()
+    # the same as `read_output`
+    jittered["DateTime"] = pd.to_datetime(jittered["DateTime"])
+    return jittered
+
+
+def update_geojson(geojson_dir, rows, jittered_file, append):
+    """ appends the jittered rows to the three layers, or remakes them """
+    out_files = [
+        os.path.join(geojson_dir, "master-%s.geojson" % name) for name in LAYERS
+    ]
+    if append and all(map(os.path.exists, out_files)):
+        writers = [GeoJSONWriter(out_file, append=True) for out_file in out_files]
+        write_layers(prepare(rows), writers)
+        for writer in writers:
+            writer.close()
+        return "appended"
+    os.makedirs(geojson_dir, exist_ok=True)
+    stream_geojson(jittered_file, out_files)
+    return "rewritten"
+
+
+def update_charts(charts_dir, rows, old):
+    """
+    takes the old versions of the changed and removed records out of the
+    cube, counts the new and changed records in, and remakes the charts
+    """
+    if not os.path.exists(os.path.join(charts_dir, CUBE_FILE)):
+        return "skipped"
+    cube = load_cube(charts_dir)
+    added, removed = [build_cube(df) if len(df) else cube[:0] for df in [rows, old]]
+    save_charts(update_cube(cube, added, removed), charts_dir)
+    return "updated"
+
+
+def update_hotspots(hotspots_dir, jittered_file):
+    """ finds the hotspots again, they can merge or split with any new crash """
+    if not os.path.exists(hotspots_dir):
+        return "skipped"
+    df = hotspots.add_hotspot_ids(hotspots.load_data(jittered_file))
+    hotspots.save_hotspots(df, hotspots_dir)
+    return "rewritten"
+
+
+def ingest(extract_file, name, data_dir=DATA_DIR, use_geocoder=False, file_format="csv"):
+    """
+    merges the new and changed records of an extract into the clean files.
+    returns a summary of what was done
+    """
+    paths = delta_paths(data_dir, name, file_format)
+    extract = add_record_ids(load_data(extract_file))
+    hashes = hex_hashes(row_hashes(extract))
+    delta = find_delta(extract, hashes, load_state(paths.state), read_ids(paths.clean))
+    summary = {
+        "new or changed": len(delta.rows),
+        "removed": len(delta.removed),
+        "unchanged": delta.unchanged,
+    }
+
+    if len(delta.rows) or delta.removed:
+        if len(delta.rows):
+            clean = clean_delta(
+                delta.rows,
+                read_output(paths.bike, "bike_ped_reports"),
+                read_output(paths.ped, "bike_ped_reports"),
+                use_geocoder,
+                load_gazetteer(paths.gazetteer),
+            )
+        else:
+            clean = pd.DataFrame(columns=[RECORD_ID, "DateTime"])
+        old = old_rows(paths.clean, list(clean[RECORD_ID]) + delta.removed)
+        summary["clean file"] = update_file(paths.clean, clean, delta.removed)
+
+        # the files made from every year, if they've been made already
+        if os.path.exists(paths.master):
+            rows = drop_cols(clean)
+            summary["master"] = update_file(paths.master, rows, delta.removed)
+            store = load_store(paths.geocoded) if os.path.exists(paths.geocoded) else None
+            jittered = jitter_rows(paths.master, rows, store)
+            summary["jittered"] = update_file(paths.jittered, jittered, delta.removed)
+            summary["geojson"] = update_geojson(
+                paths.geojson,
+                jittered,
+                paths.jittered,
+                summary["jittered"] == "appended",
+            )
+            summary["charts"] = update_charts(paths.charts, clean, old)
+            summary["hotspots"] = update_hotspots(paths.hotspots, paths.jittered)
+
+    # only saved once everything is merged, so a failed run is simply redone
+    save_state(extract, hashes, paths.state)
+    return summary
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="merge a new extract into the data")
+    parser.add_argument("extract")
+    parser.add_argument("name", help="the yearly file, ex. moco-crash-2023")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--geocode", action="store_true", help="geocode new records")
+    parser.add_argument(
+        "--format",
+        choices=["csv", "parquet"],
+        default="csv",
+        help="format of the files in cleaning-process",
+    )
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    script_report(sys.argv)
+    ARGS = parse_args(sys.argv[1:])
+    SUMMARY = ingest(ARGS.extract, ARGS.name, ARGS.data_dir, ARGS.geocode, ARGS.format)
+
+    for STEP, RESULT in SUMMARY.items():
+        print(STEP + ":", RESULT)
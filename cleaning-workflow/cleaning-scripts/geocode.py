@@ -2,94 +2,378 @@
 this script updates the geocoding for all crash reports with two roads listed,
 which enables intersection geocoding.
 
-IMPORTANT: this code will take a long time to run, around an hour for each 
-of the small data sets. It took more than 16 hours to run on the master file. 
+IMPORTANT: this code will take a long time to run, around an hour for each
+of the small data sets. It took more than 16 hours to run on the master file.
 
-If you don't want to spend the time, you can use the already geocoded data in the 
+most of that time was spent geocoding the same intersections over and over.
+this script now only geocodes each unique intersection once, and stores the
+results in a sqlite cache. reruns, new yearly files and runs that crashed
+partway through only pay for intersections that aren't in the cache yet.
+
+more files can be geocoded in one run. their intersections are looked up
+together, so the requests share one rate limit instead of each file
+getting its own:
+    python geocode.py "in-1" "out-1" "in-2" "out-2" [cache-file] --workers 8
+
+If you don't want to spend the time, you can use the already geocoded data in the
 data/clean-data/geocoded file or the data/clean-data/jittered file
 """
 
 import sys
+import sqlite3
+import time
+import random
+import argparse
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # pandas
 import pandas as pd
 
-# regex
-import re
+# parquet or csv, depending on the file name
+from crash_schema import read_table, write_table
 
 # geopy for geolocation
 import geopy
 from geopy.geocoders import ArcGIS
-from geopy.extra.rate_limiter import RateLimiter
+from geopy.adapters import RequestsAdapter
+from geopy.exc import GeocoderRateLimited, GeocoderTimedOut, GeocoderUnavailable
 
 # progress bar
 from tqdm import tqdm
 
+# offline geocoder built from already geocoded crashes
+from intersection_index import normalize_road, load_index, lookup, MAX_SPREAD
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
+
 tqdm.pandas()
 
+CITY = "BLOOMINGTON IN"
+CACHE_FILE = "../../data/cleaning-process/geocode-cache.sqlite"
+
+# how many requests can be in flight at once, and how many can start per second
+WORKERS = 8
+RATE = 10
+# how many times to retry a request that timed out or was rate limited
+RETRIES = 4
+BACKOFF = 0.5
+TIMEOUT = 10
+
+# errors worth retrying. anything else is a real problem with the request
+RETRY_ERRORS = (GeocoderRateLimited, GeocoderTimedOut, GeocoderUnavailable)
+
 
 def load_data(in_file):
     """ returns a pandas dataframe of the raw dataset """
-    return pd.read_csv(in_file, low_memory=False)
+    return read_table(in_file, low_memory=False)
+
+
+def make_geocoder(workers=WORKERS, timeout=TIMEOUT, scheme=None, domain=None):
+    """
+    returns one ArcGIS client to share between all requests, so they reuse
+    the same connection pool. `scheme` and `domain` can point it at the
+    local stand-in from `mock_geocoder.py`.
+    """
+    options = {}
+    if domain:
+        options["domain"] = domain
+    return ArcGIS(
+        scheme=scheme,
+        timeout=timeout,
+        adapter_factory=partial(
+            RequestsAdapter, pool_connections=1, pool_maxsize=workers
+        ),
+        **options,
+    )
+
+
+class TokenBucket:
+    """
+    allows `rate` requests per second on average, with bursts of up to
+    `burst` requests. shared by all worker threads.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ blocks until a request is allowed to start """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
 
 
 # define a function to geolocate a given column
-def geocode_intersection(road1, road2):
+def geocode_intersection(road1, road2, city=CITY, geocoder=None):
     if len(str(road2)) > 0:
-        print(road1, road2)
-        n = ArcGIS().geocode(road1 + " & " + road2 + ", BLOOMINGTON IN")
+        geocoder = geocoder or ArcGIS()
+        n = geocoder.geocode(road1 + " & " + road2 + ", " + city)
         # n is a list [0] = street names [1] = lat/long
-        return n[1]
+        return n[1] if n else None
     else:
-        return ""
+        return None
+
 
+def geocode_with_retries(key, geocoder, bucket, retries=RETRIES, backoff=BACKOFF):
+    """
+    geocodes one (road1, road2, city) key. timeouts and rate limits are
+    retried with exponential backoff. raises the last error if every
+    attempt fails.
+    """
+    for attempt in range(retries + 1):
+        if bucket is not None:
+            bucket.acquire()
+        try:
+            return geocode_intersection(key[0], key[1], key[2], geocoder)
+        except RETRY_ERRORS as error:
+            if attempt == retries:
+                raise
+            wait = backoff * 2 ** attempt * (1 + random.random())
+            if getattr(error, "retry_after", None):
+                wait = max(wait, error.retry_after)
+            time.sleep(wait)
 
-def apply_geocode(df):
-    df["new_coords"] = df.progress_apply(
-        lambda x: geocode_intersection(x["Roadway Id"], x["Intersecting Road"]), axis=1
+
+def geocode_many(keys, geocoder, workers=WORKERS, rate=RATE):
+    """
+    geocodes a list of keys on a pool of `workers` threads, starting at most
+    `rate` requests per second. yields (key, coords, error) as each request
+    finishes.
+    """
+    bucket = TokenBucket(rate, burst=workers) if rate else None
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            pool.submit(geocode_with_retries, key, geocoder, bucket): key
+            for key in keys
+        }
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            key = futures[future]
+            try:
+                yield key, future.result(), None
+            except Exception as error:
+                yield key, None, error
+
+
+def open_cache(cache_file=CACHE_FILE):
+    """ opens (and creates, if needed) the sqlite geocode cache """
+    cache = sqlite3.connect(cache_file)
+    cache.execute(
+        """
+        CREATE TABLE IF NOT EXISTS geocodes (
+            road1 TEXT NOT NULL,
+            road2 TEXT NOT NULL,
+            city TEXT NOT NULL,
+            latitude REAL,
+            longitude REAL,
+            PRIMARY KEY (road1, road2, city)
+        )
+        """
     )
-    return df
+    return cache
 
 
-def split_coords(string, index):
-    test = re.findall("[\d]{2}\.[\d]{5}", str(string))
-    return float(test[index]) if len(test) > 1 else ""
+def read_cache(cache, keys):
+    """ returns a dict of (road1, road2, city) -> (lat, lon) for cached keys """
+    found = {}
+    for road1, road2, city in keys:
+        row = cache.execute(
+            "SELECT latitude, longitude FROM geocodes "
+            "WHERE road1 = ? AND road2 = ? AND city = ?",
+            (road1, road2, city),
+        ).fetchone()
+        if row is not None:
+            found[(road1, road2, city)] = row
+    return found
 
 
-def clean_geocode_coords(df):
-    df["Latitude_2"] = df["new_coords"].apply(lambda x: x["Roadway Id"], 0, axis=1)
-    df["Longitude_2"].apply(lambda x: x["Roadway Id"], 1, axis=1)
-    return df
+def write_cache(cache, key, coords):
+    """
+    stores one geocoded intersection. intersections with no result are stored
+    too, so they aren't requested again. commits right away so a crash
+    partway through a run doesn't lose any work.
+    """
+    lat, lon = coords if coords else (None, None)
+    cache.execute(
+        "INSERT OR REPLACE INTO geocodes VALUES (?, ?, ?, ?, ?)", (*key, lat, lon)
+    )
+    cache.commit()
 
 
-def merge_lat_lon(coord1, coord2):
-    if coord2 == "":
-        return coord1
-    else:
-        return coord2
+def unique_intersections(df, city=CITY):
+    """ returns a df of the normalized (road1, road2, city) key for every row """
+    keys = pd.DataFrame(
+        {
+            "road1": df["Roadway Id"].map(normalize_road),
+            "road2": df["Intersecting Road"].map(normalize_road),
+        },
+        index=df.index,
+    )
+    keys["city"] = city
+    return keys
 
 
-def apply_merge(df):
-    df["Latitude"] = df.apply(
-        lambda x: merge_lat_lon(x["Latitude"], x["Latitude_2"]), axis=1
+def apply_geocode(
+    df,
+    cache,
+    city=CITY,
+    geocoder=None,
+    workers=WORKERS,
+    rate=RATE,
+    index=None,
+    max_spread=MAX_SPREAD,
+):
+    """
+    geocodes every unique intersection in the df. the cache is checked first,
+    then the offline intersection `index` (if given), and only what's left
+    is sent to ArcGIS. adds `Latitude_2` and `Longitude_2` columns and
+    returns the df along with the number of cache hits, index hits, misses
+    and failed requests.
+    """
+    geocoder = geocoder or make_geocoder(workers)
+    keys = unique_intersections(df, city)
+    has_intersection = (keys["road1"] != "") & (keys["road2"] != "")
+    unique_keys = list(
+        keys[has_intersection].drop_duplicates().itertuples(index=False, name=None)
     )
-    df["Longitude"] = df.apply(
-        lambda x: merge_lat_lon(x["Longitude"], x["Longitude_2"]), axis=1
+
+    coords = read_cache(cache, unique_keys)
+    hits = len(coords)
+    index_hits = 0
+    misses = []
+    for key in unique_keys:
+        if key in coords:
+            continue
+        found = lookup(index, key[0], key[1], max_spread) if index else None
+        if found is not None:
+            coords[key] = found
+            index_hits += 1
+        else:
+            misses.append(key)
+
+    # only the main thread writes to the cache
+    failed = 0
+    for key, value, error in geocode_many(misses, geocoder, workers, rate):
+        if error is not None:
+            # don't cache failures, so they are retried on the next run
+            print("could not geocode", key, "-", error)
+            failed += 1
+            continue
+        coords[key] = value
+        write_cache(cache, key, value)
+
+    # fan the unique results back out to every row
+    results = pd.DataFrame(
+        [(*key, *(value if value else (None, None))) for key, value in coords.items()],
+        columns=["road1", "road2", "city", "Latitude_2", "Longitude_2"],
     )
+    new_coords = keys.merge(results, how="left", on=["road1", "road2", "city"])
+    df["Latitude_2"] = new_coords["Latitude_2"].to_numpy(dtype=float)
+    df["Longitude_2"] = new_coords["Longitude_2"].to_numpy(dtype=float)
+    return df, {
+        "hits": hits,
+        "index_hits": index_hits,
+        "misses": len(misses),
+        "failed": failed,
+    }
+
+
+def apply_merge(df):
+    """ keeps the original lat/lon wherever geocoding didn't return a result """
+    df["Latitude"] = df["Latitude_2"].fillna(df["Latitude"])
+    df["Longitude"] = df["Longitude_2"].fillna(df["Longitude"])
     return df
 
 
 def save_clean_df(cleaned_df, out_file):
     """ save the master df """
-    cleaned_df.to_csv(out_file, index=False)
+    write_table(cleaned_df, out_file)
 
 
-if __name__ == "__main__":
-    DF = load_data(sys.argv[1])
-    OUTFILE = sys.argv[2]
+def geocode_files(dfs, cache, **options):
+    """
+    geocodes the intersections of many files in one batch, so one that is in
+    more than one file is only looked up once, and all the requests share
+    the same threads and rate limit. returns the geocoded dfs and the stats
+    """
+    roads = pd.concat(
+        [df[["Roadway Id", "Intersecting Road"]] for df in dfs], ignore_index=True
+    )
+    roads, stats = apply_geocode(roads, cache, **options)
+    start = 0
+    for df in dfs:
+        found = roads.iloc[start : start + len(df)]
+        df["Latitude_2"] = found["Latitude_2"].to_numpy()
+        df["Longitude_2"] = found["Longitude_2"].to_numpy()
+        start += len(df)
+    return dfs, stats
 
-    CLEAN_DF = apply_merge(clean_geocode_coords(apply_geocode(DF)))
 
-    save_clean_df(CLEAN_DF.drop(columns=["Latitude_2", "Longitude_2", "new_coords"]))
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="geocode crash intersections")
+    parser.add_argument(
+        "files",
+        nargs="+",
+        help="in_file out_file [in_file out_file ...] [cache_file]",
+    )
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--rate", type=float, default=RATE, help="requests/second")
+    parser.add_argument("--timeout", type=float, default=TIMEOUT)
+    parser.add_argument("--scheme", default=None, help="ex. `http` for the mock")
+    parser.add_argument("--domain", default=None, help="ex. `localhost:8080`")
+    parser.add_argument("--index", default=None, help="intersection_index.py output")
+    parser.add_argument("--max-spread", type=float, default=MAX_SPREAD, help="meters")
+    args = parser.parse_args(argv)
+    # an odd file out is the cache, the same as when only one file was taken
+    args.cache_file = args.files.pop() if len(args.files) % 2 else CACHE_FILE
+    if not args.files:
+        parser.error("needs an in_file and an out_file")
+    args.pairs = list(zip(args.files[::2], args.files[1::2]))
+    return args
 
-    print("geocode updated successfully for", DF)
+
+if __name__ == "__main__":
+    script_report(sys.argv)
+    ARGS = parse_args(sys.argv[1:])
+    DFS = [load_data(IN_FILE) for IN_FILE, _ in ARGS.pairs]
+    CACHE = open_cache(ARGS.cache_file)
+    GEOCODER = make_geocoder(ARGS.workers, ARGS.timeout, ARGS.scheme, ARGS.domain)
+    INDEX = load_index(ARGS.index) if ARGS.index else None
+
+    GEOCODED_DFS, STATS = geocode_files(
+        DFS,
+        CACHE,
+        geocoder=GEOCODER,
+        workers=ARGS.workers,
+        rate=ARGS.rate,
+        index=INDEX,
+        max_spread=ARGS.max_spread,
+    )
+    for (IN_FILE, OUT_FILE), GEOCODED_DF in zip(ARGS.pairs, GEOCODED_DFS):
+        CLEAN_DF = apply_merge(GEOCODED_DF)
+        save_clean_df(CLEAN_DF.drop(columns=["Latitude_2", "Longitude_2"]), OUT_FILE)
+    CACHE.close()
+
+    print(
+        "geocode cache hits:", STATS["hits"],
+        "index hits:", STATS["index_hits"],
+        "misses:", STATS["misses"],
+        "failed:", STATS["failed"],
+    )
+    for IN_FILE, _ in ARGS.pairs:
+        print("geocode updated successfully for", IN_FILE)
@@ -0,0 +1,152 @@
+"""
+this script compiles the geocoded master file into a lookup store, so the
+jitter step doesn't have to parse the whole csv again for every yearly file.
+
+the store is a folder of numpy arrays: the crash times (int64 nanoseconds),
+a key for each crash's road pair, and its latitude/longitude, all sorted by
+time and then key. the arrays are opened memory-mapped, so every job that
+uses the store shares one copy of it in the page cache, and only reads the
+parts its lookups touch.
+
+a crash is looked up by its DateTime and road pair. if no geocoded crash
+has the same road pair, but only one crash happened at that exact time,
+that one is used.
+
+input:
+    - data/clean-data/geocoded/master_crash_geocoded.csv
+output:
+    - data/clean-data/geocoded/master_crash_geocoded.store
+"""
+
+import os
+import sys
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+# parquet or csv, depending on the file name
+from crash_schema import read_stage, with_extension
+
+# the same road pair keys as the offline intersection geocoder
+from intersection_index import pair_key
+
+# DateTime to int64, shared with the bike/ped matching
+from merge_bike_ped import to_nanoseconds
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
+
+GeocodeStore = namedtuple("GeocodeStore", ["times", "keys", "latitude", "longitude"])
+
+
+def load_data(in_file):
+    """ returns only the columns needed to build the store """
+    return read_stage(in_file, "geocode_store", low_memory=False)
+
+
+def record_keys(df):
+    """ returns an int64 hash of each crash's normalized, unordered road pair """
+    pairs = [
+        "|".join(pair_key(road1, road2))
+        for road1, road2 in zip(df["Roadway Id"], df["Intersecting Road"])
+    ]
+    return pd.util.hash_array(np.array(pairs, dtype=object)).view(np.int64)
+
+
+def build_store(df):
+    """ returns an in-memory GeocodeStore of the geocoded crashes """
+    times, readable = to_nanoseconds(df["DateTime"])
+    keys = record_keys(df)
+    lat = pd.to_numeric(df["Latitude"], errors="coerce").to_numpy(dtype=float)
+    lon = pd.to_numeric(df["Longitude"], errors="coerce").to_numpy(dtype=float)
+    order = np.lexsort((keys[readable], times[readable]))
+    return GeocodeStore(
+        times[readable][order],
+        keys[readable][order],
+        lat[readable][order],
+        lon[readable][order],
+    )
+
+
+def save_store(store, store_dir):
+    """ writes each array of the store to its own .npy file """
+    os.makedirs(store_dir, exist_ok=True)
+    for name, values in store._asdict().items():
+        np.save(os.path.join(store_dir, name + ".npy"), values)
+
+
+def open_store(store_dir):
+    """ opens a saved store memory-mapped, without reading it into memory """
+    return GeocodeStore(
+        *(
+            np.load(os.path.join(store_dir, name + ".npy"), mmap_mode="r")
+            for name in GeocodeStore._fields
+        )
+    )
+
+
+def load_store(path):
+    """
+    opens the store for a geocoded file. a csv or parquet file is compiled
+    into a `.store` folder next to it the first time, and again whenever
+    the file is newer than its store.
+    """
+    if os.path.isdir(path):
+        return open_store(path)
+    store_dir = with_extension(path, ".store")
+    times_file = os.path.join(store_dir, "times.npy")
+    if not os.path.exists(times_file) or (
+        os.path.getmtime(times_file) < os.path.getmtime(path)
+    ):
+        save_store(build_store(load_data(path)), store_dir)
+    return open_store(store_dir)
+
+
+def lookup(store, df):
+    """
+    returns the geocoded latitude and longitude of every crash in the df,
+    nan for crashes that aren't in the store
+    """
+    times, readable = to_nanoseconds(df["DateTime"])
+    keys = record_keys(df)
+    readable = np.flatnonzero(readable)
+
+    first = np.searchsorted(store.times, times[readable], side="left")
+    last = np.searchsorted(store.times, times[readable], side="right")
+    counts = last - first
+
+    # a crash alone at its time is a match, even if its roads were spelled
+    # differently
+    found = np.full(len(df), -1)
+    alone = counts == 1
+    found[readable[alone]] = first[alone]
+
+    # otherwise the road pair has to match too
+    rows = np.repeat(np.arange(len(readable)), counts)
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    positions = first[rows] + offsets
+    same_roads = store.keys[positions] == keys[readable[rows]]
+    rows, positions = readable[rows[same_roads]], positions[same_roads]
+    # the first match for each crash. the rows are in order, so `np.unique`
+    # gives the position of each crash's first match
+    rows, first_match = np.unique(rows, return_index=True)
+    found[rows] = positions[first_match]
+
+    matched = found >= 0
+    lat = np.full(len(df), np.nan)
+    lon = np.full(len(df), np.nan)
+    lat[matched] = store.latitude[found[matched]]
+    lon[matched] = store.longitude[found[matched]]
+    return lat, lon
+
+
+if __name__ == "__main__":
+    script_report(sys.argv)
+    IN_FILE = sys.argv[1]
+    STORE_DIR = sys.argv[2] if len(sys.argv) > 2 else with_extension(IN_FILE, ".store")
+
+    STORE = build_store(load_data(IN_FILE))
+    save_store(STORE, STORE_DIR)
+
+    print(len(STORE.times), "geocoded crashes saved to", STORE_DIR)
@@ -0,0 +1,321 @@
+"""
+this script finds the places where crashes cluster (the "hotspots") and ranks
+them, for the dashboard's top intersections layer.
+
+crashes are grouped by where they happened, not by their road names, so
+`E 3RD ST & JORDAN` and `EAGLESON AVE & E 3RD ST` end up in the same hotspot.
+the map is cut into `CELL_SIZE` meter squares, and:
+    - a square with at least `MIN_CELL_CRASHES` crashes is a core square
+    - touching core squares (diagonals too) make up one cluster
+    - a square that isn't a core square joins the busiest core square it
+      touches, if any. the rest of its crashes aren't in a hotspot
+    - clusters with fewer than `MIN_CRASHES` crashes aren't hotspots
+this is density clustering (like dbscan) on a grid, so it only takes a few
+sorts and lookups, and the whole 2003-2022 master file takes seconds.
+
+every crash in a hotspot gets a `Hotspot Id`, made from the hotspot's
+busiest square (ex. `HS:174426:-296849`). the squares are laid out from a
+fixed origin, so a hotspot keeps its id from one release to the next, as
+long as its busiest square doesn't change.
+
+the hotspots are ranked by their weighted crashes: a crash counts 1, a crash
+with injuries `INJURY_WEIGHT` and a fatal crash `FATAL_WEIGHT`. each hotspot
+also has its bike/ped share and its trend: the change in crashes per year,
+over the last `TREND_YEARS` years of the data.
+
+input (the jittered file has the geocoded lat/lon):
+    - data/clean-data/jittered/master-crashes-jittered.csv
+output:
+    - data/clean-data/hotspots/hotspots.csv, every hotspot, ranked
+    - data/clean-data/hotspots/hotspot-crashes.csv, the Hotspot Id of every
+      crash, by Record Id
+    - data/clean-data/hotspots/top-intersections.geojson, the `TOP` hotspots
+
+run this command in the terminal:
+    python hotspots.py "../../data/clean-data/jittered/master-crashes-jittered.csv" /
+        "../../data/clean-data/hotspots"
+"""
+
+import os
+import sys
+import json
+
+import numpy as np
+import pandas as pd
+
+# parquet or csv, depending on the file name
+from crash_schema import read_stage, write_table
+
+# flat-earth distances are plenty at this scale
+from intersection_index import METERS_PER_DEGREE, pair_key
+
+from make_geojson import drop_out_of_bounds_points
+from make_charts import is_true
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
+
+HOTSPOT_ID = "Hotspot Id"
+HOTSPOTS_FILE = "hotspots.csv"
+CRASHES_FILE = "hotspot-crashes.csv"
+LAYER_FILE = "top-intersections.geojson"
+
+# about the size of an intersection
+CELL_SIZE = 25
+MIN_CELL_CRASHES = 3
+MIN_CRASHES = 5
+
+# the east-west size of a square is fixed at Bloomington's latitude, so the
+# squares (and the ids) don't depend on the data
+REFERENCE_LATITUDE = 39.17
+
+INJURY_WEIGHT = 3
+FATAL_WEIGHT = 10
+TREND_YEARS = 5
+
+# the hotspots on the dashboard layer
+TOP = 100
+
+# the 8 squares around a square, as (row, column) steps
+NEIGHBOURS = [(dy, dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1) if dy or dx]
+
+# squares are stored as one int64: the row in the high bits, the column low
+COLUMN_BITS = 32
+COLUMN_OFFSET = 1 << (COLUMN_BITS - 1)
+
+
+def load_data(in_file):
+    """ returns only the columns the hotspots are made from """
+    return read_stage(in_file, "hotspots", low_memory=False)
+
+
+def grid_squares(lat, lon, cell_size=CELL_SIZE):
+    """ the row and column of the square every crash is in """
+    lon_scale = np.cos(np.radians(REFERENCE_LATITUDE))
+    rows = np.floor(lat * METERS_PER_DEGREE / cell_size).astype(np.int64)
+    cols = np.floor(lon * METERS_PER_DEGREE * lon_scale / cell_size).astype(np.int64)
+    return rows, cols
+
+
+def square_keys(rows, cols):
+    return (rows << COLUMN_BITS) + (cols + COLUMN_OFFSET)
+
+
+def square_name(key):
+    """ `HS:<row>:<column>` """
+    row, col = key >> COLUMN_BITS, key & ((1 << COLUMN_BITS) - 1)
+    return "HS:%d:%d" % (row, col - COLUMN_OFFSET)
+
+
+def find_neighbours(squares):
+    """
+    the position in `squares` (sorted keys) of the 8 squares around each
+    square, or -1 where that square has no crashes
+    """
+    neighbours = np.full((len(squares), len(NEIGHBOURS)), -1)
+    for i, (dy, dx) in enumerate(NEIGHBOURS):
+        keys = squares + (dy << COLUMN_BITS) + dx
+        found = np.searchsorted(squares, keys).clip(max=len(squares) - 1)
+        neighbours[:, i] = np.where(squares[found] == keys, found, -1)
+    return neighbours
+
+
+def connect(labels, src, dst):
+    """
+    gives every connected group of squares the smallest label in it. `src`
+    and `dst` are the pairs of touching squares, in both directions
+    """
+    while True:
+        merged = labels.copy()
+        np.minimum.at(merged, src, labels[dst])
+        # follow each label to its own label, so long chains join fast
+        merged = merged[merged]
+        if np.array_equal(merged, labels):
+            return labels
+        labels = merged
+
+
+def cluster_squares(squares, counts, min_cell_crashes=MIN_CELL_CRASHES):
+    """
+    returns the cluster of every square, as the position of the cluster's
+    first core square, or -1 for squares that aren't in a cluster
+    """
+    core = counts >= min_cell_crashes
+    neighbours = find_neighbours(squares)
+
+    # core squares that touch are one cluster
+    square, step = np.nonzero((neighbours >= 0) & core[:, None])
+    touching = core[neighbours[square, step]]
+    src, dst = square[touching], neighbours[square, step][touching]
+    labels = connect(np.arange(len(squares)), src, dst)
+    labels = np.where(core, labels, -1)
+
+    # the other squares join the busiest core square they touch
+    neighbour_counts = np.where(
+        neighbours >= 0, counts[neighbours] * core[neighbours], 0
+    )
+    busiest = neighbour_counts.argmax(axis=1)
+    border = ~core & (neighbour_counts.max(axis=1) > 0)
+    rows = np.flatnonzero(border)
+    labels[rows] = labels[neighbours[rows, busiest[rows]]]
+    return labels
+
+
+def hotspot_ids(lat, lon, cell_size=CELL_SIZE, min_crashes=MIN_CRASHES):
+    """ the Hotspot Id of every crash, or None if it isn't in a hotspot """
+    ids = np.full(len(lat), None, dtype=object)
+    known = ~(np.isnan(lat) | np.isnan(lon))
+    if not known.any():
+        return ids
+    rows, cols = grid_squares(lat[known], lon[known], cell_size)
+    squares, inverse, counts = np.unique(
+        square_keys(rows, cols), return_inverse=True, return_counts=True
+    )
+    labels = cluster_squares(squares, counts)
+
+    # each cluster is named after its busiest square, the first one on a tie
+    clustered = np.flatnonzero(labels >= 0)
+    order = clustered[np.lexsort((squares[clustered], -counts[clustered]))]
+    clusters, first = np.unique(labels[order], return_index=True)
+    named = order[first]
+    sizes = np.bincount(labels[clustered], counts[clustered], len(squares))
+
+    names = np.full(len(squares), None, dtype=object)
+    big = sizes[clusters] >= min_crashes
+    names[clusters[big]] = [square_name(key) for key in squares[named[big]]]
+    square_names = np.where(labels >= 0, names[labels.clip(min=0)], None)
+    ids[known] = square_names[inverse]
+    return ids
+
+
+def add_hotspot_ids(df):
+    """ adds a `Hotspot Id` column. crashes outside the county get none """
+    mapped = drop_out_of_bounds_points(df)
+    lat = mapped["Latitude"].to_numpy(dtype=float)
+    lon = mapped["Longitude"].to_numpy(dtype=float)
+    df[HOTSPOT_ID] = pd.Series(hotspot_ids(lat, lon), index=mapped.index, dtype=object)
+    return df
+
+
+def intersection_names(df):
+    """ `ROAD 1 & ROAD 2`, the same whichever road was written first """
+    pairs = pd.MultiIndex.from_arrays(
+        [df["Roadway Id"].astype(object), df["Intersecting Road"].astype(object)]
+    )
+    codes, uniques = pairs.factorize()
+    names = np.array(
+        [" & ".join(filter(None, pair_key(*pair))) for pair in uniques], dtype=object
+    )
+    return names[codes]
+
+
+def most_common(codes, values, n):
+    """ the most common value for every code, the first one on a tie """
+    counts = pd.DataFrame({"code": codes, "value": values}).value_counts(sort=False)
+    counts = counts.reset_index().sort_values(
+        ["count", "value"], ascending=[False, True], kind="stable"
+    )
+    first = counts.drop_duplicates("code")
+    result = np.full(n, "", dtype=object)
+    result[first["code"].to_numpy()] = first["value"].to_numpy()
+    return result
+
+
+def yearly_trend(counts):
+    """ the least squares slope of each row of yearly counts """
+    years = np.arange(counts.shape[1]) - (counts.shape[1] - 1) / 2
+    if not (years ** 2).sum():
+        return np.zeros(len(counts))
+    return counts @ years / (years ** 2).sum()
+
+
+def rank_hotspots(df, trend_years=TREND_YEARS):
+    """ one row per hotspot, ranked by weighted crashes """
+    df = df[df[HOTSPOT_ID].notna()]
+    codes, ids = pd.factorize(df[HOTSPOT_ID])
+    n = len(ids)
+
+    dead = pd.to_numeric(df["Number Dead"], errors="coerce").fillna(0).to_numpy()
+    injured = pd.to_numeric(df["Number Injured"], errors="coerce").fillna(0).to_numpy()
+    weights = np.select([dead > 0, injured > 0], [FATAL_WEIGHT, INJURY_WEIGHT], 1)
+    bike_ped = is_true(df, "Cyclist Involved") | is_true(df, "Pedestrian Involved")
+
+    # crashes per hotspot per year, for the last `trend_years` years
+    years = pd.to_datetime(df["DateTime"], errors="coerce").dt.year.to_numpy()
+    last_year = int(np.nanmax(years)) if n and not np.isnan(years).all() else 0
+    # only the years that are in the data
+    if last_year:
+        trend_years = min(trend_years, last_year - int(np.nanmin(years)) + 1)
+    first_year = last_year - trend_years + 1
+    recent = (years >= first_year) & (years <= last_year)
+    yearly = np.bincount(
+        codes[recent] * trend_years + (years[recent] - first_year).astype(np.int64),
+        minlength=n * trend_years,
+    ).reshape(n, trend_years)
+
+    crashes = np.bincount(codes, minlength=n)
+    hotspots = pd.DataFrame(
+        {
+            HOTSPOT_ID: np.asarray(ids, dtype=object),
+            "Intersection": most_common(codes, intersection_names(df), n),
+            "Latitude": np.bincount(codes, df["Latitude"].to_numpy(float), n) / crashes,
+            "Longitude": np.bincount(codes, df["Longitude"].to_numpy(float), n)
+            / crashes,
+            "Crashes": crashes,
+            "Weighted Crashes": np.bincount(codes, weights, n).astype(np.int64),
+            "Number Dead": np.bincount(codes, dead, n).astype(np.int64),
+            "Number Injured": np.bincount(codes, injured, n).astype(np.int64),
+            "Bike/Ped Share": np.bincount(codes, bike_ped, n) / crashes,
+            "Crashes Last Year": yearly[:, -1],
+            "Crashes Year Before": yearly[:, -2] if trend_years > 1 else 0,
+            "Trend": yearly_trend(yearly),
+        }
+    )
+    hotspots = hotspots.sort_values(
+        ["Weighted Crashes", "Crashes", HOTSPOT_ID],
+        ascending=[False, False, True],
+        ignore_index=True,
+    )
+    hotspots.insert(0, "Rank", np.arange(1, n + 1))
+    return hotspots.round(
+        {"Latitude": 6, "Longitude": 6, "Bike/Ped Share": 3, "Trend": 2}
+    )
+
+
+def hotspot_layer(hotspots, top=TOP):
+    """ the top hotspots as a geojson FeatureCollection of points """
+    features = []
+    for row in hotspots.head(top).to_dict("records"):
+        lat, lon = row.pop("Latitude"), row.pop("Longitude")
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": [lon, lat]},
+                "properties": {
+                    key: value.item() if isinstance(value, np.generic) else value
+                    for key, value in row.items()
+                },
+            }
+        )
+    return {"type": "FeatureCollection", "features": features}
+
+
+def save_hotspots(df, out_dir):
+    """ saves the ranked hotspots, the crashes' ids and the dashboard layer """
+    os.makedirs(out_dir, exist_ok=True)
+    hotspots = rank_hotspots(df)
+    write_table(hotspots, os.path.join(out_dir, HOTSPOTS_FILE))
+    if "Record Id" in df:
+        write_table(df[["Record Id", HOTSPOT_ID]], os.path.join(out_dir, CRASHES_FILE))
+    with open(os.path.join(out_dir, LAYER_FILE), "w") as f:
+        json.dump(hotspot_layer(hotspots), f)
+    return hotspots
+
+
+if __name__ == "__main__":
+    script_report(sys.argv)
+    IN_FILE = sys.argv[1]
+    OUT_DIR = sys.argv[2]
+
+    HOTSPOTS = save_hotspots(add_hotspot_ids(load_data(IN_FILE)), OUT_DIR)
+    print(len(HOTSPOTS), "hotspots saved to", OUT_DIR)
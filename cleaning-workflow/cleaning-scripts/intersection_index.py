@@ -0,0 +1,150 @@
+"""
+this script builds an offline intersection geocoder from crash reports that
+already have good lat/lon values, so most intersections never need to be
+sent to ArcGIS.
+
+every report with two roads is keyed on its normalized road pair. the order
+of the roads doesn't matter, so `E 3RD ST & JORDAN AVE` and
+`JORDAN AVE & E 3RD ST` are the same intersection. each intersection stores
+the median lat/lon of its reports (which ignores the odd bad coordinate)
+and a spread estimate: the median distance, in meters, of its reports from
+that point. intersections with a large spread are probably mixing up
+different places and should still be geocoded over the network.
+
+input:
+    - any number of cleaned or geocoded crash csvs, ex. data/clean-data/*.csv
+      or data/clean-data/geocoded/master_crash_geocoded.csv
+output:
+    - a csv with one row per intersection
+"""
+
+import sys
+
+import numpy as np
+import pandas as pd
+
+# parquet or csv, depending on the file name
+from crash_schema import read_stage
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
+
+# reports outside of Monroe County can't be right
+MIN_LAT, MAX_LAT = 38.99133, 39.35543165
+MIN_LON, MAX_LON = -86.68285, -86.32442
+
+# intersections with a spread above this many meters are geocoded instead
+MAX_SPREAD = 75
+# a single report doesn't say anything about the spread
+MIN_COUNT = 2
+
+METERS_PER_DEGREE = 111_320
+
+
+def load_data(in_file):
+    """ returns only the columns needed to build the index """
+    return read_stage(in_file, "intersection_index", low_memory=False)
+
+
+def normalize_road(road):
+    """ `  e 3rd  st ` -> `E 3RD ST`. missing roads become empty strings """
+    if not isinstance(road, str):
+        return ""
+    return " ".join(road.upper().split())
+
+
+def pair_key(road1, road2):
+    """ the order-independent key for an intersection """
+    road1, road2 = normalize_road(road1), normalize_road(road2)
+    return (road1, road2) if road1 <= road2 else (road2, road1)
+
+
+def intersection_rows(df):
+    """ returns the normalized road pair and lat/lon of every usable report """
+    road1 = df["Roadway Id"].map(normalize_road).to_numpy(dtype=object)
+    road2 = df["Intersecting Road"].map(normalize_road).to_numpy(dtype=object)
+    in_order = road1 <= road2
+    rows = pd.DataFrame(
+        {
+            "road1": np.where(in_order, road1, road2),
+            "road2": np.where(in_order, road2, road1),
+            "latitude": pd.to_numeric(df["Latitude"], errors="coerce"),
+            "longitude": pd.to_numeric(df["Longitude"], errors="coerce"),
+        }
+    )
+    return rows[
+        (rows["road1"] != "")
+        & (rows["road2"] != "")
+        & (rows["road1"] != rows["road2"])
+        & rows["latitude"].between(MIN_LAT, MAX_LAT)
+        & rows["longitude"].between(MIN_LON, MAX_LON)
+    ]
+
+
+def build_index(dfs):
+    """
+    returns one row per intersection with its median lat/lon, the median
+    distance of its reports from that point and the number of reports
+    """
+    rows = pd.concat([intersection_rows(df) for df in dfs], ignore_index=True)
+    groups = rows.groupby(["road1", "road2"], sort=True)
+    centers = groups[["latitude", "longitude"]].transform("median")
+
+    # distances are small, so a flat-earth approximation is plenty
+    dy = (rows["latitude"] - centers["latitude"]) * METERS_PER_DEGREE
+    dx = (
+        (rows["longitude"] - centers["longitude"])
+        * METERS_PER_DEGREE
+        * np.cos(np.radians(centers["latitude"]))
+    )
+    rows = rows.assign(distance=np.hypot(dx, dy))
+
+    index = rows.groupby(["road1", "road2"], sort=True).agg(
+        latitude=("latitude", "median"),
+        longitude=("longitude", "median"),
+        spread=("distance", "median"),
+        count=("distance", "size"),
+    )
+    return index.reset_index().round({"latitude": 6, "longitude": 6, "spread": 1})
+
+
+def save_index(index, out_file):
+    """ save the index """
+    index.to_csv(out_file, index=False)
+
+
+def load_index(index_file):
+    """ returns a dict of (road1, road2) -> (lat, lon, spread, count) """
+    index = pd.read_csv(index_file, keep_default_na=False)
+    return {
+        (road1, road2): (lat, lon, spread, count)
+        for road1, road2, lat, lon, spread, count in index.itertuples(
+            index=False, name=None
+        )
+    }
+
+
+def lookup(index, road1, road2, max_spread=MAX_SPREAD, min_count=MIN_COUNT):
+    """
+    returns the (lat, lon) of an intersection, or None if it has never been
+    seen or its reports are too spread out to trust
+    """
+    found = index.get(pair_key(road1, road2))
+    if found is None:
+        return None
+    lat, lon, spread, count = found
+    if spread > max_spread or count < min_count:
+        return None
+    return lat, lon
+
+
+if __name__ == "__main__":
+    script_report(sys.argv)
+    DFS = list(map(load_data, sys.argv[1:-1]))
+    OUTFILE = sys.argv[-1]
+
+    INDEX = build_index(DFS)
+    save_index(INDEX, OUTFILE)
+
+    USABLE = (INDEX["spread"] <= MAX_SPREAD) & (INDEX["count"] >= MIN_COUNT)
+    print(len(INDEX), "intersections indexed,", int(USABLE.sum()), "usable offline")
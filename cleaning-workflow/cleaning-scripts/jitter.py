@@ -5,6 +5,12 @@ to add geocoded lat/lon to the master.csv file and then jitter the points.
 jittering the points, meaning shifting them slightly will, make it easier to 
 see individual crashes that all occurred at the same place on a map.
 
+crashes at the same spot are spread out in a small spiral around it, which
+gets bigger as more crashes share the spot. the layout only depends on the
+coordinates and `SEED`, so rerunning this script on the same data gives
+byte for byte the same output, and a new release only moves the points
+that actually changed.
+
 the geocoded master file was produced by running the geocode.py script on the 
 master.csv file output, which took a very long time.
 
@@ -14,56 +20,147 @@ input:
 output: 
 - data/clean-data/master-crashes.csv
 - data/clean-data/jittered/master-crashes-jittered/csv
+
+more files can be jittered against the same geocoded file in one run:
+    python jitter.py "in-file" "geocoded-file" "out-file" "in-2" "out-2" --workers 2
 """
 
 import sys
+
+import numpy as np
 import pandas as pd
-import random
 
+# parquet or csv, depending on the file name
+from crash_schema import read_table, write_table
 
-def load_data(in_file):
-    """ returns a pandas dataframe of the raw dataset """
-    return pd.read_csv(in_file, low_memory=False)
+# the geocoded master file, compiled for fast lookups
+from geocode_store import load_store, lookup
 
+# many files at once, in a pool of processes
+from parallel_files import parse_files, file_pairs, run_files
 
-def merge_geocoded_lat_lon(master, geocoded_master):
-    geocoded = master.merge(geocoded_master, how="left", on="DateTime")
-    master["Latitude"] = geocoded["Latitude_y"]
-    master["Longitude"] = geocoded["Longitude_y"]
-    return master
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
 
+# crashes less than about 10cm apart (6 decimals) are at the same spot
+PRECISION = 6
+# distance between neighbouring points in a spread out group, about 3.5m
+SPACING = 0.00003
+# changing the seed turns every group to a new angle
+SEED = 2023
+# the angle between consecutive points of a sunflower spiral
+GOLDEN_ANGLE = np.pi * (3 - np.sqrt(5))
 
-def find_duplicates(df):
-    df["duplicate?"] = df.duplicated(
-        subset=[("Roadway Id" and "Intersecting Road") or ("Latitude" and "Longitude")]
-    )
-    return df
+
+def load_data(in_file):
+    """ returns a pandas dataframe of the raw dataset """
+    return read_table(in_file, low_memory=False)
 
 
-# define a function to return a jittered coordinate based on the original coordinate
-def jitter(coord):
-    jitter_val = random.random() * (0.0001 - 0.00005) - 0.00005
-    return coord + jitter_val
+def merge_geocoded_lat_lon(master, store):
+    """
+    replaces the lat/lon of every crash found in the geocode store. crashes
+    that aren't in it keep their own lat/lon
+    """
+    lat, lon = lookup(store, master)
+    master["Latitude"] = np.where(np.isnan(lat), master["Latitude"], lat)
+    master["Longitude"] = np.where(np.isnan(lon), master["Longitude"], lon)
+    return master
 
 
-def add_jitter(df):
-    df.loc[df["duplicate?"] == True, "Latitude"] = df["Latitude"].apply(jitter)
-    df.loc[df["duplicate?"] == True, "Longitude"] = df["Longitude"].apply(jitter)
-    return df.drop(columns="duplicate?")
+def spatial_cells(df, precision=PRECISION):
+    """
+    returns the integer grid cell of every crash. crashes in the same cell
+    are coincident. crashes with a missing lat/lon get no cell (<NA>)
+    """
+    scale = 10 ** precision
+    return pd.DataFrame(
+        {
+            "lat": (pd.to_numeric(df["Latitude"], errors="coerce") * scale).round(),
+            "lon": (pd.to_numeric(df["Longitude"], errors="coerce") * scale).round(),
+        },
+        index=df.index,
+    ).astype("Int64")
+
+
+def group_angles(lat_cells, lon_cells, seed=SEED):
+    """
+    returns a starting angle for every cell. it only depends on the cell and
+    the seed, so adding crashes somewhere else never moves these points
+    """
+    with np.errstate(over="ignore"):
+        h = lat_cells.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+        h ^= lon_cells.astype(np.uint64) * np.uint64(0xBF58476D1CE4E5B9)
+        h ^= np.uint64(seed) * np.uint64(0x94D049BB133111EB)
+        # splitmix64 finalizer, so nearby cells get unrelated angles
+        h ^= h >> np.uint64(30)
+        h *= np.uint64(0xBF58476D1CE4E5B9)
+        h ^= h >> np.uint64(27)
+        h *= np.uint64(0x94D049BB133111EB)
+        h ^= h >> np.uint64(31)
+    return (h >> np.uint64(11)).astype(float) / 2 ** 53 * 2 * np.pi
+
+
+def add_jitter(df, seed=SEED, spacing=SPACING, precision=PRECISION):
+    """
+    spreads every group of coincident crashes out in a sunflower spiral
+    around their shared spot. the first crash stays put, and the spiral
+    grows with the size of the group so points never pile up. the same
+    input and seed always give exactly the same output
+    """
+    cells = spatial_cells(df, precision)
+    located = cells.notna().all(axis=1).to_numpy()
+    cells = cells[located]
+    lat_cells = cells["lat"].to_numpy(dtype=np.int64)
+    lon_cells = cells["lon"].to_numpy(dtype=np.int64)
+
+    # the position of each crash in its group, in file order
+    position = cells.groupby(["lat", "lon"], sort=False).cumcount().to_numpy()
+    radius = spacing * np.sqrt(position)
+    angle = group_angles(lat_cells, lon_cells, seed) + position * GOLDEN_ANGLE
+
+    lat = lat_cells / 10 ** precision + radius * np.sin(angle)
+    # a degree of longitude is shorter than a degree of latitude
+    lon_scale = np.cos(np.radians(lat_cells / 10 ** precision))
+    lon = lon_cells / 10 ** precision + radius * np.cos(angle) / lon_scale
+
+    # only move the duplicates, the first crash keeps its exact coordinates.
+    # by position, so the df's index doesn't have to be unique
+    moved = position > 0
+    rows = np.flatnonzero(located)[moved]
+    for col, values in [("Latitude", lat), ("Longitude", lon)]:
+        coordinates = pd.to_numeric(df[col], errors="coerce").to_numpy(
+            dtype=float, na_value=np.nan, copy=True
+        )
+        coordinates[rows] = values[moved].round(precision + 1)
+        df[col] = coordinates
+    return df
 
 
 def save_clean_df(cleaned_df, out_file):
     """ save the df """
-    cleaned_df.to_csv(out_file, index=False)
+    write_table(cleaned_df, out_file)
 
 
-if __name__ == "__main__":
-    DF = load_data(sys.argv[1])
-    GEOCODED_DF = load_data(sys.argv[2])
-    OUTFILE = sys.argv[3]
-
-    JITTERED_DF = add_jitter(find_duplicates(merge_geocoded_lat_lon(DF, GEOCODED_DF)))
+def jitter_file(in_file, out_file, geocoded_file):
+    """
+    jitters one file. the store is memory-mapped, so every worker reads the
+    same copy of it
+    """
+    df = merge_geocoded_lat_lon(load_data(in_file), load_store(geocoded_file))
+    save_clean_df(add_jitter(df), out_file)
 
-    save_clean_df(JITTERED_DF, OUTFILE)
 
-    print(sys.argv[1], "jittered successfully")
+if __name__ == "__main__":
+    script_report(sys.argv)
+    FILES, WORKERS = parse_files(sys.argv[1:], "jitter crashes at the same spot")
+    if len(FILES) < 3:
+        raise SystemExit("needs a file, the geocoded file and an output file")
+
+    # compiled here the first time, then only memory-mapped by the workers
+    load_store(FILES[1])
+    PAIRS = [(FILES[0], FILES[2])] + file_pairs(FILES[3:])
+
+    run_files(jitter_file, PAIRS, WORKERS, {"geocoded_file": FILES[1]})
+    for IN_FILE, _ in PAIRS:
+        print(IN_FILE, "jittered successfully")
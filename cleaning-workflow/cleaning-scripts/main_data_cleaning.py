@@ -13,10 +13,24 @@ import pandas as pd
 import numpy as np
 import re
 
+# parquet or csv, depending on the file name
+from crash_schema import read_table, write_table, check_layout
+
+# how every source layout's columns are renamed
+from crash_schema import SOURCE_RENAMES
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
+
+
+# renaming columns to match with 2019-2022 field names
+rename_dict_13_18 = SOURCE_RENAMES["2013-2018"]
+rename_dict_03_15 = SOURCE_RENAMES["2003-2015"]
+
 
 def load_data(crash_file):
     """ returns a pandas dataframe of the raw dataset. """
-    return pd.read_csv(crash_file, encoding="unicode_escape")
+    return read_table(crash_file, encoding="unicode_escape")
 
 
 def rename_df(crash_df, rename_dict):
@@ -78,38 +92,18 @@ def add_bike_ped_flags(df):
 
 def save_clean_df(cleaned_df, out_file):
     """ save the cleaned df """
-    cleaned_df.to_csv(out_file, index=False)
+    write_table(cleaned_df, out_file)
 
 
 if __name__ == "__main__":
-
-    rename_dict_13_18 = {
-        "DATE": "Collision Date",
-        "TIME": "Collision Time",
-        "Trailers": "Trailers Involved",
-        "INJ": "Number Injured",
-        "DEAD": "Number Dead",
-        "DEER": "Number Deer",
-        "House#": "House Number",
-        "VEH#": "Vehicles Involved",
-        "Surf Con": "Surface Condition",
-        "Collision Type": "Manner of Collision",
-        "Rd Junction": "Roadway Junction Type",
-        "Weather": "Weather Conditions",
-        "Road Char": "Road Character",
-        "Surface": "Roadway Surface",
-        "CN Zone": "Construction?",
-        "Unique Id": "Unique Location Id",
-        "Intersect Rd.": "Intersecting Road",
-    }
-    rename_dict_03_15 = {"Collision Type": "Vehicles Involved"}
+    script_report(sys.argv)
 
     # DF_13_18 = load_data("./source-data/moco-crash-2013-2018.csv")
     # DF_03_15 = load_data("./source-data/moco-crash-2003-2015.csv")
     # OUTFILE_13_18 = "./data-output/standard-fields/moco-crash-2013-2018.csv"
     # OUTFILE_03_15 = "./data-output/standard-fields/moco-crash-2003-2015.csv"
-    DF_13_18 = load_data(sys.argv[1])
-    DF_03_15 = load_data(sys.argv[2])
+    DF_13_18 = check_layout(load_data(sys.argv[1]), "2013-2018", sys.argv[1])
+    DF_03_15 = check_layout(load_data(sys.argv[2]), "2003-2015", sys.argv[2])
     OUTFILE_13_18 = sys.argv[3]
     OUTFILE_03_15 = sys.argv[4]
 
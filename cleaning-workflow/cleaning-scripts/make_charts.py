@@ -0,0 +1,258 @@
+"""
+this script makes the csvs in data/charts from the master file.
+
+it first counts the crashes into one table (the "cube"), with a row for each
+combination of year, month, hour, severity, bike/ped involvement and primary
+factor that happened at least once, and then makes every chart csv from the
+cube. the cube is saved as `crash-cube.csv`, so charts can be remade (or new
+ones added) without reading the master file again.
+
+the charts show every year since 2003, so they have to be made from the
+full 2003-2022 master file: a master made from fewer years replaces the
+published charts with fewer years. (`pipeline.py` only saves them here when
+it has the older source files.)
+
+when a new year of data comes out, only that year has to be counted:
+    python make_charts.py --append "new-year-clean.csv" "charts-folder"
+replaces the years in the new file in the saved cube, and remakes the charts.
+
+input:
+    - data/clean-data/master-crashes.csv
+output:
+    - data/charts/crash-cube.csv
+    - data/charts/annual-fatalities.csv
+    - data/charts/annual-injuries.csv
+    - data/charts/bike-ped-deaths.csv
+    - data/charts/bike-ped-injuries.csv
+"""
+
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+# parquet or csv, depending on the file name
+from crash_schema import read_table, write_table, read_stage
+
+# the shared codes of `Primary Factor`, when it's loaded as a categorical
+from categories import category_codes
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
+
+CUBE_FILE = "crash-cube.csv"
+
+# the columns the cube is counted by
+DIMENSIONS = ["Year", "Month", "Hour", "Severity", "Bike/Ped", "Primary Factor"]
+MEASURES = ["Crashes", "Number Dead", "Number Injured"]
+
+# severity and bike/ped are bit flags, so they can be combined
+INJURY, FATAL = 1, 2
+CYCLIST, PEDESTRIAN = 1, 2
+
+
+# the bike/ped charts skip 2003-2005, which are outliers
+FIRST_BIKE_PED_YEAR = 2006
+
+
+def load_data(in_file):
+    """ returns only the columns the cube is built from """
+    return read_stage(in_file, "charts", low_memory=False)
+
+
+def is_true(df, col):
+    """ True/False flags from csvs (text) and parquet files (booleans) """
+    if col not in df:
+        return np.zeros(len(df), dtype=bool)
+    return df[col].astype(str).str.lower().eq("true").to_numpy()
+
+
+def build_cube(df):
+    """
+    counts the crashes, deaths and injuries for every combination of the
+    dimensions in a single pass: each row gets one integer code for its
+    combination, and the codes are counted with `np.bincount`
+    """
+    times = pd.to_datetime(df["DateTime"], errors="coerce")
+    dead = pd.to_numeric(df["Number Dead"], errors="coerce").fillna(0).to_numpy()
+    injured = pd.to_numeric(df["Number Injured"], errors="coerce").fillna(0).to_numpy()
+    known = times.notna().to_numpy()
+
+    year = times.dt.year.to_numpy()[known].astype(np.int64)
+    first_year = year.min() if len(year) else 0
+    severity = (injured > 0) * INJURY + (dead > 0) * FATAL
+    bike_ped = is_true(df, "Cyclist Involved") * CYCLIST
+    bike_ped += is_true(df, "Pedestrian Involved") * PEDESTRIAN
+    factor_codes, factors = category_codes(df["Primary Factor"])
+
+    codes = [
+        year - first_year,
+        times.dt.month.to_numpy()[known].astype(np.int64) - 1,
+        times.dt.hour.to_numpy()[known].astype(np.int64),
+        severity[known],
+        bike_ped[known],
+        factor_codes[known],
+    ]
+    shape = (year.max() - first_year + 1 if len(year) else 1, 12, 24, 4, 4)
+    shape += (max(len(factors), 1),)
+    flat = np.ravel_multi_index(codes, shape)
+
+    # only the combinations that actually happened
+    cells, inverse = np.unique(flat, return_inverse=True)
+    cube = pd.DataFrame(
+        dict(zip(DIMENSIONS, np.unravel_index(cells, shape))), dtype=np.int64
+    )
+    cube["Year"] += first_year
+    cube["Month"] += 1
+    cube["Primary Factor"] = np.asarray(factors, dtype=object)[cube["Primary Factor"]]
+    cube["Crashes"] = np.bincount(inverse, minlength=len(cells))
+    cube["Number Dead"] = np.bincount(inverse, dead[known], minlength=len(cells))
+    cube["Number Injured"] = np.bincount(inverse, injured[known], minlength=len(cells))
+    return cube
+
+
+def append_to_cube(cube, new_cube):
+    """ replaces the years in `new_cube` """
+    kept = cube[~cube["Year"].isin(new_cube["Year"].unique())]
+    return pd.concat([kept, new_cube], ignore_index=True).sort_values(
+        DIMENSIONS, ignore_index=True
+    )
+
+
+def update_cube(cube, added, removed):
+    """
+    adds the counts of the `added` cube and takes away the counts of the
+    `removed` one. combinations that are left without crashes are dropped
+    """
+    removed = removed.assign(**{col: -removed[col] for col in MEASURES})
+    cube = pd.concat([cube, added, removed], ignore_index=True)
+    cube = cube.groupby(DIMENSIONS, as_index=False, dropna=False)[MEASURES].sum()
+    return cube[cube["Crashes"] > 0].reset_index(drop=True)
+
+
+def yearly(cube, mask=None):
+    """ sums the measures of the cube (or part of it) for every year """
+    part = cube if mask is None else cube[mask]
+    return part.groupby("Year")[MEASURES].sum()
+
+
+def has(flags, flag):
+    return (flags & flag) > 0
+
+
+def annual_fatalities(cube):
+    totals = yearly(cube)
+    chart = totals[["Number Dead"]].assign(**{"Total Crashes": totals["Crashes"]})
+    # how many deaths for every 100 crashes
+    chart["Pct fatal"] = chart["Number Dead"] / chart["Total Crashes"] * 100
+    return chart.reset_index()
+
+
+def annual_injuries(cube):
+    totals = yearly(cube)
+    chart = totals[["Number Injured"]].assign(**{"Total Crashes": totals["Crashes"]})
+    # how many injuries for every 100 crashes
+    chart["Pct injured"] = chart["Number Injured"] / chart["Total Crashes"] * 100
+    return chart.reset_index()
+
+
+def bike_ped_totals(cube, severity):
+    """
+    the yearly bike/ped crashes with the given severity, next to all
+    bike/ped crashes and all crashes. only years that had any are kept
+    """
+    cube = cube[cube["Year"] >= FIRST_BIKE_PED_YEAR]
+    bike_ped = cube["Bike/Ped"] > 0
+    totals = yearly(cube)
+    chart = pd.DataFrame(
+        {
+            "Bike/ped": yearly(cube, bike_ped & has(cube["Severity"], severity))[
+                "Crashes"
+            ],
+            "Total bike/ped crashes": yearly(cube, bike_ped)["Crashes"],
+            "Total crashes": totals["Crashes"],
+            "Total injuries": totals["Number Injured"],
+            "Total deaths": totals["Number Dead"],
+        }
+    )
+    return chart[chart["Bike/ped"] > 0].astype({"Bike/ped": int})
+
+
+def bike_ped_deaths(cube):
+    chart = bike_ped_totals(cube, FATAL).rename(columns={"Bike/ped": "Bike/ped deaths"})
+    chart["bike/ped_death_pct"] = (
+        chart["Bike/ped deaths"] / chart["Total bike/ped crashes"] * 100
+    )
+    chart["all_death_pct"] = chart["Total deaths"] / chart["Total crashes"] * 100
+    return chart[
+        [
+            "Bike/ped deaths",
+            "Total bike/ped crashes",
+            "Total crashes",
+            "Total deaths",
+            "bike/ped_death_pct",
+            "all_death_pct",
+        ]
+    ].reset_index()
+
+
+def bike_ped_injuries(cube):
+    chart = bike_ped_totals(cube, INJURY).rename(
+        columns={"Bike/ped": "Bike/ped injuries"}
+    )
+    chart["bike/ped_pct"] = (
+        chart["Bike/ped injuries"] / chart["Total bike/ped crashes"] * 100
+    )
+    chart["all_injuries_pct"] = chart["Total injuries"] / chart["Total crashes"] * 100
+    return chart[
+        [
+            "Bike/ped injuries",
+            "Total bike/ped crashes",
+            "Total crashes",
+            "Total injuries",
+            "bike/ped_pct",
+            "all_injuries_pct",
+            "Total deaths",
+        ]
+    ].reset_index()
+
+
+CHARTS = {
+    "annual-fatalities.csv": annual_fatalities,
+    "annual-injuries.csv": annual_injuries,
+    "bike-ped-deaths.csv": bike_ped_deaths,
+    "bike-ped-injuries.csv": bike_ped_injuries,
+}
+
+
+# the bike/ped charts have always had the row numbers as their first column
+NUMBERED_CHARTS = ["bike-ped-deaths.csv", "bike-ped-injuries.csv"]
+
+
+def save_charts(cube, out_dir):
+    """ saves the cube and every chart made from it """
+    os.makedirs(out_dir, exist_ok=True)
+    write_table(cube, os.path.join(out_dir, CUBE_FILE))
+    for name, make_chart in CHARTS.items():
+        make_chart(cube).to_csv(
+            os.path.join(out_dir, name), index=name in NUMBERED_CHARTS
+        )
+
+
+def load_cube(out_dir):
+    return read_table(os.path.join(out_dir, CUBE_FILE), keep_default_na=False)
+
+
+if __name__ == "__main__":
+    script_report(sys.argv)
+    if sys.argv[1] == "--append":
+        OUT_DIR = sys.argv[3]
+        CUBE = append_to_cube(load_cube(OUT_DIR), build_cube(load_data(sys.argv[2])))
+    else:
+        OUT_DIR = sys.argv[2]
+        CUBE = build_cube(load_data(sys.argv[1]))
+
+    save_charts(CUBE, OUT_DIR)
+
+    print(len(CUBE), "cube rows and", len(CHARTS), "charts saved to", OUT_DIR)
@@ -0,0 +1,198 @@
+"""
+this script saves the same three map layers as make_geojson.py (deaths,
+injuries and nonfatal crashes) in a compact binary format that the
+dashboard can load straight into typed arrays, without parsing any json.
+
+each file is:
+    - 4 bytes: the length of the header (little-endian uint32)
+    - the header: json describing the columns, padded with spaces
+    - the columns, one after the other, each starting at a multiple of 8 bytes
+
+the header has the number of crashes, and for every column its name, numpy
+type, byte offset (from the start of the file) and how to decode it:
+    - `lat`/`lon` are int32 millionths of a degree (multiply by `scale`)
+    - `dt` is int32 minutes since 1970-01-01, the same time zone as DateTime
+    - `r`, `r2`, `f` and `m` are indexes into the column's `dictionary`.
+      `f` and `m` use the shared dictionaries in `data/categories.json`, so
+      their codes don't change between releases
+    - the counts (`i`, `d`, `v`) and flags (`c`, `p`) are small ints
+every column uses `missing` (-1) for empty values.
+
+input:
+    - data/clean-data/jittered/master-crashes-jittered.csv
+output:
+    - master-deaths.bin, master-injuries.bin and master-nonfatal.bin
+"""
+
+import os
+import sys
+import json
+
+import numpy as np
+import pandas as pd
+
+# the same records and layers as the geojson
+from make_geojson import LAYERS, PROPERTIES, load_data, prepare, severity
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
+
+# coordinates are stored in millionths of a degree, the same as the geojson
+COORDINATE_SCALE = 1e-6
+
+MISSING = -1
+
+# dictionary encoded text columns
+CATEGORICAL = ["r", "r2", "f", "m"]
+# small whole numbers
+COUNTS = ["i", "d", "v"]
+# true/false
+FLAGS = ["c", "p"]
+
+ALIGNMENT = 8
+
+BOOLEAN_VALUES = {True: 1, False: 0, "True": 1, "False": 0, "true": 1, "false": 0}
+
+
+def coordinate_column(col):
+    """ int32 millionths of a degree """
+    values = pd.to_numeric(col, errors="coerce") / COORDINATE_SCALE
+    return values.round().fillna(MISSING).to_numpy(dtype=np.int32), {
+        "scale": COORDINATE_SCALE
+    }
+
+
+def time_column(col):
+    """ int32 minutes since 1970 """
+    times = pd.to_datetime(col, errors="coerce")
+    minutes = times.to_numpy(dtype="datetime64[m]").astype(np.int64)
+    minutes[times.isna().to_numpy()] = MISSING
+    return minutes.astype(np.int32), {"unit": "minutes since 1970-01-01"}
+
+
+def categorical_column(col):
+    """ the smallest int type that fits the codes, and the dictionary """
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        # the shared codes, the same in every release
+        codes, uniques = col.cat.codes.to_numpy(), col.cat.categories
+    else:
+        codes, uniques = pd.factorize(col, sort=True)
+    dtype = np.int16 if len(uniques) < np.iinfo(np.int16).max else np.int32
+    return codes.astype(dtype), {"dictionary": [str(value) for value in uniques]}
+
+
+def count_column(col):
+    values = pd.to_numeric(col, errors="coerce").round()
+    return values.fillna(MISSING).to_numpy(dtype=np.int16), {}
+
+
+def flag_column(col):
+    values = col.map(BOOLEAN_VALUES).astype("float")
+    return values.fillna(MISSING).to_numpy(dtype=np.int8), {}
+
+
+def encode_column(df, name):
+    """ returns the array and the decoding details for one column """
+    if name not in df:
+        col = pd.Series(np.nan, index=df.index)
+    else:
+        col = df[name]
+    if name in ("Latitude", "Longitude"):
+        return coordinate_column(col)
+    if name == "dt":
+        return time_column(col)
+    if name in CATEGORICAL:
+        return categorical_column(col)
+    if name in COUNTS:
+        return count_column(col)
+    return flag_column(col)
+
+
+def padding(size):
+    return -size % ALIGNMENT
+
+
+def save_columnar(df, out_file, properties):
+    """ writes one layer of a prepared df. returns the number of bytes """
+    columns = {"lat": "Latitude", "lon": "Longitude"}
+    columns.update({name: name for name in properties})
+    arrays = {}
+    header = {"count": len(df), "missing": MISSING, "columns": []}
+    for short, name in columns.items():
+        values, details = encode_column(df, name)
+        arrays[short] = values
+        header["columns"].append(
+            {"name": short, "type": values.dtype.name, "offset": 0, **details}
+        )
+
+    # the offsets depend on the header's size, which depends on the offsets,
+    # so leave room for them by writing the header with the largest offset
+    for column in header["columns"]:
+        column["offset"] = 2 ** 32 - 1
+    header_size = 4 + len(json.dumps(header, separators=(",", ":")).encode())
+    header_size += padding(header_size)
+
+    offset = header_size
+    for column in header["columns"]:
+        column["offset"] = offset
+        size = arrays[column["name"]].nbytes
+        offset += size + padding(size)
+
+    encoded_header = json.dumps(header, separators=(",", ":")).encode()
+    encoded_header += b" " * (header_size - 4 - len(encoded_header))
+    with open(out_file, "wb") as f:
+        f.write(np.uint32(len(encoded_header)).tobytes())
+        f.write(encoded_header)
+        for column in header["columns"]:
+            values = arrays[column["name"]].astype(column["type"], copy=False)
+            # typed arrays are always little-endian in the browser
+            data = values.astype(values.dtype.newbyteorder("<")).tobytes()
+            f.write(data + b"\0" * padding(len(data)))
+    return offset
+
+
+def read_columnar(in_file):
+    """ reads a file back into a dict of decoded numpy arrays """
+    with open(in_file, "rb") as f:
+        data = f.read()
+    header_size = int(np.frombuffer(data[:4], dtype="<u4")[0])
+    header = json.loads(data[4 : 4 + header_size])
+    columns = {}
+    for column in header["columns"]:
+        values = np.frombuffer(
+            data,
+            dtype=np.dtype(column["type"]).newbyteorder("<"),
+            count=header["count"],
+            offset=column["offset"],
+        )
+        if "scale" in column:
+            values = np.where(values == MISSING, np.nan, values * column["scale"])
+        elif "dictionary" in column:
+            dictionary = np.array(column["dictionary"] + [None], dtype=object)
+            values = dictionary[values]
+        columns[column["name"]] = values
+    return columns
+
+
+def save_layers(df, out_dir):
+    """ writes every layer of a prepared df. returns the bytes in each file """
+    os.makedirs(out_dir, exist_ok=True)
+    layer = severity(df)
+    return {
+        name: save_columnar(
+            df[layer == i],
+            os.path.join(out_dir, "master-%s.bin" % name),
+            PROPERTIES[name],
+        )
+        for i, name in enumerate(LAYERS)
+    }
+
+
+if __name__ == "__main__":
+    script_report(sys.argv)
+    DF = load_data(sys.argv[1])
+    OUT_DIR = sys.argv[2]
+
+    SIZES = save_layers(prepare(DF), OUT_DIR)
+
+    print("binary layers saved to", OUT_DIR, SIZES)
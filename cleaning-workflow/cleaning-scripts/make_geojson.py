@@ -4,19 +4,63 @@ it outputs three geojsons:
 1. fatal crashes only
 2. crashes resulting in injury only
 3. crashes that didn't result in fatalities or injuries
+
+the input is read in chunks and every crash is written straight to the file
+for its severity, so memory use doesn't grow with the number of crashes.
+each column is turned into json text once per chunk (and each distinct
+value only once), then the features are put together from those pieces.
+
+it can also split the three layers into map tiles, so the map only has to
+download the tiles it is showing:
+    python make_geojson.py --tiles "in-file" "out-folder"
+this writes `out-folder/<layer>/<z>/<x>/<y>.geojson` for zooms 10 to 16, and
+a `manifest.json` that lists every tile and how many crashes it has. below
+the highest zoom, tiles with more than `MAX_TILE_FEATURES` crashes only keep
+that many of them. the same crashes are kept on every run, and a crash that
+is kept at one zoom is kept at every higher zoom too.
 """
 
+import os
 import sys
+import json
 
+import numpy as np
 import pandas as pd
 
-from pandas_geojson import to_geojson
-from pandas_geojson import write_geojson
+# parquet or csv, depending on the file name
+from crash_schema import read_stage, read_chunks, stage_columns
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report, record
+
+# rows read at a time
+CHUNK_SIZE = 100_000
+
+# the three files, in the order they are given on the command line
+LAYERS = ["deaths", "injuries", "nonfatal"]
+
+PROPERTIES = {
+    "deaths": ["i", "d", "v", "r", "r2", "f", "m", "dt", "c", "p"],
+    # remove the "d" death category bc there are no deaths in this layer
+    "injuries": ["i", "v", "r", "r2", "f", "m", "dt", "c", "p"],
+    # remove the "d" death and "i" injuries categories bc
+    # this layer only includes rows w/o these fields
+    "nonfatal": ["v", "r", "r2", "f", "m", "dt", "c", "p"],
+}
+
+# the zoom levels of the map tiles. Monroe County fits in 4 tiles at zoom 10
+MIN_ZOOM = 10
+MAX_ZOOM = 16
+# crashes per tile below MAX_ZOOM, so zoomed out tiles stay small
+MAX_TILE_FEATURES = 1000
+
+# missing values are written as empty strings, the same as `fillna("")`
+MISSING = '""'
 
 
 def load_data(in_file):
-    """ returns a pandas dataframe of the raw dataset """
-    return pd.read_csv(in_file, low_memory=False)
+    """ returns only the columns that end up on the map """
+    return read_stage(in_file, "map", low_memory=False)
 
 
 def drop_out_of_bounds_points(map_df):
@@ -41,66 +85,232 @@ def minimize_field_names(df):
         "Cyclist Involved": "c",
         "Pedestrian Involved": "p",
     }
-    return df.rename(rename_dict)
-
-
-def round_digits(coord):
-    return round(coord, 6)
+    return df.rename(columns=rename_dict)
 
 
 def round_lat_lon(df):
-    df[["Latitude", "Longitude"]] = df[["Latitude", "Longitude"]].apply(round_digits)
+    df[["Latitude", "Longitude"]] = df[["Latitude", "Longitude"]].round(6)
     return df
 
 
-def save_deaths(df, outfile):
-    deaths = df["d" > 0]
-    death_geo_json = to_geojson(
-        df=df[deaths].fillna(""),
-        lat="Latitude",
-        lon="Longitude",
-        properties=["i", "d", "v", "r", "r2", "f", "m", "dt", "c", "p"],
-    )
-    write_geojson(death_geo_json, filename=outfile)
-
-
-def save_injuries(df, outfile):
-    deaths = df["d" > 0]
-    injuries = df["i" > 0]
-    injuries_geojson = to_geojson(
-        df=df[~deaths][injuries].fillna(""),
-        lat="Latitude",
-        lon="Longitude",
-        # remove the "d" death category bc there are no deaths in this df
-        properties=["i", "v", "r", "r2", "f", "m", "dt", "c", "p"],
-    )
-    write_geojson(injuries_geojson, filename=outfile)
-
-
-def save_nonfatal(df, outfile):
-    deaths = df["d" > 0]
-    injuries = df["i" > 0]
-    nonfatal_geojson = to_geojson(
-        df=df[~deaths][~injuries].fillna(""),
-        lat="Latitude",
-        lon="Longitude",
-        # remove the "d" death and "i" injuries categories bc
-        # this df only includes rows w/o these fields
-        properties=["v", "r", "r2", "f", "m", "dt", "c", "p"],
+def prepare(df):
+    """ the bounds-filtered, rounded and renamed records that get mapped """
+    return minimize_field_names(round_lat_lon(drop_out_of_bounds_points(df)))
+
+
+def severity(df):
+    """ returns the index in `LAYERS` of each crash's file """
+    deaths = pd.to_numeric(df["d"], errors="coerce").to_numpy() > 0
+    injuries = pd.to_numeric(df["i"], errors="coerce").to_numpy() > 0
+    return np.select([deaths, injuries], [0, 1], 2)
+
+
+def to_json(value):
+    """ json text of one value. numpy numbers and bools become plain python """
+    return json.dumps(value.item() if isinstance(value, np.generic) else value)
+
+
+def encode_values(col):
+    """
+    returns the json text of every value in a column, as an object array.
+    each distinct value is only encoded once
+    """
+    if pd.api.types.is_datetime64_any_dtype(col):
+        col = col.dt.strftime("%Y-%m-%d %H:%M:%S")
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        # the shared dictionary already has each value once
+        codes, uniques = col.cat.codes.to_numpy(), col.cat.categories
+    else:
+        codes, uniques = pd.factorize(col)
+    # code -1 (missing) picks the last entry
+    encoded = np.array([to_json(value) for value in uniques] + [MISSING], dtype=object)
+    return encoded[codes]
+
+
+def encode_columns(df):
+    """ encodes the coordinates and every property a layer can have """
+    encoded = {}
+    for name in ["Latitude", "Longitude"] + PROPERTIES["deaths"]:
+        if name in df:
+            encoded[name] = encode_values(df[name])
+        else:
+            encoded[name] = np.full(len(df), MISSING, dtype=object)
+    return encoded
+
+
+def encode_features(encoded, properties):
+    """ puts the encoded columns together into one geojson feature per row """
+    features = '{"type":"Feature","properties":{'
+    for i, name in enumerate(properties):
+        features = features + ("," if i else "") + '"%s":' % name + encoded[name]
+    return (
+        features
+        + '},"geometry":{"type":"Point","coordinates":['
+        + encoded["Longitude"]
+        + ","
+        + encoded["Latitude"]
+        + "]}}"
     )
-    write_geojson(nonfatal_geojson, filename=outfile)
 
 
-if __name__ == "__main__":
-    DF = load_data(sys.argv[1])
-    OUTFILE_DEATHS = sys.argv[2]
-    OUTFILE_INJURIES = sys.argv[3]
-    OUTFILE_NONFATAL = sys.argv[4]
+class GeoJSONWriter:
+    """
+    writes a FeatureCollection one batch of encoded features at a time. with
+    `append`, adds the features to the end of a file it wrote before
+    """
+
+    def __init__(self, path, append=False):
+        self.rows = 0
+        # written before the next batch of features
+        self.separator = ""
+        if append:
+            # cut off the closing `]}`, and write after the last feature
+            with open(path, "rb+") as f:
+                f.seek(-3, os.SEEK_END)
+                if f.read(1) != b"[":
+                    self.separator = ","
+                f.truncate(f.tell())
+            self.file = open(path, "a")
+        else:
+            self.file = open(path, "w")
+            self.file.write('{"type":"FeatureCollection","features":[')
+
+    def write(self, features):
+        if len(features):
+            self.file.write(self.separator + ",".join(features))
+            self.separator = ","
+            self.rows += len(features)
+
+    def close(self):
+        self.file.write("]}")
+        self.file.close()
+
+
+def write_layers(df, writers):
+    """ routes every row of a prepared df to the writer for its severity """
+    encoded = encode_columns(df)
+    layer = severity(df)
+    for i, (name, writer) in enumerate(zip(LAYERS, writers)):
+        rows = layer == i
+        writer.write(
+            encode_features(
+                {key: values[rows] for key, values in encoded.items()},
+                PROPERTIES[name],
+            )
+        )
+
+
+def save_geojson(df, out_files):
+    """ saves a prepared df to the deaths, injuries and nonfatal files """
+    writers = [GeoJSONWriter(out_file) for out_file in out_files]
+    write_layers(df, writers)
+    for writer in writers:
+        writer.close()
+    return [writer.rows for writer in writers]
+
+
+def stream_geojson(in_file, out_files, chunk_size=CHUNK_SIZE):
+    """
+    makes the three files in a single pass over the input, one chunk at a
+    time. returns the number of crashes in each file
+    """
+    writers = [GeoJSONWriter(out_file) for out_file in out_files]
+    usecols = stage_columns(in_file, "map")
+    for chunk in read_chunks(in_file, chunk_size, usecols=usecols, low_memory=False):
+        write_layers(prepare(chunk), writers)
+    for writer in writers:
+        writer.close()
+    return [writer.rows for writer in writers]
+
 
-    MIN_DF = minimize_field_names(round_lat_lon(drop_out_of_bounds_points(DF)))
+def tile_xy(lat, lon, zoom):
+    """ returns the web mercator x/y of the tile each point is in """
+    n = 2 ** zoom
+    x = np.floor((lon + 180) / 360 * n).astype(int)
+    y = np.floor((1 - np.arcsinh(np.tan(np.radians(lat))) / np.pi) / 2 * n)
+    return x, y.astype(int)
+
+
+def tile_priority(df):
+    """
+    returns a repeatable, random looking rank for every crash. zoomed out
+    tiles keep the crashes with the lowest ranks
+    """
+    return pd.util.hash_pandas_object(
+        df[["Latitude", "Longitude", "dt"]].astype(str), index=False
+    ).to_numpy()
+
+
+def save_tiles(
+    df, out_dir, min_zoom=MIN_ZOOM, max_zoom=MAX_ZOOM, max_features=MAX_TILE_FEATURES
+):
+    """
+    splits every layer of a prepared df into a z/x/y pyramid of geojson tiles,
+    and writes a manifest of the tiles. returns the manifest
+    """
+    encoded = encode_columns(df)
+    layer = severity(df)
+    manifest = {
+        "minzoom": min_zoom,
+        "maxzoom": max_zoom,
+        "max_features": max_features,
+        "layers": {},
+    }
+    for i, name in enumerate(LAYERS):
+        rows = layer == i
+        features = encode_features(
+            {key: values[rows] for key, values in encoded.items()}, PROPERTIES[name]
+        )
+        # the lowest ranks first, so each tile's first rows are the ones it keeps
+        order = np.argsort(tile_priority(df[rows]), kind="stable")
+        features = features[order]
+        lat = df["Latitude"].to_numpy(dtype=float)[rows][order]
+        lon = df["Longitude"].to_numpy(dtype=float)[rows][order]
+
+        tiles = {}
+        for zoom in range(min_zoom, max_zoom + 1):
+            x, y = tile_xy(lat, lon, zoom)
+            tile = pd.DataFrame({"x": x, "y": y})
+            if zoom < max_zoom:
+                rank = tile.groupby(["x", "y"], sort=False).cumcount().to_numpy()
+                kept = rank < max_features
+            else:
+                kept = np.ones(len(tile), dtype=bool)
+            kept_features = features[kept]
+            groups = tile[kept].groupby(["x", "y"], sort=True).indices
+            for (tile_x, tile_y), positions in groups.items():
+                folder = os.path.join(out_dir, name, str(zoom), str(tile_x))
+                os.makedirs(folder, exist_ok=True)
+                writer = GeoJSONWriter(os.path.join(folder, "%d.geojson" % tile_y))
+                writer.write(kept_features[positions])
+                writer.close()
+                tiles["%d/%d/%d" % (zoom, tile_x, tile_y)] = len(positions)
+        manifest["layers"][name] = {"features": int(rows.sum()), "tiles": tiles}
+
+    with open(os.path.join(out_dir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, separators=(",", ":"))
+    return manifest
+
+
+if __name__ == "__main__":
+    script_report(sys.argv)
+    if sys.argv[1] == "--tiles":
+        MANIFEST = save_tiles(prepare(load_data(sys.argv[2])), sys.argv[3])
+        TILES = sum(len(layer["tiles"]) for layer in MANIFEST["layers"].values())
+        print(TILES, "tiles saved to", sys.argv[3])
+    else:
+        IN_FILE = sys.argv[1]
+        OUTFILE_DEATHS = sys.argv[2]
+        OUTFILE_INJURIES = sys.argv[3]
+        OUTFILE_NONFATAL = sys.argv[4]
 
-    save_deaths(MIN_DF, OUTFILE_DEATHS)
-    save_injuries(MIN_DF, OUTFILE_INJURIES)
-    save_nonfatal(MIN_DF, OUTFILE_NONFATAL)
+        # streamed, so the whole file is one step of the report
+        COUNTS = record(
+            os.path.basename(IN_FILE),
+            "file",
+            stream_geojson,
+            IN_FILE,
+            [OUTFILE_DEATHS, OUTFILE_INJURIES, OUTFILE_NONFATAL],
+        )
 
-    print("geojson saved successfully")
+        print("geojson saved successfully:", dict(zip(LAYERS, COUNTS)))
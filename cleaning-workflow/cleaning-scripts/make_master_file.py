@@ -24,145 +24,183 @@ master dataset as exact numbers. instead, more specific analysis should
 be based on the specific 2003-2015 file, not the master file.
 """
 
+import os
 import sys
 
 import pandas as pd
 
+# parquet or csv, depending on the file name
+from crash_schema import read_table, write_table
+from crash_schema import read_columns, read_chunks, TableWriter
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report, record
+
 
 def load_data(in_file):
     """ returns a pandas dataframe of the raw dataset """
-    return pd.read_csv(in_file, low_memory=False)
+    return read_table(in_file, low_memory=False)
+
+
+# uncomparable or unuseful columns
+DROPPED_COLS = [
+    "Collision Date",
+    "Collision Time",
+    "House Number",
+    "Roadway Interchange",
+    "Roadway Ramp",
+    "Interchange",
+    "Feet From",
+    "Direction",
+    "Construction Type",
+    "Type of Median",
+    "_id",
+    "Traffic Control",
+    "_id",
+    "Agency",
+    "City",
+    "Trailers Involved",
+    "Number Deer",
+    "Roadway Class",
+    "Hit and Run?",
+    "Locality",
+    "School Zone?",
+    "Rumble Strips?",
+    "Construction?",
+    "Roadway Junction Type",
+    "Road Character",
+    "Roadway Surface",
+    "Ramp",
+    "Property Type",
+    "Dir",
+    "Road Class",
+    "H&R",
+    "School ",
+    "Light",
+    "Median",
+    "Rumble Strips",
+    "Master Record Number",
+    "CN Type",
+    "Unique Location Id",
+    "Light Condition",
+    "Weather Conditions",
+    "Surface Condition",
+    "Local Code",
+    "County",
+    "Township",
+    "Roadway Suffix",
+    "Roadway Name",
+    "Roadway Number",
+    "Intersecting Road Number",
+    "Mile Marker",
+    "Corporate Limits",
+    "Traffic Control Devices?",
+    "Aggressive Driving?",
+    "Damage Estimate",
+    "State Property Damage?",
+    "Corporate Limits?",
+    # added by canonicalize_streets.py
+    "Roadway Id Match Confidence",
+    "Intersecting Road Match Confidence",
+]
 
 
 def drop_cols(df):
     """ drops uncomparable or unuseful columns. keeps cols useful for mapping """
-    cols_to_drop = [
-        "Collision Date",
-        "Collision Time",
-        "House Number",
-        "Roadway Interchange",
-        "Roadway Ramp",
-        "Interchange",
-        "Feet From",
-        "Direction",
-        "Construction Type",
-        "Type of Median",
-        "_id",
-        "Traffic Control",
-        "_id",
-        "Agency",
-        "City",
-        "Trailers Involved",
-        "Number Deer",
-        "Roadway Class",
-        "Hit and Run?",
-        "Locality",
-        "School Zone?",
-        "Rumble Strips?",
-        "Construction?",
-        "Roadway Junction Type",
-        "Road Character",
-        "Roadway Surface",
-        "Ramp",
-        "Property Type",
-        "Dir",
-        "Road Class",
-        "H&R",
-        "School ",
-        "Light",
-        "Median",
-        "Rumble Strips",
-        "Master Record Number",
-        "CN Type",
-        "Unique Location Id",
-        "Light Condition",
-        "Weather Conditions",
-        "Surface Condition",
-        "Local Code",
-        "County",
-        "Township",
-        "Roadway Suffix",
-        "Roadway Name",
-        "Roadway Number",
-        "Intersecting Road Number",
-        "Mile Marker",
-        "Corporate Limits",
-        "Traffic Control Devices?",
-        "Aggressive Driving?",
-        "Damage Estimate",
-        "State Property Damage?",
-        "Corporate Limits?",
-    ]
-    return df.drop(cols_to_drop, axis=1, errors="ignore")
-
-
-def get_year(date):
-    return pd.to_datetime(date).year
+    return df.drop(DROPPED_COLS, axis=1, errors="ignore")
 
 
-def drop_duplicate_years(df):
-    df["Year"] = df["DateTime"].apply(get_year)
-    return df[df["Year"] < 2013].drop(columns=["Year"])
+# the 2003-2015 data has an `Injury Type` column instead of counts
+ESTIMATE_COLS = ["Injury Type", "Vehicles Involved"]
 
+# the Injury Type / Vehicles Involved values that count as 1 (or more)
+FATALITY_ESTIMATES = {"Fatal": 1}
+INJURY_ESTIMATES = {"Non-incapacitating": 1, "Incapacitating": 1}
+VEHICLE_ESTIMATES = {"1-Car": 1, "2-Car": 2, "3+ Cars": 3}
 
-def injury_estimate(string):
-    if string == "Non-incapacitating":
-        return 1
-    elif string == "Incapacitating":
-        return 1
-    else:
-        return 0
+# rows read at a time when streaming the master file
+CHUNK_SIZE = 100_000
 
 
-def fatality_estimate(string):
-    if string == "Fatal":
-        return 1
-    else:
-        return 0
+def is_0315(columns):
+    """ the 2003-2015 file is the only one with an `Injury Type` column """
+    return "Injury Type" in columns
+
+
+def drop_duplicate_years(df):
+    """ drops 2013 and later, which the newer files cover with exact counts """
+    years = pd.to_datetime(df["DateTime"]).dt.year
+    return df[years < 2013]
 
 
-def num_vehicle_estimate(string):
-    if string == "1-Car":
-        return 1
-    elif string == "2-Car":
-        return 2
-    elif string == "3+ Cars":
-        return 3
-    else:
-        return 0
+def estimate(col, estimates):
+    return col.map(estimates).fillna(0).astype(int)
 
 
 def estimate_fields(df):
-    df["Number Dead"] = df["Injury Type"].apply(fatality_estimate)
-    df["Number Injured"] = df["Injury Type"].apply(injury_estimate)
-    df["Vehicles Involved"] = df["Vehicles Involved"].apply(num_vehicle_estimate)
+    df["Number Dead"] = estimate(df["Injury Type"], FATALITY_ESTIMATES)
+    df["Number Injured"] = estimate(df["Injury Type"], INJURY_ESTIMATES)
+    df["Vehicles Involved"] = estimate(df["Vehicles Involved"], VEHICLE_ESTIMATES)
     return df.drop(columns=["Injury Type", "Vehicles Involved"])
 
 
+def master_columns(in_files):
+    """
+    returns the columns each file needs to be read with, and the columns of
+    the master file: every kept column, in the order they first appear
+    """
+    cols_to_drop = set(DROPPED_COLS)
+    usecols = {}
+    out_cols = []
+    for in_file in in_files:
+        columns = read_columns(in_file)
+        keep = [col for col in columns if col not in cols_to_drop]
+        if is_0315(columns):
+            estimated = [col for col in ESTIMATE_COLS if col not in keep]
+            usecols[in_file] = keep + [col for col in estimated if col in columns]
+            keep = [col for col in keep if col not in ESTIMATE_COLS]
+            keep += ["Number Dead", "Number Injured"]
+        else:
+            usecols[in_file] = keep
+        out_cols += [col for col in keep if col not in out_cols]
+    return usecols, out_cols
+
+
+def stream_master(in_files, out_file, chunk_size=CHUNK_SIZE):
+    """
+    builds the master file one chunk at a time, only reading the columns it
+    keeps, so memory stays flat no matter how big the source files are.
+    returns the number of rows written.
+    """
+    usecols, out_cols = master_columns(in_files)
+    writer = TableWriter(out_file, out_cols)
+    for in_file in in_files:
+        columns = usecols[in_file]
+        for chunk in read_chunks(
+            in_file, chunk_size, usecols=columns, low_memory=False
+        ):
+            if is_0315(columns):
+                chunk = estimate_fields(drop_duplicate_years(chunk))
+            writer.write(chunk)
+    writer.close()
+    return writer.rows
+
+
 def combine_dfs(df_list):
     return pd.concat(df_list)
 
 
 def save_clean_df(cleaned_df, out_file):
     """ save the master df """
-    cleaned_df.to_csv(out_file, index=False)
+    write_table(cleaned_df, out_file)
 
 
 if __name__ == "__main__":
+    script_report(sys.argv)
     DFS = sys.argv[1:-1]
     OUTFILE = sys.argv[-1]
 
-    CLEAN_DFS = list(map(load_data, DFS))
-
-    for i, df in enumerate(CLEAN_DFS):
-        """if it's the 2003-2015 data, drop duplicate years and add death/injury estimates"""
-        if "2011-03-06 18:00:00" in set(df["DateTime"]):
-            CLEAN_DFS[i] = estimate_fields(drop_duplicate_years(df))
-
-    CLEAN_DFS = list(map(drop_cols, CLEAN_DFS))
-
-    master = combine_dfs(CLEAN_DFS)
-
-    save_clean_df(master, OUTFILE)
+    # streamed, so the whole file is one step of the report
+    ROWS = record(os.path.basename(OUTFILE), "file", stream_master, DFS, OUTFILE)
 
-    print("master file saved successfully")
+    print("master file saved successfully,", ROWS, "rows")
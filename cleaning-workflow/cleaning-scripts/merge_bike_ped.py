@@ -1,28 +1,172 @@
-""" 
+"""
 this script adds bike and ped columns to the data from 2013-2018
 the source data for the bike/ped crashes is from the city
+
+a crash is marked as a bike or ped crash when a city report has a DateTime
+within `TOLERANCE` of it, and (when both have coordinates) is less than
+`MAX_DISTANCE` meters away. each city report marks at most one crash, the
+closest match. a confidence column says how good the match was: 1 is the
+same minute and place, lower values are further apart in time or space.
+
+the bike and ped files are indexed once, so any number of yearly files can
+be tagged in one run, spread over `--workers` processes:
+    python merge_bike_ped.py "main-file" "bike-file" "ped-file" "output-file" /
+        "main-file-2" "output-file-2" ... --workers 4
 """
 import sys
 import os
+from collections import namedtuple
 
+import numpy as np
 import pandas as pd
 
+# parquet or csv, depending on the file name
+from crash_schema import read_table, write_table, read_stage
+
+# flat-earth distances are plenty at this scale
+from intersection_index import METERS_PER_DEGREE
+
+# many files at once, in a pool of processes
+from parallel_files import parse_files, file_pairs, run_files
+
+# `--report FILE` records the run, see run_report.py
+from run_report import script_report
+
+# how far apart the crash and the city report can be
+TOLERANCE = pd.Timedelta(minutes=2)
+MAX_DISTANCE = 250
+
+CONFIDENCE_COLS = {
+    "Cyclist Involved": "Cyclist Match Confidence",
+    "Pedestrian Involved": "Pedestrian Match Confidence",
+}
+
+# city reports sorted by time, with their coordinates
+CrashIndex = namedtuple("CrashIndex", ["times", "latitude", "longitude"])
+
 
 def load_data(file):
     """ returns a pandas dataframe of a csv. """
-    return pd.read_csv(file, encoding="unicode_escape")
+    return read_table(file, encoding="unicode_escape")
+
+
+def load_reports(file):
+    """ returns only the columns the bike/ped reports are matched by """
+    return read_stage(file, "bike_ped_reports", encoding="unicode_escape")
+
+
+def to_nanoseconds(col):
+    """ returns DateTime as int64 nanoseconds, and which values were readable """
+    times = pd.to_datetime(col, errors="coerce")
+    return times.to_numpy(dtype="datetime64[ns]").astype(np.int64), times.notna().to_numpy()
+
+
+def coordinates(df):
+    """ returns lat/lon arrays. 0/0 and missing values become nan """
+    lat = pd.to_numeric(df["Latitude"], errors="coerce").to_numpy(dtype=float)
+    lon = pd.to_numeric(df["Longitude"], errors="coerce").to_numpy(dtype=float)
+    missing = (lat == 0) | (lon == 0)
+    return np.where(missing, np.nan, lat), np.where(missing, np.nan, lon)
+
 
+def build_index(df):
+    """ returns a CrashIndex of the bike or ped reports """
+    times, readable = to_nanoseconds(df["DateTime"])
+    lat, lon = coordinates(df)
+    order = np.argsort(times[readable], kind="stable")
+    return CrashIndex(
+        times[readable][order], lat[readable][order], lon[readable][order]
+    )
 
-def merge(main_df, df_to_merge, new_col_name):
-    """merges the bike or ped data wtih the original csv"""
-    dates = df_to_merge["DateTime"].reset_index()
-    dates[new_col_name] = True
-    return main_df.merge(dates, how="left", on="DateTime")
+
+def distances(lat1, lon1, lat2, lon2):
+    """ meters between two sets of points. nan if either is missing """
+    dy = (lat1 - lat2) * METERS_PER_DEGREE
+    dx = (lon1 - lon2) * METERS_PER_DEGREE * np.cos(np.radians(lat1))
+    return np.hypot(dx, dy)
+
+
+def candidates(times, index, tolerance):
+    """
+    returns every (crash row, index position) pair within `tolerance` of
+    each other, found with a binary search on the sorted index
+    """
+    tolerance = tolerance.value
+    first = np.searchsorted(index.times, times - tolerance, side="left")
+    last = np.searchsorted(index.times, times + tolerance, side="right")
+    counts = last - first
+    rows = np.repeat(np.arange(len(times)), counts)
+    # the position of each pair within its crash's window
+    offsets = np.arange(len(rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return rows, first[rows] + offsets
+
+
+def first_unused(rows, found):
+    """
+    which pairs to keep, going through them in order: a pair is kept unless
+    its crash or its report is already in a kept pair
+    """
+    keep = np.zeros(len(rows), dtype=bool)
+    used_rows, used_found = set(), set()
+    for i, (row, report) in enumerate(zip(rows.tolist(), found.tolist())):
+        if row not in used_rows and report not in used_found:
+            keep[i] = True
+            used_rows.add(row)
+            used_found.add(report)
+    return keep
+
+
+def match(df, index, tolerance=TOLERANCE, max_distance=MAX_DISTANCE):
+    """
+    returns the match confidence (0-1) of every crash in the df, nan for
+    crashes that don't match any report in the index
+    """
+    times, readable = to_nanoseconds(df["DateTime"])
+    lat, lon = coordinates(df)
+    readable = np.flatnonzero(readable)
+    rows, found = candidates(times[readable], index, tolerance)
+    rows = readable[rows]
+
+    time_off = np.abs(times[rows] - index.times[found]) / tolerance.value
+    meters = distances(
+        lat[rows], lon[rows], index.latitude[found], index.longitude[found]
+    )
+    close = np.isnan(meters) | (meters <= max_distance)
+    rows, found = rows[close], found[close]
+    time_off, meters = time_off[close], meters[close]
+
+    # 1 for the same minute and place, 0.5 at the edge of the window. an
+    # unknown distance counts as halfway
+    time_score = 1 - time_off / 2
+    place_score = np.where(np.isnan(meters), 0.5, 1 - meters / (2 * max_distance))
+    pairs = pd.DataFrame(
+        {"row": rows, "found": found, "confidence": time_score * place_score}
+    )
+
+    # every crash and every report is used once, best matches first
+    pairs = pairs.sort_values(
+        ["confidence", "row", "found"], ascending=[False, True, True]
+    )
+    pairs = pairs[first_unused(pairs["row"].to_numpy(), pairs["found"].to_numpy())]
+
+    confidence = np.full(len(df), np.nan)
+    confidence[pairs["row"].to_numpy()] = pairs["confidence"].round(3).to_numpy()
+    return confidence
+
+
+def merge(main_df, index, new_col_name):
+    """ marks the crashes that match a bike or ped report in the index """
+    confidence = match(main_df, index)
+    main_df[new_col_name] = pd.Series(True, index=main_df.index).where(
+        ~np.isnan(confidence)
+    )
+    main_df[CONFIDENCE_COLS[new_col_name]] = confidence
+    return main_df
 
 
 def save_merged_df(merged_df, out_file):
     """ save the merged df """
-    merged_df.drop(columns=["index_x", "index_y"]).to_csv(out_file, index=False)
+    write_table(merged_df, out_file)
 
 
 def remove_temp_file(file):
@@ -31,21 +175,33 @@ def remove_temp_file(file):
     os.remove(file)
 
 
-if __name__ == "__main__":
+def merge_file(in_file, out_file, bike_index, ped_index):
+    """ tags one file with the bike/ped reports, then removes the input """
+    merged_df = merge(load_data(in_file), bike_index, "Cyclist Involved")
+    merged_df = merge(merged_df, ped_index, "Pedestrian Involved")
+    save_merged_df(merged_df, out_file)
+
+    remove_temp_file(in_file)
 
-    DF = load_data(sys.argv[1])
-    BIKE_DF = load_data(sys.argv[2])
-    PED_DF = load_data(sys.argv[3])
-    OUTFILE = sys.argv[4]
 
-    MERGED_DF = merge(DF, BIKE_DF, "Cyclist Involved")
-    MERGED_DF = merge(MERGED_DF, PED_DF, "Pedestrian Involved")
-    save_merged_df(MERGED_DF, OUTFILE)
+if __name__ == "__main__":
+    script_report(sys.argv)
+
+    FILES, WORKERS = parse_files(sys.argv[1:], "add the bike/ped columns")
+    if len(FILES) < 4:
+        raise SystemExit("needs a main file, the bike and ped files and an output file")
 
-    remove_temp_file(sys.argv[1])
+    # indexed once here, and sent to each worker once
+    SHARED = {
+        "bike_index": build_index(load_reports(FILES[1])),
+        "ped_index": build_index(load_reports(FILES[2])),
+    }
+    PAIRS = [(FILES[0], FILES[3])] + file_pairs(FILES[4:])
 
-    print("bike/ped data has been added to", sys.argv[4])
+    run_files(merge_file, PAIRS, WORKERS, SHARED)
+    for _, OUTFILE in PAIRS:
+        print("bike/ped data has been added to", OUTFILE)
 
     """
-    python merge_bike_ped.py "main-file" "bike-file" "ped-file" "output-file" 
+    python merge_bike_ped.py "main-file" "bike-file" "ped-file" "output-file"
     """
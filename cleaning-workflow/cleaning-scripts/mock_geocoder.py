@@ -0,0 +1,156 @@
+"""
+this script runs a local stand-in for the ArcGIS geocoding service, so the
+geocoding step can be benchmarked and tested without a network connection
+or spending any of the provider's rate limit.
+
+it answers the same `findAddressCandidates` requests as ArcGIS with made-up
+(but repeatable) coordinates inside Monroe County. it can also add latency,
+fail a share of requests and rate limit, to test the retries in `geocode.py`.
+
+run it in one terminal:
+    python mock_geocoder.py --port 8080 --latency 0.2 --failure-rate 0.05
+and point the geocoding step at it in another:
+    python geocode.py "in-file" "out-file" "cache-file" --scheme http --domain localhost:8080
+"""
+
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+GEOCODE_PATH = "/arcgis/rest/services/World/GeocodeServer/findAddressCandidates"
+
+# roughly the same bounds used in `make_geojson.drop_out_of_bounds_points`
+MIN_LAT, MAX_LAT = 38.99133, 39.35543
+MIN_LON, MAX_LON = -86.68285, -86.32442
+
+
+def fake_location(query):
+    """ returns the same lat/lon for the same query every time """
+    digest = hashlib.sha1(query.encode("utf-8")).digest()
+    lat_share = int.from_bytes(digest[:4], "big") / 2 ** 32
+    lon_share = int.from_bytes(digest[4:8], "big") / 2 ** 32
+    return (
+        round(MIN_LAT + lat_share * (MAX_LAT - MIN_LAT), 6),
+        round(MIN_LON + lon_share * (MAX_LON - MIN_LON), 6),
+    )
+
+
+def make_handler(latency=0.0, failure_rate=0.0, max_rate=None, seed=0):
+    """
+    builds a request handler class. `latency` is seconds per request,
+    `failure_rate` is the share of requests that get a 503 and `max_rate`
+    is how many requests per second are allowed before sending 429s.
+    """
+    rng = random.Random(seed)
+    lock = threading.Lock()
+    stats = {"requests": 0, "failures": 0, "rate_limited": 0}
+    window = {"start": time.monotonic(), "count": 0}
+
+    class MockGeocoderHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != GEOCODE_PATH:
+                self.send_json(404, {"error": {"code": 404, "message": "not found"}})
+                return
+
+            with lock:
+                stats["requests"] += 1
+                now = time.monotonic()
+                if now - window["start"] >= 1:
+                    window["start"], window["count"] = now, 0
+                window["count"] += 1
+                limited = max_rate is not None and window["count"] > max_rate
+                failed = not limited and rng.random() < failure_rate
+                if limited:
+                    stats["rate_limited"] += 1
+                if failed:
+                    stats["failures"] += 1
+
+            time.sleep(latency)
+            if limited:
+                self.send_json(429, {"error": {"code": 429}}, {"Retry-After": "1"})
+                return
+            if failed:
+                self.send_json(503, {"error": {"code": 503}})
+                return
+
+            query = parse_qs(url.query).get("singleLine", [""])[0]
+            lat, lon = fake_location(query)
+            self.send_json(
+                200,
+                {
+                    "spatialReference": {"wkid": 4326},
+                    "candidates": [
+                        {
+                            "address": query,
+                            "location": {"x": lon, "y": lat},
+                            "score": 100,
+                            "attributes": {},
+                        }
+                    ],
+                },
+            )
+
+        def send_json(self, status, body, headers=None):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            # keep the terminal quiet, there is one line per request otherwise
+            pass
+
+    MockGeocoderHandler.stats = stats
+    return MockGeocoderHandler
+
+
+class MockGeocoderServer(ThreadingHTTPServer):
+    # the default backlog of 5 drops connections once many workers connect
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def serve(port=0, **options):
+    """
+    starts the mock server on a background thread and returns it. use
+    `server.server_address[1]` to find the port when `port` is 0, and
+    `server.shutdown()` to stop it.
+    """
+    server = MockGeocoderServer(("127.0.0.1", port), make_handler(**options))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="local stand-in for ArcGIS")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds")
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--max-rate", type=float, default=None, help="requests/s")
+    parser.add_argument("--seed", type=int, default=0)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    ARGS = parse_args(sys.argv[1:])
+    SERVER = MockGeocoderServer(
+        ("127.0.0.1", ARGS.port),
+        make_handler(ARGS.latency, ARGS.failure_rate, ARGS.max_rate, ARGS.seed),
+    )
+    print("mock geocoder listening on", "localhost:%d" % ARGS.port)
+    try:
+        SERVER.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(SERVER.RequestHandlerClass.stats)
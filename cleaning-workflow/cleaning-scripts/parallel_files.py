@@ -0,0 +1,103 @@
+"""
+runs one script's cleaning over many files at once, spread over a pool of
+worker processes.
+
+the scripts that clean one file at a time (clean_datetime.py,
+clean_addresses.py, merge_bike_ped.py, jitter.py) also take more pairs of
+input/output files in one command:
+    python clean_addresses.py "in-1" "out-1" "in-2" "out-2" --workers 4
+the files don't depend on each other, so with enough cores a run takes
+about as long as the biggest file, instead of all of them added up.
+
+reference data that every file needs (ex. the bike/ped reports) is loaded
+once by the main process and sent to each worker once, when it starts,
+instead of being loaded again for every file.
+
+with `--report FILE` (see `run_report.py`), every file is a step of the
+report. a worker records the steps of each file it cleans and sends them
+back with the file's result.
+"""
+
+import os
+import argparse
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+# the report of a script run with `--report`
+import run_report
+
+# one worker per core
+WORKERS = os.cpu_count() or 1
+
+# the reference data sent to this worker when it started
+SHARED = {}
+
+
+def share(shared, reporting=False):
+    """ runs once in every worker, when the pool starts it """
+    SHARED.clear()
+    SHARED.update(shared or {})
+    run_report.SCRIPT_REPORT = (
+        run_report.RunReport(track_changes=False) if reporting else None
+    )
+
+
+def clean_one(clean_file, in_file, out_file, shared):
+    """ cleans one pair of files, as a step of the script's report """
+    func = partial(clean_file, **shared)
+    return run_report.record(os.path.basename(in_file), "file", func, in_file, out_file)
+
+
+def call(clean_file, in_file, out_file):
+    """ the result of one file, and the steps the worker recorded for it """
+    report = run_report.SCRIPT_REPORT
+    if report is not None:
+        report.steps = []
+    result = clean_one(clean_file, in_file, out_file, SHARED)
+    return result, report.steps if report is not None else []
+
+
+def run_files(clean_file, pairs, workers=WORKERS, shared=None):
+    """
+    calls `clean_file(in_file, out_file, **shared)` for every pair of files,
+    in up to `workers` processes. `clean_file` has to be a top level function
+    of its script. returns the results in the same order as the pairs
+    """
+    workers = min(workers, len(pairs))
+    if workers <= 1:
+        # no need for a pool
+        return [
+            clean_one(clean_file, in_file, out_file, shared or {})
+            for in_file, out_file in pairs
+        ]
+    report = run_report.SCRIPT_REPORT
+    with ProcessPoolExecutor(
+        workers, initializer=share, initargs=(shared, report is not None)
+    ) as pool:
+        futures = [
+            pool.submit(call, clean_file, in_file, out_file)
+            for in_file, out_file in pairs
+        ]
+        results = []
+        for future in futures:
+            result, steps = future.result()
+            if report is not None:
+                report.steps += steps
+            results.append(result)
+        return results
+
+
+def file_pairs(files):
+    """ `in-1 out-1 in-2 out-2` -> [(in-1, out-1), (in-2, out-2)] """
+    if len(files) % 2:
+        raise SystemExit("every input file needs an output file")
+    return list(zip(files[::2], files[1::2]))
+
+
+def parse_files(argv, description):
+    """ the file names and `--workers` of a script's command line """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("files", nargs="+")
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    args = parser.parse_args(argv)
+    return args.files, args.workers
@@ -0,0 +1,625 @@
+"""
+this script runs every cleaning step in one go, instead of the ~35 separate
+commands in the README.
+
+the steps are declared below as tasks. each task lists the tasks (or source
+files) it needs, and the dataframes are handed from one task to the next in
+memory. every task's output is still saved to a file: the last step of a
+file's cleaning saves to the same file as before (ex.
+`data/cleaning-process/moco-crash-2022.csv`), and the steps before it save
+to their own files (ex. `moco-crash-2022.datetime.csv`), so any step can be
+rerun on its own from the output of the step before it.
+
+tasks are only rerun when something they depend on has changed: a source
+file, an upstream task or the code of the scripts the task uses. this is
+tracked with content hashes in `data/cleaning-process/pipeline-state.json`.
+running the pipeline again without changing anything only takes a few
+seconds, and editing one yearly source file only reruns that file's branch
+(plus the master file and everything built from it).
+
+road names are matched against the street gazetteer (see
+`canonicalize_streets.py`) after the addresses are cleaned, once the
+gazetteer file has been built.
+
+the published geojson layers, charts and hotspots cover 2003-2022, so they are only
+remade when the 2013-2018 and 2003-2015 source files are in
+`data/source-data`. without them, they're saved to `data/cleaning-process/build`
+instead, and the published files are left as they are.
+
+the geocoding step is slow and uses the network, so it only runs with
+`--geocode`. with `--format parquet`, the files in `data/cleaning-process`
+are saved as typed parquet files instead of csvs (see `crash_schema.py`).
+
+run this command in the terminal:
+    python pipeline.py
+    python pipeline.py --geocode --force
+    python pipeline.py --format parquet
+
+every run adds a report to `data/cleaning-process/run-reports.jsonl`, with
+the time, memory and rows in/out of every step (see `run_report.py`).
+`--profile TASK` also runs that task under cProfile.
+    python pipeline.py --force --profile addresses:moco-crash-2022
+"""
+
+import os
+import sys
+import json
+import hashlib
+import argparse
+import importlib
+from collections import namedtuple
+
+import pandas as pd
+
+from crash_schema import read_table, write_table, read_stage, check_layout
+from categories import CATEGORIES_FILE
+
+# time, memory and rows of every step
+from run_report import RunReport, print_steps
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = "../../data"
+STATE_FILE = "cleaning-process/pipeline-state.json"
+REPORT_FILE = "cleaning-process/run-reports.jsonl"
+
+YEARS = ["2022", "2021", "2020", "2019"]
+
+# the published map layers and charts cover 2003-2022, so they are only
+# remade when the older source files are there too. otherwise they're saved
+# in BUILD_DIR
+HISTORY_FILES = ["moco-crash-2013-2018.csv", "moco-crash-2003-2015.csv"]
+BUILD_DIR = "cleaning-process/build"
+
+# `inputs` are names of other tasks. source files are tasks with no `func`.
+# `modules` are the scripts whose code the task depends on, with the scripts
+# they import. for a source file, it's the script whose `load_data` reads it,
+# and a crash source file has a `layout` its columns are checked against
+# (see `crash_schema.SOURCE_COLUMNS`).
+Task = namedtuple(
+    "Task", ["name", "func", "inputs", "output", "modules", "layout"], defaults=[None]
+)
+
+# every task depends on these too: the pipeline itself, the schema every file
+# is read and written with, and the category dictionaries
+SHARED_MODULES = ["pipeline", "crash_schema", "categories", "run_report"]
+SHARED_FILES = [CATEGORIES_FILE]
+
+
+def file_hash(path):
+    """returns the sha256 of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def task_key(task, input_keys):
+    """
+    a hash of everything that affects a task's output: its name, the code of
+    the scripts it uses, the shared scripts and files and the keys of its inputs
+    """
+    digest = hashlib.sha256(task.name.encode("utf-8"))
+    paths = [os.path.join(SCRIPT_DIR, name + ".py") for name in SHARED_MODULES]
+    paths += [os.path.join(SCRIPT_DIR, name + ".py") for name in task.modules]
+    for path in paths + SHARED_FILES:
+        # the category dictionaries don't exist until they're first built
+        digest.update(file_hash(path).encode() if os.path.exists(path) else b"none")
+    for key in input_keys:
+        digest.update(key.encode("utf-8"))
+    return digest.hexdigest()
+
+
+def read_output(path, stage=None):
+    """
+    reads a file written by an earlier task, with `DateTime` parsed. with a
+    `stage`, only the columns it uses are read
+    """
+    if stage is None:
+        df = read_table(path, low_memory=False)
+    else:
+        df = read_stage(path, stage, low_memory=False)
+    if "DateTime" in df:
+        df["DateTime"] = pd.to_datetime(df["DateTime"])
+    return df
+
+
+def read_source(task):
+    """reads a source file the same way the first script that uses it does"""
+    df = importlib.import_module(task.modules[0]).load_data(task.output)
+    return check_layout(df, task.layout, task.output) if task.layout else df
+
+
+# the tasks. each one wraps the functions from one of the cleaning scripts
+
+
+def standardize_1318(df):
+    from main_data_cleaning import rename_df, rename_dict_13_18
+
+    return rename_df(df, rename_dict_13_18)
+
+
+def standardize_0315(df):
+    from main_data_cleaning import (
+        rename_df,
+        rename_dict_03_15,
+        organize_location_cols,
+        add_bike_ped_flags,
+    )
+
+    return add_bike_ped_flags(organize_location_cols(rename_df(df, rename_dict_03_15)))
+
+
+def times_1318(df):
+    from clean_times import clean_1318
+
+    return clean_1318(df, "Collision Time")
+
+
+def times_0315(df):
+    from clean_times import clean_0315
+
+    return clean_0315(df)
+
+
+def date_time(df):
+    from clean_datetime import clean_date_time
+    from record_ids import add_record_ids
+
+    return clean_date_time(add_record_ids(df), "Collision Date", "Collision Time")
+
+
+def addresses(df):
+    from clean_addresses import clean_addresses
+
+    df = clean_addresses(df)
+    # a number, the same as when the next script reads it back from the file
+    df["Address Number"] = pd.to_numeric(df["Address Number"], errors="coerce")
+    return df
+
+
+def streets(df, gazetteer):
+    from canonicalize_streets import canonicalize_streets
+
+    return canonicalize_streets(df, gazetteer)
+
+
+def geocode(df):
+    from geocode import open_cache, apply_geocode, apply_merge
+
+    cache = open_cache()
+    geocoded, stats = apply_geocode(df, cache)
+    cache.close()
+    print("   ", stats)
+    return apply_merge(geocoded).drop(columns=["Latitude_2", "Longitude_2"])
+
+
+def bike_ped(df, bike_df, ped_df):
+    from merge_bike_ped import build_index, merge
+
+    merged = merge(df, build_index(bike_df), "Cyclist Involved")
+    return merge(merged, build_index(ped_df), "Pedestrian Involved")
+
+
+def master(*dfs):
+    from make_master_file import (
+        is_0315,
+        drop_cols,
+        drop_duplicate_years,
+        estimate_fields,
+        combine_dfs,
+    )
+
+    dfs = [
+        estimate_fields(drop_duplicate_years(df)) if is_0315(df.columns) else df
+        for df in dfs
+    ]
+    # a fresh index, the same as reading the master file back from csv
+    return combine_dfs(list(map(drop_cols, dfs))).reset_index(drop=True)
+
+
+def jitter(df, geocoded_df=None):
+    from jitter import merge_geocoded_lat_lon, add_jitter
+    from geocode_store import build_store
+
+    if geocoded_df is not None:
+        df = merge_geocoded_lat_lon(df, build_store(geocoded_df))
+    return add_jitter(df)
+
+
+def copy(df):
+    """the 2003-2015 file has no bike/ped reports to merge, it's saved as it is"""
+    return df
+
+
+def geojson(df):
+    from make_geojson import prepare
+
+    return prepare(df)
+
+
+def charts(df):
+    from make_charts import build_cube
+
+    return build_cube(df)
+
+
+def hotspots(df):
+    from hotspots import add_hotspot_ids
+
+    return add_hotspot_ids(df.copy())
+
+
+def has_history(data_dir):
+    """whether the master file will have every year since 2003"""
+    return all(
+        os.path.exists(os.path.join(data_dir, "source-data", name))
+        for name in HISTORY_FILES
+    )
+
+
+def output_dirs(data_dir):
+    """
+    the folders for the files made from the master file that are published
+    (the geojson layers, the charts and the hotspots). without the older
+    years they go to the build folder, so the published ones are never
+    replaced by files that are missing 2003-2018
+    """
+    root = data_dir if has_history(data_dir) else os.path.join(data_dir, BUILD_DIR)
+    clean = os.path.join(root, "clean-data")
+    return {
+        "charts": os.path.join(root, "charts"),
+        "geojson": os.path.join(clean, "geojson"),
+        "hotspots": os.path.join(clean, "hotspots"),
+    }
+
+
+def build_tasks(data_dir=DATA_DIR, use_geocoder=False, file_format="csv"):
+    """returns the list of tasks, in an order where inputs come first"""
+    src = os.path.join(data_dir, "source-data")
+    tmp = os.path.join(data_dir, "cleaning-process")
+    clean = os.path.join(data_dir, "clean-data")
+    published = output_dirs(data_dir)
+    tasks = []
+    # the extension of the files in `cleaning-process`
+    ext = "." + file_format
+
+    def add(name, func, inputs, output, modules):
+        tasks.append(Task(name, func, inputs, output, modules))
+        return name
+
+    # road names are only canonicalized once a gazetteer has been built
+    gazetteer = None
+    path = os.path.join(tmp, "street-gazetteer.csv")
+    if os.path.exists(path):
+        gazetteer = add_source(tasks, "source:gazetteer", path, "canonicalize_streets")
+
+    def stage_file(name, stage):
+        """
+        every stage of a file saves to its own file, so a stage that is rerun
+        on its own starts from its input's output instead of its own
+        """
+        return os.path.join(tmp, "%s.%s%s" % (name, stage, ext))
+
+    def clean_file(name, first_input):
+        """the steps every file goes through after its times are cleaned"""
+        stages = [
+            (
+                "datetime",
+                date_time,
+                [],
+                ["clean_datetime", "clean_times", "record_ids", "parallel_files"],
+            ),
+            ("addresses", addresses, [], ["clean_addresses", "parallel_files"]),
+        ]
+        if gazetteer:
+            stages.append(
+                (
+                    "streets",
+                    streets,
+                    [gazetteer],
+                    ["canonicalize_streets", "intersection_index"],
+                )
+            )
+        if use_geocoder:
+            stages.append(("geocode", geocode, [], ["geocode", "intersection_index"]))
+
+        step = first_input
+        for stage, func, inputs, modules in stages:
+            # the last stage saves to the file the next scripts read
+            if stage == stages[-1][0]:
+                out = os.path.join(tmp, name + ext)
+            else:
+                out = stage_file(name, stage)
+            step = add(stage + ":" + name, func, [step] + inputs, out, modules)
+        return step
+
+    bike = clean_file(
+        "bike-crashes-2013-2023",
+        add_source(
+            tasks,
+            "source:bike",
+            os.path.join(src, "bike-crashes-2013-2023.csv"),
+            "clean_datetime",
+            "2019-2022",
+        ),
+    )
+    ped = clean_file(
+        "ped-crashes-2013-2023",
+        add_source(
+            tasks,
+            "source:ped",
+            os.path.join(src, "ped-crashes-2013-2023.csv"),
+            "clean_datetime",
+            "2019-2022",
+        ),
+    )
+
+    yearly = []
+    for year in YEARS:
+        name = "moco-crash-" + year
+        path = os.path.join(src, name + ".csv")
+        if not os.path.exists(path):
+            continue
+        step = add_source(tasks, "source:" + year, path, "clean_datetime", "2019-2022")
+        step = clean_file(name, step)
+        yearly.append(
+            add(
+                "bike-ped:" + year,
+                bike_ped,
+                [step, bike, ped],
+                os.path.join(clean, name + "-clean.csv"),
+                ["merge_bike_ped", "intersection_index", "parallel_files"],
+            )
+        )
+
+    # the two older files only exist on some machines
+    path = os.path.join(src, "moco-crash-2013-2018.csv")
+    if os.path.exists(path):
+        step = add_source(
+            tasks, "source:2013-2018", path, "main_data_cleaning", "2013-2018"
+        )
+        step = add(
+            "standardize:2013-2018",
+            standardize_1318,
+            [step],
+            stage_file("moco-crash-2013-2018", "standardize"),
+            ["main_data_cleaning"],
+        )
+        step = add(
+            "times:2013-2018",
+            times_1318,
+            [step],
+            stage_file("moco-crash-2013-2018", "times"),
+            ["clean_times"],
+        )
+        step = clean_file("moco-crash-2013-2018", step)
+        yearly.append(
+            add(
+                "bike-ped:2013-2018",
+                bike_ped,
+                [step, bike, ped],
+                os.path.join(clean, "moco-crash-2013-2018-clean.csv"),
+                ["merge_bike_ped", "intersection_index", "parallel_files"],
+            )
+        )
+
+    path = os.path.join(src, "moco-crash-2003-2015.csv")
+    if os.path.exists(path):
+        step = add_source(
+            tasks, "source:2003-2015", path, "main_data_cleaning", "2003-2015"
+        )
+        step = add(
+            "standardize:2003-2015",
+            standardize_0315,
+            [step],
+            stage_file("moco-crash-2003-2015", "standardize"),
+            ["main_data_cleaning"],
+        )
+        step = add(
+            "times:2003-2015",
+            times_0315,
+            [step],
+            stage_file("moco-crash-2003-2015", "times"),
+            ["clean_times"],
+        )
+        step = clean_file("moco-crash-2003-2015", step)
+        yearly.append(
+            add(
+                "clean:2003-2015",
+                copy,
+                [step],
+                os.path.join(clean, "moco-crash-2003-2015-clean.csv"),
+                ["pipeline"],
+            )
+        )
+
+    step = add(
+        "master",
+        master,
+        yearly,
+        os.path.join(clean, "master-crashes.csv"),
+        ["make_master_file"],
+    )
+
+    add(
+        "charts",
+        charts,
+        [step],
+        os.path.join(published["charts"], "crash-cube.csv"),
+        ["make_charts"],
+    )
+
+    # use the already geocoded master file for the jittered lat/lon, if it exists
+    jitter_inputs = [step]
+    path = os.path.join(clean, "geocoded", "master_crash_geocoded.csv")
+    if os.path.exists(path):
+        jitter_inputs.append(
+            add_source(tasks, "source:geocoded", path, "geocode_store")
+        )
+    step = add(
+        "jitter",
+        jitter,
+        jitter_inputs,
+        os.path.join(clean, "jittered", "master-crashes-jittered.csv"),
+        [
+            "jitter",
+            "geocode_store",
+            "intersection_index",
+            "merge_bike_ped",
+            "parallel_files",
+        ],
+    )
+
+    add(
+        "geojson",
+        geojson,
+        [step],
+        # the first of the three layers
+        os.path.join(published["geojson"], "master-deaths.geojson"),
+        ["make_geojson"],
+    )
+
+    add(
+        "hotspots",
+        hotspots,
+        [step],
+        os.path.join(published["hotspots"], "hotspot-crashes.csv"),
+        ["hotspots", "intersection_index", "make_geojson", "make_charts"],
+    )
+    return tasks
+
+
+def add_source(tasks, name, path, module, layout=None):
+    tasks.append(Task(name, None, [], path, [module], layout))
+    return name
+
+
+def save_output(task, result):
+    """
+    saves a task's output. the geojson task writes its three files, the
+    charts task writes the cube and every chart made from it, and the
+    hotspots task writes the ranked hotspots and the dashboard layer too
+    """
+    os.makedirs(os.path.dirname(task.output), exist_ok=True)
+    if task.name == "geojson":
+        from make_geojson import LAYERS, save_geojson
+
+        folder = os.path.dirname(task.output)
+        save_geojson(
+            result,
+            [os.path.join(folder, "master-%s.geojson" % name) for name in LAYERS],
+        )
+    elif task.name == "charts":
+        from make_charts import save_charts
+
+        save_charts(result, os.path.dirname(task.output))
+    elif task.name == "hotspots":
+        from hotspots import save_hotspots
+
+        save_hotspots(result, os.path.dirname(task.output))
+    else:
+        write_table(result, task.output)
+
+
+def load_state(state_file):
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            return json.load(f)
+    return {}
+
+
+def save_state(state, state_file):
+    with open(state_file, "w") as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+
+
+def run(tasks, state_file, force=False, report=None):
+    """
+    runs every task whose key has changed since the last run, passing
+    dataframes between tasks in memory. every load, transform and save is
+    recorded in `report`. returns the names of the tasks that were rerun.
+    """
+    report = report or RunReport()
+    state = load_state(state_file)
+    by_name = {task.name: task for task in tasks}
+    keys = {}
+    frames = {}
+    rerun = []
+
+    def get_frame(name):
+        """the task's output, from memory if it ran, otherwise from its file"""
+        if name not in frames:
+            task = by_name[name]
+            frames[name] = report.run_step(
+                name,
+                "load",
+                read_source if task.func is None else read_output,
+                task if task.func is None else task.output,
+            )
+        # the cleaning functions change their inputs, and outputs can be shared
+        return frames[name].copy()
+
+    for task in tasks:
+        if task.func is None:
+            keys[task.name] = file_hash(task.output)
+            continue
+
+        keys[task.name] = task_key(task, [keys[name] for name in task.inputs])
+        up_to_date = state.get(task.name) == keys[task.name] and os.path.exists(
+            task.output
+        )
+        if up_to_date and not force:
+            continue
+
+        print("running", task.name)
+        result = report.run_step(
+            task.name,
+            "transform",
+            task.func,
+            *[get_frame(name) for name in task.inputs],
+        )
+        report.run_step(task.name, "save", save_output, task, result)
+        frames[task.name] = result
+        rerun.append(task.name)
+
+        # save after every task, so a crash doesn't throw away finished work
+        state[task.name] = keys[task.name]
+        save_state(state, state_file)
+
+    return rerun
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="run the whole cleaning pipeline")
+    parser.add_argument("--data-dir", default=DATA_DIR)
+    parser.add_argument("--geocode", action="store_true", help="include geocoding")
+    parser.add_argument("--force", action="store_true", help="rerun every task")
+    parser.add_argument(
+        "--format",
+        choices=["csv", "parquet"],
+        default="csv",
+        help="format of the files in cleaning-process",
+    )
+    parser.add_argument("--report", help="json lines file to add the run report to")
+    parser.add_argument("--profile", metavar="TASK", help="run one task in cProfile")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    ARGS = parse_args(sys.argv[1:])
+    TASKS = build_tasks(ARGS.data_dir, ARGS.geocode, ARGS.format)
+    REPORT_PATH = ARGS.report or os.path.join(ARGS.data_dir, REPORT_FILE)
+    REPORT = RunReport(ARGS.profile, os.path.dirname(REPORT_PATH))
+    if not has_history(ARGS.data_dir):
+        print(
+            "the 2003-2018 source files aren't in source-data, so the map layers,",
+            "charts and hotspots are saved to",
+            os.path.join(ARGS.data_dir, BUILD_DIR),
+        )
+    RERUN = run(TASKS, os.path.join(ARGS.data_dir, STATE_FILE), ARGS.force, REPORT)
+    REPORT.save(REPORT_PATH, rerun=RERUN, format=ARGS.format, force=ARGS.force)
+
+    print_steps(REPORT.steps)
+    print("run report added to", REPORT_PATH)
+    print(len(RERUN), "of", sum(t.func is not None for t in TASKS), "tasks rerun")
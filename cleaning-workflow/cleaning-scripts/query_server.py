@@ -0,0 +1,397 @@
+"""
+this script serves the crashes to the dashboard from a small local http
+server, so the map can ask for just the crashes it needs (a range of years,
+bike/ped crashes only, one primary factor, what's on screen...) instead of
+downloading the three geojson layers and filtering them itself.
+
+the master (or jittered) file is loaded once, into one array per column:
+    - every crash's geojson feature is encoded once, with the same short
+      property names as the geojson layers (see `make_geojson.py`), so an
+      answer is only a join of the features that match
+    - the crashes are sorted by DateTime, so a range of years is found with
+      two binary searches
+    - the crashes are also sorted by `GRID_SIZE` degree squares, so a map
+      view only looks at the crashes in the squares it covers
+whichever of the two finds fewer crashes is used first, and the other
+filters only check those crashes. answers are cached by query, with an
+ETag, and sent gzipped to clients that accept it. a client that sends back
+the ETag of an answer it already has gets a 304 without the body.
+
+    GET /crashes?years=2019-2022&involving=bike,ped&severity=deaths,injuries
+        &factor=SPEED TOO FAST FOR WEATHER CONDITIONS&bbox=-86.6,39.1,-86.5,39.2
+        &limit=1000
+returns a geojson FeatureCollection. every parameter is optional:
+    - years: `2021` or `2019-2022`
+    - involving: `bike`, `ped` or `bike,ped` (either one)
+    - severity: any of `deaths`, `injuries` and `nonfatal`, like the layers
+    - factor: a primary factor, can be given more than once
+    - bbox: `west,south,east,north`, in degrees
+    - limit: at most this many crashes, the earliest ones first
+    GET /meta
+returns the number of crashes, the years, the primary factors and the
+property names.
+
+run this command in the terminal, and the server only listens on localhost:
+    python query_server.py "../../data/clean-data/jittered/master-crashes-jittered.csv" --port 8000
+"""
+
+import sys
+import json
+import gzip
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+# the same records, names and json as the geojson layers
+from make_geojson import (
+    LAYERS,
+    PROPERTIES,
+    load_data,
+    prepare,
+    severity,
+    encode_columns,
+    encode_features,
+)
+from make_charts import is_true
+
+# about 1km squares
+GRID_SIZE = 0.01
+GRID_BITS = 32
+
+PARAMETERS = ["years", "involving", "severity", "factor", "bbox", "limit"]
+
+# answers kept in memory, the least recently used are dropped first
+CACHE_SIZE = 256
+
+# the DateTime of crashes without one, before every real time
+NO_TIME = np.iinfo(np.int64).min
+
+
+class CrashIndex:
+    """ the crashes of a file as arrays, with a time index and a grid index """
+
+    def __init__(self, df):
+        df = prepare(df).reset_index(drop=True)
+        self.rows = len(df)
+        self.features = encode_features(encode_columns(df), PROPERTIES["deaths"])
+        self.lat = df["Latitude"].to_numpy(dtype=float)
+        self.lon = df["Longitude"].to_numpy(dtype=float)
+        self.layer = severity(df)
+        self.bike = is_true(df, "c")
+        self.ped = is_true(df, "p")
+        self.factor_codes, factors = pd.factorize(df["f"].astype(object))
+        self.factors = {factor: code for code, factor in enumerate(factors)}
+
+        times = pd.to_datetime(df["dt"], errors="coerce")
+        self.times = times.to_numpy(dtype="datetime64[ns]").astype(np.int64)
+        self.times[times.isna().to_numpy()] = NO_TIME
+        self.years = sorted(int(year) for year in times.dt.year.dropna().unique())
+        self.by_time = np.argsort(self.times, kind="stable")
+        self.sorted_times = self.times[self.by_time]
+
+        grid_rows, grid_cols = self.squares(self.lat, self.lon)
+        keys = (grid_rows << GRID_BITS) + grid_cols
+        self.by_square = np.argsort(keys, kind="stable")
+        self.sorted_squares = keys[self.by_square]
+
+        # a different file means different answers, and different ETags
+        self.version = hashlib.sha1(
+            pd.util.hash_array(self.features).tobytes()
+        ).hexdigest()[:16]
+
+    @staticmethod
+    def squares(lat, lon):
+        """ the grid row and column of each point, columns kept positive """
+        rows = np.floor(np.asarray(lat) / GRID_SIZE).astype(np.int64)
+        cols = np.floor((np.asarray(lon) + 180) / GRID_SIZE).astype(np.int64)
+        return rows, cols
+
+    def time_rows(self, start, end):
+        """ the crashes with start <= DateTime < end """
+        first, last = np.searchsorted(self.sorted_times, [start, end])
+        return self.by_time[first:last]
+
+    def bbox_rows(self, slices):
+        if not slices:
+            return np.array([], dtype=np.int64)
+        return np.concatenate([self.by_square[s] for s in slices])
+
+    def bbox_slices(self, bbox):
+        """ the slices of `by_square` for the squares a bbox covers """
+        west, south, east, north = bbox
+        (row_0, row_1), (col_0, col_1) = self.squares([south, north], [west, east])
+        if not self.rows:
+            return []
+        # only the rows of squares that have crashes
+        row_0 = max(row_0, self.sorted_squares[0] >> GRID_BITS)
+        row_1 = min(row_1, self.sorted_squares[-1] >> GRID_BITS)
+        slices = []
+        for row in range(row_0, row_1 + 1):
+            low = (row << GRID_BITS) + col_0
+            high = (row << GRID_BITS) + col_1
+            first, last = np.searchsorted(self.sorted_squares, [low, high + 1])
+            if last > first:
+                slices.append(slice(first, last))
+        return slices
+
+    def find(self, query):
+        """ the rows that match a query, in the order of the file """
+        time_range = query.get("time")
+        # start from whichever index finds fewer crashes
+        candidates = self.time_rows(*time_range) if time_range else None
+        if "bbox" in query:
+            slices = self.bbox_slices(query["bbox"])
+            in_squares = sum(s.stop - s.start for s in slices)
+            if candidates is None or in_squares < len(candidates):
+                candidates = self.bbox_rows(slices)
+        if candidates is None:
+            candidates = np.arange(self.rows)
+
+        keep = np.ones(len(candidates), dtype=bool)
+        if time_range:
+            times = self.times[candidates]
+            keep &= (times >= time_range[0]) & (times < time_range[1])
+        if "bbox" in query:
+            west, south, east, north = query["bbox"]
+            lat, lon = self.lat[candidates], self.lon[candidates]
+            keep &= (lat >= south) & (lat <= north) & (lon >= west) & (lon <= east)
+        if "involving" in query:
+            involved = np.zeros(len(candidates), dtype=bool)
+            if "bike" in query["involving"]:
+                involved |= self.bike[candidates]
+            if "ped" in query["involving"]:
+                involved |= self.ped[candidates]
+            keep &= involved
+        if "severity" in query:
+            keep &= np.isin(self.layer[candidates], query["severity"])
+        if "factor" in query:
+            keep &= np.isin(self.factor_codes[candidates], query["factor"])
+
+        rows = np.sort(candidates[keep])
+        if "limit" in query:
+            # the earliest crashes
+            rows = rows[np.argsort(self.times[rows], kind="stable")[: query["limit"]]]
+            rows.sort()
+        return rows
+
+    def geojson(self, rows):
+        """ a FeatureCollection of the given rows, as text """
+        return (
+            '{"type":"FeatureCollection","features":['
+            + ",".join(self.features[rows])
+            + "]}"
+        )
+
+    def meta(self):
+        return {
+            "crashes": self.rows,
+            "years": self.years,
+            "factors": sorted(self.factors, key=str),
+            "properties": PROPERTIES["deaths"],
+            "layers": LAYERS,
+        }
+
+
+def parse_years(value):
+    """ `2021` or `2019-2022` -> the start and end, as int64 nanoseconds """
+    first, _, last = value.partition("-")
+    first, last = int(first), int(last or first)
+    if first > last:
+        raise ValueError("years: %s is after %s" % (first, last))
+    # nanosecond timestamps only go from late 1677 to early 2262
+    if first <= pd.Timestamp.min.year or last >= pd.Timestamp.max.year:
+        raise ValueError(
+            "years: use years from %d to %d"
+            % (pd.Timestamp.min.year + 1, pd.Timestamp.max.year - 1)
+        )
+    return (
+        pd.Timestamp(year=first, month=1, day=1).value,
+        pd.Timestamp(year=last + 1, month=1, day=1).value,
+    )
+
+
+def parse_query(params, index):
+    """
+    turns the query string parameters into filters. raises ValueError for
+    parameters that can't be used
+    """
+    query = {}
+    unknown = set(params) - set(PARAMETERS)
+    if unknown:
+        raise ValueError("unknown parameters: " + ", ".join(sorted(unknown)))
+    if "years" in params:
+        query["time"] = parse_years(params["years"][0])
+    if "involving" in params:
+        involving = set(params["involving"][0].split(","))
+        if not involving <= {"bike", "ped"}:
+            raise ValueError("involving: use bike, ped or bike,ped")
+        query["involving"] = involving
+    if "severity" in params:
+        names = params["severity"][0].split(",")
+        if not set(names) <= set(LAYERS):
+            raise ValueError("severity: use any of " + ", ".join(LAYERS))
+        query["severity"] = [LAYERS.index(name) for name in names]
+    if "factor" in params:
+        # factors that never happened match nothing
+        query["factor"] = [index.factors.get(factor, -2) for factor in params["factor"]]
+    if "bbox" in params:
+        bbox = [float(value) for value in params["bbox"][0].split(",")]
+        if len(bbox) != 4 or not np.isfinite(bbox).all():
+            raise ValueError("bbox: use west,south,east,north")
+        if bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ValueError("bbox: use west,south,east,north")
+        query["bbox"] = bbox
+    if "limit" in params:
+        query["limit"] = max(int(params["limit"][0]), 0)
+    return query
+
+
+def cache_key(url):
+    """ the same query with its parameters in any order is the same answer """
+    params = parse_qs(url.query, keep_blank_values=True)
+    pairs = [(name, value) for name in sorted(params) for value in sorted(params[name])]
+    return url.path + "?" + "&".join("%s=%s" % pair for pair in pairs)
+
+
+class ResponseCache:
+    """ the last `size` answers: their ETag, body and gzipped body """
+
+    def __init__(self, size=CACHE_SIZE):
+        self.size = size
+        self.answers = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0}
+
+    def get(self, key):
+        with self.lock:
+            answer = self.answers.get(key)
+            if answer is not None:
+                self.answers.move_to_end(key)
+                self.stats["hits"] += 1
+            else:
+                self.stats["misses"] += 1
+            return answer
+
+    def put(self, key, answer):
+        with self.lock:
+            self.answers[key] = answer
+            self.answers.move_to_end(key)
+            while len(self.answers) > self.size:
+                self.answers.popitem(last=False)
+
+
+def make_handler(index, cache_size=CACHE_SIZE):
+    """ builds a request handler class that answers from `index` """
+    cache = ResponseCache(cache_size)
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path not in ("/crashes", "/meta"):
+                self.send_json(404, {"error": "not found"})
+                return
+
+            # only answers have an ETag, a query that can't be used never gets a 304
+            query = None
+            try:
+                if url.path == "/crashes":
+                    query = parse_query(parse_qs(url.query), index)
+            except ValueError as error:
+                self.send_json(400, {"error": str(error)})
+                return
+
+            key = cache_key(url)
+            etag = hashlib.sha1((index.version + key).encode("utf-8")).hexdigest()
+            etag = '"%s"' % etag[:24]
+            if etag in self.headers.get("If-None-Match", ""):
+                cache.stats["not_modified"] += 1
+                self.send_answer(304, etag)
+                return
+
+            answer = cache.get(key)
+            if answer is None:
+                body = self.answer(url, query).encode("utf-8")
+                answer = (body, gzip.compress(body, compresslevel=6))
+                cache.put(key, answer)
+
+            self.send_answer(200, etag, *answer)
+
+        def answer(self, url, query):
+            if url.path == "/meta":
+                return json.dumps(index.meta())
+            return index.geojson(index.find(query))
+
+        def send_answer(self, status, etag, body=b"", zipped=b""):
+            use_gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+            payload = zipped if use_gzip and status == 200 else body
+            self.send_response(status)
+            self.send_header("ETag", etag)
+            # clients have to check back, but a 304 is cheap
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Vary", "Accept-Encoding")
+            self.send_header("Access-Control-Allow-Origin", "*")
+            if status == 200:
+                self.send_header("Content-Type", "application/json")
+                if use_gzip:
+                    self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def send_json(self, status, body):
+            payload = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            # keep the terminal quiet, there is one line per request otherwise
+            pass
+
+    QueryHandler.cache = cache
+    return QueryHandler
+
+
+class QueryServer(ThreadingHTTPServer):
+    # the map asks for many tiles of the view at once
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def serve(index, port=0, **options):
+    """
+    starts the server on a background thread and returns it. use
+    `server.server_address[1]` to find the port when `port` is 0, and
+    `server.shutdown()` to stop it.
+    """
+    server = QueryServer(("127.0.0.1", port), make_handler(index, **options))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="local crash query server")
+    parser.add_argument("in_file", help="the master or jittered file")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE)
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    ARGS = parse_args(sys.argv[1:])
+    INDEX = CrashIndex(load_data(ARGS.in_file))
+    SERVER = QueryServer(("127.0.0.1", ARGS.port), make_handler(INDEX, ARGS.cache_size))
+    print(INDEX.rows, "crashes served on", "localhost:%d" % ARGS.port)
+    try:
+        SERVER.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(SERVER.RequestHandlerClass.cache.stats)
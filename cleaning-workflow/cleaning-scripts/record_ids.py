@@ -0,0 +1,87 @@
+"""
+gives every crash record a stable `Record Id`, so a record can be found again
+in a later extract of the same data (see `delta_ingest.py`).
+
+the id is, in order of preference:
+    - `MRN:<number>` from the `Master Record Number`, where the file has one
+    - `LC:<agency>|<local code>`, where the file has a usable local code.
+      some local codes were turned into numbers by excel (ex. `2.022E+11`)
+      and aren't unique anymore, so those aren't used
+    - `FP:<hash>`, a fingerprint of the crash itself: its agency, date, time,
+      roads, house number and location. the 2019-2021 files have no local
+      code, so their records are always fingerprinted. if a record changes
+      one of those fields in a later extract, it gets a new id, and counts as
+      removed and added again.
+if two records end up with the same id, the later ones get `#2`, `#3`...
+"""
+
+import numpy as np
+import pandas as pd
+
+RECORD_ID = "Record Id"
+
+# the fields that identify a crash when there's no usable id
+FINGERPRINT_COLS = [
+    "Agency",
+    "Collision Date",
+    "Collision Time",
+    "Roadway Id",
+    "Intersecting Road",
+    "House Number",
+    "Latitude",
+    "Longitude",
+]
+
+# local codes that excel saved in scientific notation
+MANGLED_CODE = r"[Ee]\+"
+
+
+def text(col):
+    """ the column as stripped strings, with missing values as empty strings """
+    return col.astype("string").str.strip().fillna("")
+
+
+def fingerprints(df):
+    """ a hash of the identifying fields of every record, as `FP:` ids """
+    cols = [col for col in FINGERPRINT_COLS if col in df]
+    hashes = pd.util.hash_pandas_object(
+        df[cols].apply(text), index=False, categorize=True
+    ).to_numpy()
+    return pd.Series(
+        ["FP:%016x" % value for value in hashes], index=df.index, dtype=object
+    )
+
+
+def record_ids(df):
+    """ returns the `Record Id` of every record in a raw extract """
+    ids = fingerprints(df)
+
+    if "Local Code" in df and "Agency" in df:
+        codes = text(df["Local Code"])
+        local = "LC:" + text(df["Agency"]) + "|" + codes
+        usable = codes.ne("") & ~codes.str.contains(MANGLED_CODE)
+        usable &= ~local.duplicated(keep=False)
+        ids = ids.where(~usable.to_numpy(dtype=bool), local.astype(object))
+
+    if "Master Record Number" in df:
+        numbers = text(df["Master Record Number"])
+        ids = ids.where(numbers.eq("").to_numpy(dtype=bool), "MRN:" + numbers)
+
+    # exact duplicate records still need their own ids
+    repeat = ids.groupby(ids).cumcount().to_numpy()
+    suffix = np.where(repeat > 0, "#" + (repeat + 1).astype(str).astype(object), "")
+    return (ids + suffix).astype(object)
+
+
+def add_record_ids(df):
+    """ adds a `Record Id` column, unless the df already has one """
+    if RECORD_ID not in df:
+        df.insert(0, RECORD_ID, record_ids(df))
+    return df
+
+
+def row_hashes(df):
+    """ a hash of every value of every record, to find records that changed """
+    return pd.util.hash_pandas_object(
+        df.drop(columns=RECORD_ID, errors="ignore").apply(text), index=False
+    ).to_numpy()
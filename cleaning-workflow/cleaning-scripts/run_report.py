@@ -0,0 +1,275 @@
+"""
+this script records how each step of a run went, so runs can be compared
+and charted over time.
+
+every step (loading a file, a task's transform or saving its output) is run
+through `RunReport.run_step`, which records:
+    - wall time and cpu time, in seconds
+    - peak RSS: the most memory the process has used so far, and how much
+      this step raised it
+    - rows in and out, and for steps that keep the index of their (first)
+      input, how many of its rows were dropped and how many were changed
+one step can also be run under cProfile, which saves a `.prof` file and
+puts the slowest functions in the report.
+
+the report is json, one object per run:
+    {"started": ..., "wall_seconds": ..., "cpu_seconds": ...,
+     "peak_rss_bytes": ..., "commit": ..., "steps": [...]}
+`pipeline.py` adds a line with each run's report to
+`data/cleaning-process/run-reports.jsonl`.
+
+the standalone scripts (clean_datetime.py, geocode.py, jitter.py...) add
+their report to a file when they're given `--report FILE`:
+    python clean_addresses.py "in-file" "out-file" --report "../../data/cleaning-process/run-reports.jsonl"
+every file they load or save through `crash_schema.py` is then a step, and
+so is every file the scripts of `parallel_files.py` clean, even in worker
+processes. a script that fails still saves the steps it finished.
+"""
+
+import os
+import sys
+import json
+import time
+import atexit
+import pstats
+import cProfile
+import platform
+import subprocess
+
+import numpy as np
+import pandas as pd
+
+# only on unix
+try:
+    import resource
+except ImportError:
+    resource = None
+
+# functions listed from a profile, slowest first
+PROFILE_FUNCTIONS = 20
+
+# the report of the standalone script being run, see `script_report`
+SCRIPT_REPORT = None
+
+
+def peak_rss():
+    """ the most memory the process has used so far, in bytes """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def git_commit():
+    """ the commit being run, if this is a git checkout """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    return {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "pandas": pd.__version__,
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+    }
+
+
+def column_hashes(df):
+    """ a hash of every value, by column, to find the rows a step changed """
+    return {
+        col: pd.util.hash_pandas_object(df[col], index=False).to_numpy()
+        for col in df.columns.unique()
+    }
+
+
+def count_changes(before, index, after):
+    """
+    returns how many input rows are missing from the output, and how many
+    kept rows have a different value in a column the input and output share.
+    None if rows can't be matched up by index
+    """
+    if not (index.is_unique and after.index.is_unique):
+        return None, None
+    # a new index (ex. a combined or summed up df) doesn't match the input's
+    if isinstance(after.index, pd.RangeIndex) and not after.index.equals(index):
+        return None, None
+    positions = index.get_indexer(after.index)
+    kept = positions >= 0
+    dropped = len(index) - int(kept.sum())
+    changed = np.zeros(int(kept.sum()), dtype=bool)
+    for col, hashes in before.items():
+        if col in after.columns and after.columns.is_unique:
+            new = pd.util.hash_pandas_object(after[col], index=False).to_numpy()
+            changed |= new[kept] != hashes[positions[kept]]
+    return dropped, int(changed.sum())
+
+
+def profile_summary(profiler, limit=PROFILE_FUNCTIONS):
+    """ the functions with the most cumulative time """
+    stats = pstats.Stats(profiler)
+    rows = []
+    for (file, line, name), (_, calls, total, cumulative, _) in stats.stats.items():
+        rows.append(
+            {
+                "function": "%s:%d(%s)" % (os.path.basename(file), line, name),
+                "calls": calls,
+                "total_seconds": round(total, 6),
+                "cumulative_seconds": round(cumulative, 6),
+            }
+        )
+    rows.sort(key=lambda row: row["cumulative_seconds"], reverse=True)
+    return rows[:limit]
+
+
+class RunReport:
+    """ the steps of one run, and totals for the whole run """
+
+    def __init__(self, profile=None, profile_dir=".", track_changes=True):
+        # the name of the task to profile
+        self.profile = profile
+        self.profile_dir = profile_dir
+        self.track_changes = track_changes
+        self.steps = []
+        self.started = time.strftime("%Y-%m-%dT%H:%M:%S")
+        self.wall_start = time.perf_counter()
+        self.cpu_start = time.process_time()
+
+    def run_step(self, task, step, func, *args):
+        """ runs `func(*args)`, records it under `task` and returns its result """
+        frames = [arg for arg in args if isinstance(arg, pd.DataFrame)]
+        before = None
+        # saving and loading don't change rows
+        if step == "transform" and self.track_changes and frames:
+            before = column_hashes(frames[0])
+            index = frames[0].index
+
+        profiler = cProfile.Profile() if task == self.profile else None
+        rss_start = peak_rss()
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        if profiler:
+            profiler.enable()
+        try:
+            result = func(*args)
+        finally:
+            if profiler:
+                profiler.disable()
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        rss_end = peak_rss()
+
+        record = {
+            "task": task,
+            "step": step,
+            "wall_seconds": round(wall, 6),
+            "cpu_seconds": round(cpu, 6),
+            "peak_rss_bytes": rss_end,
+            "rss_growth_bytes": None if rss_end is None else rss_end - rss_start,
+            "rows_in": sum(len(frame) for frame in frames) if frames else None,
+            "rows_out": len(result) if isinstance(result, pd.DataFrame) else None,
+            "rows_dropped": None,
+            "rows_modified": None,
+        }
+        if before is not None and isinstance(result, pd.DataFrame):
+            record["rows_dropped"], record["rows_modified"] = count_changes(
+                before, index, result
+            )
+        if profiler:
+            record["profile"] = self.save_profile(profiler, task, step)
+            record["profile_functions"] = profile_summary(profiler)
+        self.steps.append(record)
+        return result
+
+    def save_profile(self, profiler, task, step):
+        """ saves the raw profile, for `snakeviz` or `python -m pstats` """
+        os.makedirs(self.profile_dir, exist_ok=True)
+        name = "profile-%s-%s.prof" % (task.replace(":", "-"), step)
+        path = os.path.join(self.profile_dir, name)
+        profiler.dump_stats(path)
+        return path
+
+    def to_dict(self, **details):
+        return {
+            "started": self.started,
+            "wall_seconds": round(time.perf_counter() - self.wall_start, 6),
+            "cpu_seconds": round(time.process_time() - self.cpu_start, 6),
+            "peak_rss_bytes": peak_rss(),
+            **environment(),
+            **details,
+            "steps": self.steps,
+        }
+
+    def save(self, path, **details):
+        """ adds the report as one line of a json lines file """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a") as f:
+            f.write(json.dumps(self.to_dict(**details)) + "\n")
+
+
+def script_report(argv):
+    """
+    takes `--report FILE` out of a standalone script's arguments (sys.argv),
+    and records the script's steps until it exits, when the report is added
+    to FILE. returns the report, or None without `--report`
+    """
+    global SCRIPT_REPORT
+    if "--report" not in argv:
+        return None
+    at = argv.index("--report")
+    if at + 1 == len(argv):
+        raise SystemExit("--report needs the file to add the report to")
+    path = argv[at + 1]
+    del argv[at : at + 2]
+
+    # the rows a step changed are only counted for the pipeline's transforms
+    SCRIPT_REPORT = RunReport(track_changes=False)
+    atexit.register(
+        SCRIPT_REPORT.save, path, script=os.path.basename(argv[0]), args=argv[1:]
+    )
+    return SCRIPT_REPORT
+
+
+def record(task, step, func, *args):
+    """ runs `func(*args)`, as a step of the script's report if it has one """
+    if SCRIPT_REPORT is None:
+        return func(*args)
+    return SCRIPT_REPORT.run_step(task, step, func, *args)
+
+
+def print_steps(steps):
+    for record in steps:
+        print(
+            "%-32s %-9s %8.3fs wall %8.3fs cpu %8s rows in %8s rows out"
+            % (
+                record["task"],
+                record["step"],
+                record["wall_seconds"],
+                record["cpu_seconds"],
+                record["rows_in"],
+                record["rows_out"],
+            )
+        )
+
+
+if __name__ == "__main__":
+    # prints the steps of the last run in a reports file
+    with open(sys.argv[1]) as f:
+        LAST = json.loads(f.readlines()[-1])
+    print_steps(LAST["steps"])
+    print(
+        "run of",
+        LAST["started"],
+        "took %.1fs," % LAST["wall_seconds"],
+        "peak RSS %.0f MB" % ((LAST["peak_rss_bytes"] or 0) / 1e6),
+    )
@@ -0,0 +1,230 @@
+"""
+this script makes synthetic crash data for benchmarking the cleaning scripts
+at sizes much bigger than the real data.
+
+the synthetic crashes copy the columns of a real yearly file (by default
+`moco-crash-2022.csv`), and every column's values are drawn from the values
+in that file, so the share of missing values, road names, primary factors
+and so on stay about the same. a few things are made up on top of that,
+so the data doesn't just repeat the template:
+    - dates are spread over one year for every template's worth of crashes
+      (up to `MAX_YEARS`), and times are random minutes of the day
+    - `ROAD_VARIANT_SHARE` of road names get a house number in front, so the
+      number of distinct roads keeps growing with the data like it does in
+      real data
+    - lat/lon are moved a little around a real crash's location
+
+it also makes the bike and ped files (a share of the synthetic crashes, the
+same as in the real data), and versions of the crashes in the 2013-2018 and
+2003-2015 formats.
+
+    python synthetic_crashes.py "out-folder" --scale 10 --seed 0
+"""
+
+import os
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# parquet or csv, depending on the file name
+from crash_schema import read_table, write_table
+
+# `H:MM AM/PM` times, the same as the real 2019-2022 files
+from clean_times import minutes_to_clock
+
+# the 2013-2018 file has its own column names
+from main_data_cleaning import rename_dict_13_18
+
+TEMPLATE_FILE = "../../data/source-data/moco-crash-2022.csv"
+
+# the share of 2022 crashes that are in the 2022 bike and ped files
+BIKE_SHARE = 0.0104
+PED_SHARE = 0.0154
+
+ROAD_VARIANT_SHARE = 0.1
+MAX_YEARS = 20
+FIRST_YEAR = 2003
+# the 2003-2015 file only matters before 2013, so its crashes are moved there
+YEARS_0315 = (2003, 2016)
+# about 200m
+COORDINATE_NOISE = 0.002
+
+# the 2003-2015 `Collision Type` values, which also mark bike/ped crashes
+VEHICLE_TYPES = ["1-Car", "2-Car", "3+ Cars"]
+INJURY_TYPES = ["No injury/unknown", "Non-incapacitating", "Incapacitating", "Fatal"]
+
+
+def load_template(template_file=TEMPLATE_FILE):
+    """ returns the real crashes the synthetic ones are drawn from """
+    return read_table(template_file, encoding="unicode_escape")
+
+
+def sample_column(col, rows, rng):
+    """ draws `rows` values from a column, keeping how often each one appears """
+    values = col.to_numpy(dtype=object)
+    return values[rng.integers(0, len(values), rows)]
+
+
+def road_variants(roads, rng):
+    """ puts a house number in front of some of the road names """
+    roads = roads.copy()
+    variant = (rng.random(len(roads)) < ROAD_VARIANT_SHARE) & pd.notna(roads)
+    numbers = rng.integers(1, 5000, len(roads)).astype(str).astype(object)
+    roads[variant] = numbers[variant] + " " + roads[variant]
+    return roads
+
+
+def random_dates(rows, years, rng):
+    """ `M/D/YY` dates, spread over `years` years starting in `FIRST_YEAR` """
+    start = pd.Timestamp(FIRST_YEAR + MAX_YEARS - years, 1, 1)
+    dates = start + pd.to_timedelta(rng.integers(0, 365 * years, rows), unit="D")
+    return (
+        dates.month.astype(str)
+        + "/"
+        + dates.day.astype(str)
+        + "/"
+        + (dates.year % 100).astype(str).str.zfill(2)
+    ).to_numpy(dtype=object)
+
+
+def generate_crashes(template, rows, seed=0):
+    """ returns `rows` synthetic crashes with the template's columns """
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame(
+        {col: sample_column(template[col], rows, rng) for col in template.columns}
+    )
+
+    years = min(max(1, rows // len(template)), MAX_YEARS)
+    df["Collision Date"] = random_dates(rows, years, rng)
+    df["Collision Time"] = minutes_to_clock(
+        pd.Series(rng.integers(0, 24 * 60, rows))
+    ).to_numpy(dtype=object)
+
+    df["Roadway Id"] = road_variants(df["Roadway Id"].to_numpy(dtype=object), rng)
+    df["Intersecting Road"] = road_variants(
+        df["Intersecting Road"].to_numpy(dtype=object), rng
+    )
+
+    # a real crash's location, moved a little. 0/0 and missing stay that way
+    real = rng.integers(0, len(template), rows)
+    lat = template["Latitude"].to_numpy(dtype=float)[real]
+    lon = template["Longitude"].to_numpy(dtype=float)[real]
+    located = (lat != 0) & (lon != 0)
+    df["Latitude"] = np.where(
+        located, lat + rng.normal(0, COORDINATE_NOISE, rows), lat
+    ).round(8)
+    df["Longitude"] = np.where(
+        located, lon + rng.normal(0, COORDINATE_NOISE, rows), lon
+    ).round(8)
+    return df
+
+
+def generate_bike_ped(crashes, share, seed=0):
+    """ picks a share of the crashes, the same as the city's bike/ped files """
+    rng = np.random.default_rng(seed)
+    return crashes[rng.random(len(crashes)) < share].reset_index(drop=True)
+
+
+def to_1318(crashes, seed=0):
+    """
+    the crashes in the 2013-2018 format: its column names, and mostly
+    military times (`1745`) with some `H:MM AM/PM` times
+    """
+    rng = np.random.default_rng(seed)
+    df = crashes.copy()
+    times = pd.to_datetime(df["Collision Time"], format="%I:%M %p")
+    military = (times.dt.hour * 100 + times.dt.minute).astype(str)
+    df["Collision Time"] = np.where(
+        rng.random(len(df)) < 0.8, military, df["Collision Time"]
+    )
+    return df.rename(columns={new: old for old, new in rename_dict_13_18.items()})
+
+
+def to_0315(crashes, seed=0):
+    """
+    the crashes in the 2003-2015 format: separate date and hour columns,
+    one `Reported_Location` and text injury and vehicle types
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.to_datetime(crashes["Collision Date"], format="%m/%d/%y")
+    years = rng.integers(*YEARS_0315, len(crashes))
+    # feb 29th isn't in every year
+    days = dates.dt.day.where((dates.dt.month != 2) | (dates.dt.day < 29), 28)
+    times = pd.to_datetime(crashes["Collision Time"], format="%I:%M %p")
+    roads = crashes["Roadway Id"].fillna("")
+    second = crashes["Intersecting Road"]
+    location = roads.where(second.isna(), roads + " & " + second.fillna(""))
+    # some locations have notes in parentheses
+    noted = rng.random(len(crashes)) < 0.05
+    location = location.where(~noted, location + " (NEAR)")
+
+    dead = pd.to_numeric(crashes["Number Dead"], errors="coerce") > 0
+    injured = pd.to_numeric(crashes["Number Injured"], errors="coerce") > 0
+    injury_type = np.where(
+        dead,
+        INJURY_TYPES[3],
+        np.where(
+            injured,
+            rng.choice(INJURY_TYPES[1:3], len(crashes)),
+            INJURY_TYPES[0],
+        ),
+    )
+    vehicles = pd.to_numeric(crashes["Vehicles Involved"], errors="coerce")
+    vehicle_type = np.array(VEHICLE_TYPES, dtype=object)[
+        (vehicles.fillna(1).clip(1, 3) - 1).astype(int)
+    ]
+    bike_ped = rng.random(len(crashes))
+    vehicle_type[bike_ped < BIKE_SHARE] = "Cyclist"
+    vehicle_type[(bike_ped >= BIKE_SHARE) & (bike_ped < BIKE_SHARE + PED_SHARE)] = (
+        "Pedestrian"
+    )
+
+    return pd.DataFrame(
+        {
+            "Year": years,
+            "Month": dates.dt.month,
+            "Day": days,
+            "Hour": (times.dt.hour * 100).astype(float),
+            "Weekend?": np.where(dates.dt.dayofweek >= 5, "Weekend", "Weekday"),
+            "Collision Type": vehicle_type,
+            "Injury Type": injury_type,
+            "Primary Factor": crashes["Primary Factor"],
+            "Reported_Location": location,
+            "Latitude": crashes["Latitude"],
+            "Longitude": crashes["Longitude"],
+        }
+    )
+
+
+def generate_all(template, scale, seed=0):
+    """ returns every synthetic file for `scale` times the template's rows """
+    crashes = generate_crashes(template, int(len(template) * scale), seed)
+    return {
+        "moco-crash-synthetic": crashes,
+        "bike-crashes-synthetic": generate_bike_ped(crashes, BIKE_SHARE, seed + 1),
+        "ped-crashes-synthetic": generate_bike_ped(crashes, PED_SHARE, seed + 2),
+        "moco-crash-2013-2018-synthetic": to_1318(crashes, seed + 3),
+        "moco-crash-2003-2015-synthetic": to_0315(crashes, seed + 4),
+    }
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="make synthetic crash data")
+    parser.add_argument("out_dir")
+    parser.add_argument("--scale", type=float, default=1, help="x the template")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--template", default=TEMPLATE_FILE)
+    parser.add_argument("--format", default="csv", choices=["csv", "parquet"])
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    ARGS = parse_args(sys.argv[1:])
+    os.makedirs(ARGS.out_dir, exist_ok=True)
+
+    FILES = generate_all(load_template(ARGS.template), ARGS.scale, ARGS.seed)
+    for NAME, DF in FILES.items():
+        write_table(DF, os.path.join(ARGS.out_dir, NAME + "." + ARGS.format))
+        print(NAME, len(DF), "rows")
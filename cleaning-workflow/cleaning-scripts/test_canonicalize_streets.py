@@ -0,0 +1,27 @@
+"""
+checks that road names are matched on their cleaned spelling, and that a
+direction glued to a name isn't dropped. run from the cleaning-scripts folder:
+    python -m pytest test_canonicalize_streets.py
+"""
+
+import numpy as np
+
+from canonicalize_streets import NgramIndex, best_match
+
+ROADS = ["E DISCOVERY PKWY", "DISCOVERY PKWY", "W 17TH ST", "WALNUT ST", "S WALNUT ST"]
+
+
+def match(name, roads=ROADS):
+    return best_match(name, NgramIndex(roads), np.full(len(roads), 3))
+
+
+def test_names_are_scored_on_their_cleaned_spelling():
+    assert match("W.17TH ST") == ("W 17TH ST", 1.0)
+    assert match("WALNT ST") == ("WALNUT ST", 0.941)
+
+
+def test_glued_directions_are_kept():
+    assert match("EDISCOVERY PKWY") == ("E DISCOVERY PKWY", 1.0)
+    assert match("SWALNUT ST") == ("S WALNUT ST", 1.0)
+    # without the road with the direction, there's no match at all
+    assert match("EDISCOVERY PKWY", ["DISCOVERY PKWY"]) is None
@@ -0,0 +1,43 @@
+"""
+checks that crashes put at midnight for lack of a time can be told apart
+from crashes that happened at midnight. run from the cleaning-scripts folder:
+    python -m pytest test_clean_datetime.py
+"""
+
+from collections import Counter
+
+import pandas as pd
+
+from clean_datetime import TIME_DEFAULTED, clean_date_time
+from clean_times import MINUTES_COL
+
+
+def test_defaulted_times_are_marked():
+    df = pd.DataFrame(
+        {
+            "Collision Date": ["1/13/22"] * 4,
+            # `0317` is read as the year 317, too early for datetime64[ns]
+            "Collision Time": ["12:00 AM", None, "soon", "0317"],
+        }
+    )
+    problems = Counter()
+    df = clean_date_time(df, "Collision Date", "Collision Time", problems)
+
+    assert (df["DateTime"] == pd.Timestamp("2022-01-13")).all()
+    assert df[TIME_DEFAULTED].tolist() == [False, True, True, True]
+    assert problems == {"missing time": 1, "unreadable time": 2, "unreadable date": 0}
+
+
+def test_defaulted_minutes_are_marked():
+    # the older files, with the times already parsed by clean_times.py
+    df = pd.DataFrame(
+        {
+            "Collision Date": ["2015-06-01"] * 3,
+            "Collision Time": ["00:00", None, "25:00"],
+            MINUTES_COL: [0, None, None],
+        }
+    )
+    df = clean_date_time(df, "Collision Date", "Collision Time")
+
+    assert (df["DateTime"] == pd.Timestamp("2015-06-01")).all()
+    assert df[TIME_DEFAULTED].tolist() == [False, True, True]
@@ -0,0 +1,34 @@
+"""
+checks that csvs are read with their declared types, and that source files
+are checked against their layout. run from the cleaning-scripts folder:
+    python -m pytest test_crash_schema.py
+"""
+
+import pandas as pd
+import pytest
+
+from crash_schema import check_layout, read_table
+
+
+def test_csvs_are_read_with_their_declared_types(tmp_path):
+    path = tmp_path / "crashes.csv"
+    path.write_text(
+        "House Number,Local Code,Number Injured,Vehicles Involved,Latitude\n"
+        "2215,2.022E+11,1,1-Car,39.1653\n"
+        "0919,,,2,\n"
+    )
+    df = read_table(str(path))
+
+    # text as it was written, not as numbers
+    assert df["House Number"].tolist() == ["2215", "0919"]
+    assert df["Local Code"].iloc[0] == "2.022E+11"
+    assert df["Number Injured"].dtype == "Int64"
+    assert df["Latitude"].dtype == "float64"
+    # a column that can't be converted without losing values stays text
+    assert df["Vehicles Involved"].tolist() == ["1-Car", "2"]
+
+
+def test_source_files_are_checked_against_their_layout():
+    df = pd.DataFrame(columns=["Year", "Month", "Day", "Hour", "Injury Type"])
+    with pytest.raises(ValueError, match="Reported_Location"):
+        check_layout(df, "2003-2015", "moco-crash-2003-2015.csv")
@@ -0,0 +1,86 @@
+"""
+checks that merging an extract into the data gives the same chart cube and
+jittered points as counting and jittering the whole master file again. run
+from the cleaning-scripts folder:
+    python -m pytest test_delta_ingest.py
+"""
+
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from delta_ingest import delta_paths, ingest
+from jitter import add_jitter
+from make_charts import DIMENSIONS, MEASURES, build_cube, load_cube
+from pipeline import read_output
+from record_ids import RECORD_ID
+from test_pipeline import SOURCE_DIR, make_data_dir, run_pipeline
+
+NAME = "moco-crash-2022"
+
+
+@pytest.fixture(scope="module")
+def data_dir(tmp_path_factory):
+    data_dir = make_data_dir(tmp_path_factory.mktemp("delta") / "data")
+    run_pipeline(data_dir)
+    return data_dir
+
+
+@pytest.fixture(scope="module")
+def source():
+    return pd.read_csv(
+        os.path.join(SOURCE_DIR, NAME + ".csv"),
+        dtype=str,
+        keep_default_na=False,
+        encoding="utf-8-sig",
+    )
+
+
+def save_extract(df, path):
+    df.to_csv(path, index=False)
+    return str(path)
+
+
+def sorted_cube(cube):
+    # the saved cube's factors are loaded as a categorical
+    cube = cube.astype({"Primary Factor": str})
+    return cube.sort_values(DIMENSIONS, ignore_index=True)[DIMENSIONS + MEASURES]
+
+
+def check_cube(paths):
+    cube = sorted_cube(load_cube(paths.charts))
+    recounted = sorted_cube(build_cube(read_output(paths.master, "charts")))
+    pd.testing.assert_frame_equal(cube, recounted, check_dtype=False)
+
+
+def test_delta_matches_a_full_recount(data_dir, source, tmp_path):
+    paths = delta_paths(data_dir, NAME)
+    # the first run has no saved hashes, every record counts as changed
+    ingest(save_extract(source, tmp_path / "first.csv"), NAME, data_dir)
+
+    # new crashes at the spots of older ones, and changed counts
+    located = source[~source["Latitude"].isin(["", "0"])]
+    new = located.sample(30, random_state=1).copy()
+    new["Collision Time"] = "3:17 AM"
+    new["Local Code"] = ["NEW%04d" % i for i in range(len(new))]
+    extract = pd.concat([source, new], ignore_index=True)
+    changed = source.sample(20, random_state=2).index
+    extract.loc[changed, "Number Injured"] = "13"
+    summary = ingest(save_extract(extract, tmp_path / "second.csv"), NAME, data_dir)
+    assert summary["new or changed"] == 50
+    check_cube(paths)
+
+    # nothing was removed, so every point is where a full run puts it
+    jittered = read_output(paths.jittered).set_index(RECORD_ID)
+    full = add_jitter(read_output(paths.master)).set_index(RECORD_ID)
+    for col in ["Latitude", "Longitude"]:
+        assert np.allclose(
+            jittered[col], full.loc[jittered.index, col], rtol=0, equal_nan=True
+        )
+
+    removed = extract.drop(extract.sample(15, random_state=3).index)
+    summary = ingest(save_extract(removed, tmp_path / "third.csv"), NAME, data_dir)
+    assert summary["removed"] == 15
+    check_cube(paths)
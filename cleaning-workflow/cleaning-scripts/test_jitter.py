@@ -0,0 +1,30 @@
+"""
+checks that jittering only depends on the order of the crashes, not on the
+df's index. run from the cleaning-scripts folder:
+    python -m pytest test_jitter.py
+"""
+
+import numpy as np
+import pandas as pd
+
+from jitter import add_jitter
+
+
+def test_a_repeated_index_jitters_like_a_fresh_one():
+    # ex. yearly files concatenated without `ignore_index`
+    df = pd.DataFrame(
+        {
+            "Latitude": [39.1653, 39.1653, 39.1653, None, 39.17],
+            "Longitude": [-86.5264, -86.5264, -86.5264, None, -86.53],
+        },
+        index=[0, 1, 0, 1, 0],
+    )
+    jittered = add_jitter(df.copy())
+    expected = add_jitter(df.reset_index(drop=True))
+
+    assert list(jittered.columns) == ["Latitude", "Longitude"]
+    for col in ["Latitude", "Longitude"]:
+        assert np.array_equal(jittered[col], expected[col], equal_nan=True)
+    # the first crash at a spot stays put, the others are moved
+    assert jittered["Latitude"].iloc[0] == 39.1653
+    assert jittered["Latitude"].iloc[1:3].nunique() == 2
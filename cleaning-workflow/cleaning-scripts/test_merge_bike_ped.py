@@ -0,0 +1,32 @@
+"""
+checks that every crash and every bike/ped report is matched at most once,
+without losing matches. run from the cleaning-scripts folder:
+    python -m pytest test_merge_bike_ped.py
+"""
+
+import numpy as np
+import pandas as pd
+
+from merge_bike_ped import build_index, match
+
+SPOT = {"Latitude": 39.1653, "Longitude": -86.5264}
+
+
+def crashes(*times):
+    return pd.DataFrame({"DateTime": pd.to_datetime(list(times)), **SPOT})
+
+
+def test_a_report_taken_by_one_crash_leaves_the_next_best_one():
+    # X and Y are reports, A and B crashes, all at the same spot. A takes X,
+    # so B has to take Y, even though B-X was the next pair to drop
+    index = build_index(crashes("2022-01-13 10:00", "2022-01-13 10:01"))
+    df = crashes("2022-01-13 10:00", "2022-01-13 10:02")
+
+    assert np.array_equal(match(df, index), [1.0, 0.75])
+
+
+def test_every_report_is_used_once():
+    index = build_index(crashes("2022-01-13 10:00"))
+    df = crashes("2022-01-13 10:00", "2022-01-13 10:01")
+
+    assert np.array_equal(match(df, index), [1.0, np.nan], equal_nan=True)
@@ -0,0 +1,113 @@
+"""
+checks that rerunning part of the pipeline gives the same files as a full
+run. run from the cleaning-scripts folder:
+    python -m pytest test_pipeline.py
+"""
+
+import os
+import ast
+import json
+import shutil
+import inspect
+import filecmp
+
+import pytest
+
+from pipeline import SCRIPT_DIR, SHARED_MODULES, STATE_FILE, build_tasks, run
+from run_report import RunReport
+
+SOURCE_DIR = "../../data/source-data"
+# one yearly file is enough, and keeps the runs short
+SOURCE_FILES = [
+    "moco-crash-2022.csv",
+    "bike-crashes-2013-2023.csv",
+    "ped-crashes-2013-2023.csv",
+]
+
+
+def make_data_dir(path):
+    os.makedirs(os.path.join(path, "source-data"))
+    os.makedirs(os.path.join(path, "cleaning-process"))
+    for name in SOURCE_FILES:
+        shutil.copy(
+            os.path.join(SOURCE_DIR, name), os.path.join(path, "source-data", name)
+        )
+    return str(path)
+
+
+def run_pipeline(data_dir):
+    return run(
+        build_tasks(data_dir), os.path.join(data_dir, STATE_FILE), report=RunReport()
+    )
+
+
+def output_files(data_dir):
+    """ every file the pipeline made, except its own bookkeeping """
+    found = []
+    for folder in ["cleaning-process", "clean-data"]:
+        for root, _, files in os.walk(os.path.join(data_dir, folder)):
+            found += [
+                os.path.relpath(os.path.join(root, name), data_dir)
+                for name in files
+                if name != os.path.basename(STATE_FILE)
+            ]
+    return sorted(found)
+
+
+@pytest.fixture(scope="module")
+def full_run(tmp_path_factory):
+    data_dir = make_data_dir(tmp_path_factory.mktemp("full") / "data")
+    run_pipeline(data_dir)
+    return data_dir
+
+
+@pytest.mark.parametrize("task", ["addresses:moco-crash-2022", "bike-ped:2022"])
+def test_rerunning_one_step_matches_a_full_run(full_run, tmp_path, task):
+    data_dir = make_data_dir(tmp_path / "data")
+    run_pipeline(data_dir)
+
+    # the same as editing the step's script: its key doesn't match anymore
+    state_file = os.path.join(data_dir, STATE_FILE)
+    with open(state_file) as f:
+        state = json.load(f)
+    state[task] = "changed"
+    with open(state_file, "w") as f:
+        json.dump(state, f)
+
+    rerun = run_pipeline(data_dir)
+    assert rerun[0] == task
+    assert not any(name.startswith("datetime:") for name in rerun)
+
+    files = output_files(full_run)
+    assert output_files(data_dir) == files
+    _, mismatch, errors = filecmp.cmpfiles(full_run, data_dir, files, shallow=False)
+    assert mismatch == [] and errors == []
+
+
+def local_imports(source):
+    """ the scripts in this folder that some code imports """
+    names = set()
+    for node in ast.walk(ast.parse(source)):
+        if isinstance(node, ast.Import):
+            names.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            names.add(node.module)
+    return {
+        name for name in names if os.path.exists(os.path.join(SCRIPT_DIR, name + ".py"))
+    }
+
+
+# some of the scripts' regexes aren't raw strings
+@pytest.mark.filterwarnings("ignore:invalid escape sequence")
+def test_tasks_list_every_script_they_use(tmp_path):
+    for task in build_tasks(make_data_dir(tmp_path / "data")):
+        if task.func is None:
+            continue
+        listed = set(task.modules) | set(SHARED_MODULES)
+        # the scripts the task's function imports, and everything they import
+        needed = local_imports(inspect.getsource(task.func))
+        # the pipeline imports every script, but only runs one in each task
+        for module in listed - {"pipeline"}:
+            with open(os.path.join(SCRIPT_DIR, module + ".py")) as f:
+                needed |= local_imports(f.read())
+        assert needed <= listed, task.name
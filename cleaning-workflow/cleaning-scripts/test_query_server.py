@@ -0,0 +1,64 @@
+"""
+checks that the query server answers queries it can't use with a 400. run
+from the cleaning-scripts folder:
+    python -m pytest test_query_server.py
+"""
+
+import json
+import hashlib
+from urllib.error import HTTPError
+from urllib.parse import urlparse
+from urllib.request import Request, urlopen
+
+import pytest
+
+from make_geojson import load_data
+from query_server import CrashIndex, cache_key, serve
+
+IN_FILE = "../../data/clean-data/jittered/moco-crash-2022-jittered.csv"
+
+
+@pytest.fixture(scope="module")
+def index():
+    return CrashIndex(load_data(IN_FILE))
+
+
+@pytest.fixture(scope="module")
+def server(index):
+    server = serve(index)
+    yield "http://127.0.0.1:%d" % server.server_address[1]
+    server.shutdown()
+
+
+def get(url, etag=None):
+    """ the status, ETag and body of an answer """
+    request = Request(url, headers={"If-None-Match": etag} if etag else {})
+    try:
+        with urlopen(request) as response:
+            return response.status, response.headers["ETag"], response.read()
+    except HTTPError as error:
+        return error.code, error.headers["ETag"], error.read()
+
+
+def etag_of(index, path):
+    """ the ETag the server gives a query, the same way it makes them """
+    key = cache_key(urlparse(path))
+    return '"%s"' % hashlib.sha1((index.version + key).encode("utf-8")).hexdigest()[:24]
+
+
+@pytest.mark.parametrize("years", ["1-99999", "1600", "2262", "99999999999999999999"])
+def test_years_out_of_range(server, years):
+    status, _, body = get(server + "/crashes?years=" + years)
+    assert status == 400
+    assert json.loads(body)["error"].startswith("years")
+
+
+def test_only_answers_get_a_304(index, server):
+    status, etag, _ = get(server + "/crashes?years=2022")
+    assert status == 200
+    assert etag == etag_of(index, "/crashes?years=2022")
+    assert get(server + "/crashes?years=2022", etag)[0] == 304
+
+    for bad in ["/crashes?years=1-99999", "/crashes?severity=all"]:
+        status, etag, _ = get(server + bad, etag_of(index, bad))
+        assert status == 400 and etag is None
@@ -0,0 +1,36 @@
+"""
+checks that the standalone scripts record their runs with `--report`. run
+from the cleaning-scripts folder:
+    python -m pytest test_run_report.py
+"""
+
+import sys
+import json
+import subprocess
+
+SOURCE_DIR = "../../data/source-data"
+YEARS = [2021, 2022]
+
+
+def test_script_report_has_every_file(tmp_path):
+    report_file = tmp_path / "run-reports.jsonl"
+    files = []
+    for year in YEARS:
+        files += [
+            "%s/moco-crash-%d.csv" % (SOURCE_DIR, year),
+            str(tmp_path / ("moco-crash-%d.csv" % year)),
+        ]
+    command = [sys.executable, "clean_datetime.py", *files, "--workers", "2"]
+    subprocess.run(command + ["--report", str(report_file)], check=True)
+
+    with open(report_file) as f:
+        [report] = [json.loads(line) for line in f]
+    assert report["script"] == "clean_datetime.py"
+    assert report["args"] == files + ["--workers", "2"]
+
+    # the steps of the worker processes too
+    steps = {(step["task"], step["step"]): step for step in report["steps"]}
+    for year in YEARS:
+        name = "moco-crash-%d.csv" % year
+        assert {(name, "load"), (name, "save"), (name, "file")} <= set(steps)
+        assert steps[(name, "load")]["rows_out"] == steps[(name, "save")]["rows_in"]